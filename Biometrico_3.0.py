@@ -1,457 +1,22 @@
 # -*- coding: utf-8 -*-
-import pymysql
-from zk import ZK
-from datetime import datetime, time
-import logging
-from pathlib import Path
-from contextlib import contextmanager
-import json
+from datetime import datetime
 import tkinter as tk
 from tkinter import messagebox, simpledialog, ttk, scrolledtext
 import threading
-import schedule
-import time as time_module
 import sys
-import os
-import subprocess
 import platform
 
-# Configurar la ruta de zk primero
-sys.path.insert(0, './zk')
-
-# --- ARCHIVOS DE CONFIGURACIÓN ---
-CONFIG_FILE = 'equipos.json'
-DB_CONFIG_FILE = 'db_config.json'
-SYNC_CONFIG_FILE = 'sync_config.json'
-LOG_FILE = 'biometric_sync.log'
-
-# --- CONFIGURACIONES BD ---
-DEFAULT_DB_CONFIG = {
-    'host': '10.0.0.7',
-    'user': 'root',
-    'password': 'S1st3m4s.',
-    'database': 'SIA',
-    'charset': 'utf8mb4',
-    'cursorclass': pymysql.cursors.DictCursor,
-    'autocommit': True
-}
-
-# --- CONFIGURACIÓN DE SINCRONIZACIÓN ---
-DEFAULT_SYNC_CONFIG = {
-    'horas_sincronizacion': ["08:00", "09:00", "10:00", "11:00", "12:00", "13:00", 
-                            "14:00", "14:35", "15:00", "16:00", "17:00", "18:00",
-                            "19:00", "20:00", "21:00", "22:00", "23:00", "00:00"],
-    'iniciar_con_sistema': False
-}
-
-# --- LOGGING ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(LOG_FILE, encoding='utf-8')
-    ]
+# Lógica de sincronización sin interfaz (también se ejecuta sola, ver sincronizador.py)
+from sincronizador import (
+    DB_CONFIG, SYNC_CONFIG, POOL_BD, GESTOR_SESIONES, logger,
+    guardar_db_config, guardar_sync_config, cargar_equipos, guardar_equipos,
+    configurar_inicio_sistema, conectar_db, obtener_ultimas_sincronizaciones,
+    extraer_datos, PlanificadorSincronizacion, inicializar_bd, describir_medicion,
+    iniciar_metricas, main as main_sin_interfaz
 )
-logger = logging.getLogger(__name__)
-
-# --- FUNCIONES DE CONFIGURACIÓN ---
-def cargar_config_archivo(archivo, default_config):
-    """Carga configuración desde archivo JSON con manejo de errores robusto"""
-    try:
-        if Path(archivo).exists():
-            with open(archivo, 'r', encoding='utf-8') as f:
-                contenido = f.read().strip()
-                if contenido:  # Verificar que no esté vacío
-                    data = json.loads(contenido)
-                    # Combinar con defaults
-                    config_actualizada = {**default_config, **data}
-                    logger.info(f"Configuración cargada desde {archivo}")
-                    return config_actualizada
-                else:
-                    logger.warning(f"Archivo {archivo} está vacío. Usando configuración por defecto.")
-                    return default_config.copy()
-        else:
-            logger.info(f"Archivo {archivo} no encontrado. Creando con configuración por defecto.")
-            with open(archivo, 'w', encoding='utf-8') as f:
-                json.dump(default_config, f, indent=2, ensure_ascii=False)
-            return default_config.copy()
-    except json.JSONDecodeError as e:
-        logger.error(f"Error de JSON en {archivo}: {e}. Usando configuración por defecto.")
-        # Crear archivo nuevo si está corrupto
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, indent=2, ensure_ascii=False)
-        return default_config.copy()
-    except Exception as e:
-        logger.error(f"Error cargando {archivo}: {e}", exc_info=True)
-        return default_config.copy()
-
-def cargar_db_config():
-    return cargar_config_archivo(DB_CONFIG_FILE, DEFAULT_DB_CONFIG)
-
-def cargar_sync_config():
-    return cargar_config_archivo(SYNC_CONFIG_FILE, DEFAULT_SYNC_CONFIG)
-
-def guardar_config_archivo(archivo, config):
-    """Guarda configuración en archivo JSON"""
-    try:
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
-        logger.info(f"Configuración guardada en {archivo}")
-        return True
-    except Exception as e:
-        logger.error(f"Error guardando configuración en {archivo}: {e}", exc_info=True)
-        return False
-
-def guardar_db_config(config):
-    # Solo campos serializables
-    serializable_config = {k: v for k, v in config.items() 
-                         if k in ["host", "user", "password", "database", "port", "charset"]}
-    return guardar_config_archivo(DB_CONFIG_FILE, serializable_config)
 
-def guardar_sync_config(config):
-    return guardar_config_archivo(SYNC_CONFIG_FILE, config)
-
-# Cargar configuraciones globales
-DB_CONFIG = cargar_db_config()
-SYNC_CONFIG = cargar_sync_config()
-
-# --- CONFIGURACIÓN DE EQUIPOS ---
-def cargar_equipos():
-    return cargar_config_archivo(CONFIG_FILE, {})
-
-def guardar_equipos(equipos):
-    return guardar_config_archivo(CONFIG_FILE, equipos)
-
-# --- CONFIGURACIÓN DE INICIO CON SISTEMA ---
-def configurar_inicio_sistema(habilitar=True):
-    """Configura la aplicación para iniciar con el sistema operativo"""
-    sistema = platform.system()
-    
-    try:
-        if sistema == "Windows":
-            from winreg import OpenKey, SetValueEx, CloseKey, HKEY_CURRENT_USER, KEY_SET_VALUE
-            from winreg import HKEYType, REG_SZ
-            
-            startup_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
-            app_name = "SincronizadorBiometrico"
-            app_path = os.path.abspath(sys.argv[0])
-            
-            key = OpenKey(HKEY_CURRENT_USER, startup_key, 0, KEY_SET_VALUE)
-            
-            if habilitar:
-                SetValueEx(key, app_name, 0, REG_SZ, f'"{app_path}"')
-                logger.info("Aplicación configurada para iniciar con Windows")
-            else:
-                try:
-                    from winreg import DeleteValue
-                    DeleteValue(key, app_name)
-                    logger.info("Aplicación removida del inicio de Windows")
-                except WindowsError:
-                    pass
-            
-            CloseKey(key)
-            
-        elif sistema == "Linux":
-            autostart_dir = os.path.expanduser("~/.config/autostart")
-            os.makedirs(autostart_dir, exist_ok=True)
-            
-            desktop_file = os.path.join(autostart_dir, "sincronizador-biometrico.desktop")
-            app_path = os.path.abspath(sys.argv[0])
-            
-            if habilitar:
-                desktop_content = f"""[Desktop Entry]
-Type=Application
-Name=Sincronizador Biométrico
-Exec=python3 "{app_path}"
-Hidden=false
-NoDisplay=false
-X-GNOME-Autostart-enabled=true
-"""
-                with open(desktop_file, 'w') as f:
-                    f.write(desktop_content)
-                os.chmod(desktop_file, 0o755)
-                logger.info("Aplicación configurada para iniciar con Linux")
-            else:
-                if os.path.exists(desktop_file):
-                    os.remove(desktop_file)
-                    logger.info("Aplicación removida del inicio de Linux")
-        
-        elif sistema == "Darwin":  # macOS
-            launchd_dir = os.path.expanduser("~/Library/LaunchAgents")
-            os.makedirs(launchd_dir, exist_ok=True)
-            
-            plist_file = os.path.join(launchd_dir, "com.sincronizador.biometrico.plist")
-            app_path = os.path.abspath(sys.argv[0])
-            
-            if habilitar:
-                plist_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<dict>
-    <key>Label</key>
-    <string>com.sincronizador.biometrico</string>
-    <key>ProgramArguments</key>
-    <array>
-        <string>python3</string>
-        <string>{app_path}</string>
-    </array>
-    <key>RunAtLoad</key>
-    <true/>
-    <key>KeepAlive</key>
-    <false/>
-</dict>
-</plist>"""
-                with open(plist_file, 'w') as f:
-                    f.write(plist_content)
-                logger.info("Aplicación configurada para iniciar con macOS")
-            else:
-                if os.path.exists(plist_file):
-                    os.remove(plist_file)
-                    logger.info("Aplicación removida del inicio de macOS")
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error configurando inicio con sistema: {e}", exc_info=True)
-        return False
-
-# --- CONEXIONES ---
-@contextmanager
-def conectar_biometrico(ip):
-    zk = ZK(ip, port=4370, timeout=20)
-    conn = None
-    try:
-        logger.info(f"Intentando conectar al equipo biométrico en {ip}")
-        conn = zk.connect()
-        conn.disable_device()
-        logger.info(f"Conexión exitosa al equipo biométrico en {ip}")
-        yield conn
-    except Exception as e:
-        logger.error(f"Error conectando al equipo biométrico {ip}: {str(e)}", exc_info=True)
-        yield None
-    finally:
-        if conn:
-            try:
-                conn.enable_device()
-                conn.disconnect()
-                logger.info(f"Conexión cerrada correctamente para el equipo en {ip}")
-            except Exception as e:
-                logger.error(f"Error cerrando conexión para equipo {ip}: {str(e)}", exc_info=True)
-
-@contextmanager
-def conectar_db():
-    conn = None
-    try:
-        logger.info("Intentando conectar a la base de datos")
-        conn = pymysql.connect(**DB_CONFIG)
-        logger.info("Conexión a BD exitosa")
-        yield conn
-    except Exception as e:
-        logger.error(f"Error conectando a la base de datos: {str(e)}", exc_info=True)
-        yield None
-    finally:
-        if conn:
-            try:
-                conn.close()
-                logger.info("Conexión a BD cerrada correctamente")
-            except Exception as e:
-                logger.error(f"Error cerrando conexión a BD: {str(e)}", exc_info=True)
-
-# --- PROCESAMIENTO ---
-def ajustar_minutos(user_id, hora):
-    try:
-        if user_id != "6833216":
-            return hora
-        if hora < time(9, 10):
-            minutos = hora.minute
-            if time(8, 35) <= hora < time(8, 40):
-                minutos -= int(minutos * 0.12)
-            elif time(8, 40) <= hora < time(8, 45):
-                minutos -= int(minutos * 0.17)
-            elif hora >= time(8, 45):
-                minutos -= int(minutos * 0.20)
-            minutos = max(minutos, 0)
-            return time(hora.hour, minutos, hora.second)
-        return hora
-    except Exception as e:
-        logger.error(f"Error ajustando minutos para user_id {user_id}: {str(e)}", exc_info=True)
-        return hora
-
-def verificar_duplicado(cursor, id_equipo, user_id, fecha, hora):
-    try:
-        cursor.execute(
-            """
-            SELECT COUNT(*) as count FROM rh_asistencias 
-            WHERE id_equipo = %s AND user_id = %s AND fecha = %s AND hora = %s
-            """,
-            (id_equipo, user_id, fecha, hora)
-        )
-        result = cursor.fetchone()
-        return result['count'] > 0
-    except Exception as e:
-        logger.error(f"Error verificando duplicado para {user_id} en {fecha} {hora}: {str(e)}", exc_info=True)
-        return True
-
-def actualizar_ultima_sincronizacion(db, id_equipo):
-    try:
-        with db.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO rh_sincronizaciones (id_equipo, ultima_sincronizacion, created_at, updated_at)
-                VALUES (%s, NOW(), NOW(), NOW())
-                ON DUPLICATE KEY UPDATE ultima_sincronizacion=NOW(), updated_at=NOW()
-                """,
-                (id_equipo,)
-            )
-        logger.info(f"Actualizada última sincronización para equipo {id_equipo}")
-    except Exception as e:
-        logger.error(f"Error actualizando última sincronización para equipo {id_equipo}: {str(e)}", exc_info=True)
-
-class ResultadoSincronizacion:
-    """Clase para almacenar resultados de sincronización"""
-    def __init__(self):
-        self.exitoso = False
-        self.total_equipos = 0
-        self.equipos_procesados = 0
-        self.registros_insertados = 0
-        self.registros_duplicados = 0
-        self.errores = 0
-        self.detalle_equipos = []
-        self.detalle_registros = []
-        self.mensaje = ""
-        self.timestamp = datetime.now()
-
-def extraer_datos():
-    """Función principal de extracción de datos con resultados detallados"""
-    resultado = ResultadoSincronizacion()
-    
-    try:
-        logger.info("Iniciando proceso de extracción de datos")
-        equipos = cargar_equipos()
-        resultado.total_equipos = len(equipos)
-        
-        if not equipos:
-            resultado.mensaje = "No hay equipos configurados para sincronizar"
-            logger.warning(resultado.mensaje)
-            return resultado
-
-        with conectar_db() as db:
-            if not db:
-                resultado.mensaje = "No se pudo conectar a la base de datos"
-                logger.error(resultado.mensaje)
-                return resultado
-
-            for id_equipo, ip in equipos.items():
-                resultado.equipos_procesados += 1
-                logger.info(f"Procesando equipo {id_equipo} ({ip})")
-                
-                registros_insertados = 0
-                registros_duplicados = 0
-                errores_equipo = 0
-                registros_detalle = []
-
-                with conectar_biometrico(ip) as bio:
-                    if not bio:
-                        resultado.errores += 1
-                        resultado.detalle_equipos.append({
-                            'equipo': id_equipo,
-                            'ip': ip,
-                            'estado': 'ERROR_CONEXION',
-                            'registros_insertados': 0,
-                            'registros_duplicados': 0,
-                            'errores': 1
-                        })
-                        logger.error(f"No se pudo conectar al equipo {id_equipo}")
-                        continue
-                    
-                    try:
-                        registros = bio.get_attendance()
-                        logger.info(f"Obtenidos {len(registros)} registros del equipo {id_equipo}")
-                    except Exception as e:
-                        resultado.errores += 1
-                        resultado.detalle_equipos.append({
-                            'equipo': id_equipo,
-                            'ip': ip,
-                            'estado': 'ERROR_LECTURA',
-                            'registros_insertados': 0,
-                            'registros_duplicados': 0,
-                            'errores': 1
-                        })
-                        logger.error(f"Error obteniendo registros del equipo {id_equipo}: {str(e)}", exc_info=True)
-                        continue
-
-                    with db.cursor() as cursor:
-                        for r in registros:
-                            try:
-                                user_id = str(r.user_id)
-                                fecha = r.timestamp.date()
-                                hora_original = r.timestamp.time()
-                                hora = ajustar_minutos(user_id, hora_original)
-
-                                if verificar_duplicado(cursor, id_equipo, user_id, fecha, hora):
-                                    registros_duplicados += 1
-                                    resultado.registros_duplicados += 1
-                                    continue
-
-                                cursor.execute(
-                                    """
-                                    INSERT INTO rh_asistencias (id_equipo, user_id, fecha, hora, visible, created_at, updated_at)
-                                    VALUES (%s, %s, %s, %s, 1, NOW(), NOW())
-                                    """,
-                                    (id_equipo, user_id, fecha, hora)
-                                )
-                                
-                                registros_insertados += 1
-                                resultado.registros_insertados += 1
-                                
-                                registros_detalle.append({
-                                    'user_id': user_id,
-                                    'fecha': str(fecha),
-                                    'hora_original': str(hora_original),
-                                    'hora_ajustada': str(hora),
-                                    'equipo': id_equipo
-                                })
-                                
-                            except Exception as e:
-                                errores_equipo += 1
-                                resultado.errores += 1
-                                logger.error(
-                                    f"Error procesando registro del equipo {id_equipo} - Usuario: {user_id}, Fecha: {fecha}, Hora: {hora}: {str(e)}", 
-                                    exc_info=True
-                                )
-
-                        actualizar_ultima_sincronizacion(db, id_equipo)
-
-                    # Agregar detalle del equipo procesado
-                    resultado.detalle_equipos.append({
-                        'equipo': id_equipo,
-                        'ip': ip,
-                        'estado': 'COMPLETADO',
-                        'registros_insertados': registros_insertados,
-                        'registros_duplicados': registros_duplicados,
-                        'errores': errores_equipo
-                    })
-                    
-                    # Agregar registros insertados
-                    resultado.detalle_registros.extend(registros_detalle)
-
-                    logger.info(
-                        f"Resumen equipo {id_equipo}:\n"
-                        f"Registros insertados: {registros_insertados}\n"
-                        f"Registros duplicados: {registros_duplicados}\n"
-                        f"Errores: {errores_equipo}"
-                    )
-
-        resultado.exitoso = True
-        resultado.mensaje = "Sincronización completada exitosamente"
-        logger.info(f"Proceso completado: {resultado.registros_insertados} registros insertados, {resultado.registros_duplicados} duplicados, {resultado.errores} errores")
-        
-    except Exception as e:
-        resultado.exitoso = False
-        resultado.mensaje = f"Error en sincronización: {str(e)}"
-        logger.error(f"Error en proceso de extracción: {str(e)}", exc_info=True)
-    
-    return resultado
+# Sincronizaciones programadas mientras la ventana está abierta
+PLANIFICADOR = PlanificadorSincronizacion()
 
 # --- INTERFAZ GRÁFICA MEJORADA ---
 class ModernButton(tk.Button):
@@ -796,6 +361,20 @@ class App:
             bg=self.colors['dark'],
             font=('Arial', 9))
         self.last_sync_label.pack(side="right", padx=10)
+        
+        # Estado del pool de conexiones a BD
+        self.pool_label = tk.Label(self.status_bar,
+            text="",
+            fg='white',
+            bg=self.colors['dark'],
+            font=('Arial', 9))
+        self.pool_label.pack(side="right", padx=10)
+        self.actualizar_estado_pool()
+
+    def actualizar_estado_pool(self):
+        """Refrescar periódicamente las estadísticas del pool en la barra de estado"""
+        self.pool_label.config(text=POOL_BD.descripcion())
+        self.root.after(5000, self.actualizar_estado_pool)
 
     def update_status(self, message):
         """Actualizar barra de estado"""
@@ -809,6 +388,8 @@ class App:
                 DB_CONFIG[campo] = entry.get()
             
             if guardar_db_config(DB_CONFIG):
+                # Las conexiones abiertas usan la configuración anterior
+                POOL_BD.reiniciar()
                 messagebox.showinfo("Éxito", "✅ Configuración de base de datos guardada correctamente")
                 self.update_status("Configuración BD guardada")
             else:
@@ -969,6 +550,7 @@ class App:
             
             equipos[id_equipo] = ip
             guardar_equipos(equipos)
+            PLANIFICADOR.reprogramar()
             self.actualizar_lista()
             self.update_status(f"Equipo {id_equipo} añadido")
             dialog.destroy()
@@ -1001,37 +583,34 @@ class App:
             if id_equipo in equipos:
                 del equipos[id_equipo]
                 guardar_equipos(equipos)
+                PLANIFICADOR.reprogramar()
                 self.actualizar_lista()
                 self.update_status(f"Equipo {id_equipo} eliminado")
                 logger.info(f"Equipo eliminado: {id_equipo}")
 
-    def obtener_ultima_sincronizacion(self, id_equipo):
-        """Obtener última sincronización de un equipo"""
-        try:
-            with conectar_db() as db:
-                if not db:
-                    return "No disponible"
-                with db.cursor() as cursor:
-                    cursor.execute(
-                        "SELECT ultima_sincronizacion FROM rh_sincronizaciones WHERE id_equipo = %s",
-                        (id_equipo,)
-                    )
-                    result = cursor.fetchone()
-                    return result['ultima_sincronizacion'].strftime('%Y-%m-%d %H:%M:%S') if result else "Nunca"
-        except Exception as e:
-            logger.error(f"Error obteniendo última sincronización: {e}")
-            return "Error"
-
     def actualizar_lista(self):
-        """Actualizar lista de equipos en el Treeview"""
+        """Actualizar lista de equipos; la consulta a la BD se hace en segundo plano"""
+        equipos = cargar_equipos()
+        
+        def consultar():
+            ultimas = obtener_ultimas_sincronizaciones()
+            self.root.after(0, lambda: self.mostrar_lista(equipos, ultimas))
+        
+        threading.Thread(target=consultar, daemon=True).start()
+
+    def mostrar_lista(self, equipos, ultimas):
+        """Cargar en el Treeview los equipos con su última sincronización"""
         for i in self.tree.get_children():
             self.tree.delete(i)
         
-        equipos = cargar_equipos()
-        
         for id_equipo, ip in equipos.items():
-            ultima_sinc = self.obtener_ultima_sincronizacion(id_equipo)
-            estado = "✅ Conectado" if ultima_sinc != "Nunca" else "❌ Sin sincronizar"
+            if ultimas is None:
+                ultima_sinc = "No disponible"
+            elif ultimas.get(str(id_equipo)):
+                ultima_sinc = ultimas[str(id_equipo)].strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                ultima_sinc = "Nunca"
+            estado = "✅ Conectado" if ultima_sinc not in ("Nunca", "No disponible") else "❌ Sin sincronizar"
             self.tree.insert('', 'end', values=(id_equipo, ip, ultima_sinc, estado))
         
         self.update_status(f"{len(equipos)} equipos cargados")
@@ -1065,6 +644,7 @@ class App:
             • Registros insertados: {resultado.registros_insertados}
             • Registros duplicados: {resultado.registros_duplicados}
             • Errores: {resultado.errores}
+            • Duración: {resultado.duracion:.1f} s
             • Hora: {resultado.timestamp.strftime('%Y-%m-%d %H:%M:%S')}
             """
             
@@ -1080,7 +660,7 @@ class App:
             
             # Detalle de registros (expandible)
             if resultado.detalle_registros:
-                self.create_detalle_registros(resultado.detalle_registros)
+                self.create_detalle_registros(resultado.detalle_registros, resultado.registros_insertados)
         
         else:
             # Error
@@ -1122,6 +702,9 @@ class App:
             elif detalle['estado'] == 'ERROR_CONEXION':
                 icon = "🔌"
                 color = self.colors['danger']
+            elif detalle['estado'] == 'OMITIDO_EN_CURSO':
+                icon = "⏳"
+                color = self.colors['accent']
             else:
                 icon = "⚠️"
                 color = self.colors['warning']
@@ -1140,11 +723,24 @@ class App:
                 bg=self.colors['light'],
                 fg=self.colors['dark']).pack(side="left")
 
-    def create_detalle_registros(self, detalle_registros):
+            # Tiempos por fase, para ver dónde se va el tiempo de cada equipo
+            if detalle.get('medicion'):
+                tk.Label(frame,
+                    text=f"⏱ {describir_medicion(detalle['medicion'])}",
+                    font=('Consolas', 8),
+                    bg=self.colors['light'],
+                    fg=self.colors['dark'],
+                    wraplength=800,
+                    justify="left").pack(anchor="w", padx=25)
+
+    def create_detalle_registros(self, detalle_registros, total_insertados):
         """Crear sección de detalle de registros (expandible)"""
+        # Se guardan hasta detalle_registros_max registros, y no los de lotes
+        # que mezclaban nuevos con duplicados
+        mostrados = f" - {len(detalle_registros)} de {total_insertados}" if len(detalle_registros) < total_insertados else ""
         # Frame colapsable
         self.registros_frame = tk.LabelFrame(self.results_container,
-            text="📝 Registros Insertados (Click para expandir/contraer)",
+            text=f"📝 Registros Insertados{mostrados} (Click para expandir/contraer)",
             font=('Arial', 10, 'bold'),
             bg=self.colors['light'],
             fg=self.colors['primary'])
@@ -1208,72 +804,15 @@ class App:
         threading.Thread(target=ejecutar_sincronizacion, daemon=True).start()
 
     def reiniciar_scheduler(self):
-        """Reiniciar el scheduler con nuevas horas"""
-        schedule.clear()
-        
-        for hora in SYNC_CONFIG.get('horas_sincronizacion', []):
-            try:
-                schedule.every().day.at(hora).do(extraer_datos)
-                logger.info(f"Programada sincronización a las {hora}")
-            except Exception as e:
-                logger.error(f"Error programando hora {hora}: {e}")
-
-# --- JOBS PROGRAMADOS ---
-def programar_jobs():
-    """Programar trabajos de sincronización"""
-    for hora in SYNC_CONFIG.get('horas_sincronizacion', []):
-        try:
-            schedule.every().day.at(hora).do(extraer_datos)
-            logger.info(f"Programada sincronización a las {hora}")
-        except Exception as e:
-            logger.error(f"Error programando hora {hora}: {e}")
-    
-    while True:
-        try:
-            schedule.run_pending()
-        except Exception as e:
-            logger.error(f"Error ejecutando job programado: {e}")
-        time_module.sleep(60)
-
-# --- INICIALIZACIÓN DE BD ---
-def inicializar_bd():
-    """Inicializar tablas de base de datos si no existen"""
-    try:
-        with conectar_db() as db:
-            if db:
-                with db.cursor() as cursor:
-                    # Tabla de sincronizaciones
-                    cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS rh_sincronizaciones (
-                        id_equipo VARCHAR(50) PRIMARY KEY,
-                        ultima_sincronizacion DATETIME,
-                        created_at DATETIME,
-                        updated_at DATETIME
-                    )
-                    """)
-                    
-                    # Tabla de asistencias
-                    cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS rh_asistencias (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        id_equipo VARCHAR(50),
-                        user_id VARCHAR(50),
-                        fecha DATE,
-                        hora TIME,
-                        visible BOOLEAN DEFAULT 1,
-                        created_at DATETIME,
-                        updated_at DATETIME,
-                        INDEX idx_equipo_usuario_fecha_hora (id_equipo, user_id, fecha, hora)
-                    )
-                    """)
-                    
-                    db.commit()
-                    logger.info("Tablas de base de datos verificadas/creadas")
-    except Exception as e:
-        logger.error(f"Error inicializando base de datos: {e}", exc_info=True)
+        """Reprogramar las sincronizaciones con las nuevas horas"""
+        PLANIFICADOR.reprogramar()
 
 # --- MAIN ---
 if __name__ == '__main__':
+    # Con argumentos (--sync-once, --service, --tiempo-real) no se abre la interfaz
+    if len(sys.argv) > 1:
+        sys.exit(main_sin_interfaz())
+
     # Configurar inicio con sistema si está habilitado
     if SYNC_CONFIG.get('iniciar_con_sistema', False):
         configurar_inicio_sistema(True)
@@ -1281,9 +820,9 @@ if __name__ == '__main__':
     # Inicializar base de datos
     inicializar_bd()
     
-    # Iniciar scheduler en segundo plano
-    scheduler_thread = threading.Thread(target=programar_jobs, daemon=True)
-    scheduler_thread.start()
+    # Iniciar planificador en segundo plano
+    PLANIFICADOR.iniciar()
+    iniciar_metricas()
     
     # Iniciar interfaz gráfica
     root = tk.Tk()
@@ -1293,6 +832,8 @@ if __name__ == '__main__':
     def on_closing():
         if messagebox.askokcancel("Salir", "¿Desea salir del sincronizador?\nLas sincronizaciones programadas se detendrán."):
             logger.info("Aplicación cerrada por el usuario")
+            PLANIFICADOR.detener(esperar=False)
+            GESTOR_SESIONES.cerrar_todas()
             root.destroy()
     
     root.protocol("WM_DELETE_WINDOW", on_closing)
@@ -1301,4 +842,6 @@ if __name__ == '__main__':
         root.mainloop()
     except KeyboardInterrupt:
         logger.info("Aplicación interrumpida por el usuario")
+        PLANIFICADOR.detener(esperar=False)
+        GESTOR_SESIONES.cerrar_todas()
         root.destroy()
\ No newline at end of file
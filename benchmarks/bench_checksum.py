@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark y verificación del checksum de los paquetes ZK.
+
+Compara zk.base.create_checksum con la implementación original (copiada de
+zkemsdk.c, byte a byte) sobre vectores fijos y paquetes aleatorios, y mide
+el tiempo por paquete para tamaños típicos: un comando corto, una petición
+_CMD_READ_BUFFER y un bloque de 1 KB de __send_chunk.
+
+Uso:
+    python benchmarks/bench_checksum.py --aleatorios 20000
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from struct import pack, unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zk import const  # noqa: E402
+from zk.base import create_checksum  # noqa: E402
+
+# (paquete en hexadecimal, checksum esperado)
+VECTORES = [
+    ('', 65534),
+    ('00', 65534),
+    ('ff', 65279),
+    ('ffff', 65534),
+    ('ffffff', 65279),
+    ('0100feff', 65534),
+    ('e80300000000feff', 64535),                                # CMD_CONNECT
+    ('e0050000d204070000000000c0ff0000', 62852),                # _CMD_READ_BUFFER
+    ('df050000d2040800010d000000000000000000', 59460),          # _CMD_PREPARE_BUFFER
+    ('0b000000e110fdff7e53657269616c4e756d62657200', 42513),    # CMD_OPTIONS_RRQ
+    (bytes(range(256)).hex(), 49214),
+    ('ff' * 1032, 65534),
+]
+
+
+def checksum_original(p):
+    """Implementación anterior de ZK.__create_checksum (recibe una tupla de bytes)."""
+    l = len(p)
+    checksum = 0
+    while l > 1:
+        checksum += unpack('H', pack('BB', p[0], p[1]))[0]
+        p = p[2:]
+        if checksum > const.USHRT_MAX:
+            checksum -= const.USHRT_MAX
+        l -= 2
+    if l:
+        checksum = checksum + p[-1]
+    while checksum > const.USHRT_MAX:
+        checksum -= const.USHRT_MAX
+    checksum = ~checksum
+    while checksum < 0:
+        checksum += const.USHRT_MAX
+    return checksum
+
+
+def header_original(buf):
+    """Como lo hacía __create_header: desempaquetar todo el paquete en una tupla."""
+    return checksum_original(unpack('%sB' % len(buf), buf))
+
+
+def verificar(aleatorios):
+    errores = 0
+    for paquete, esperado in VECTORES:
+        paquete = bytes.fromhex(paquete)
+        for nombre, obtenido in (('nuevo', create_checksum(paquete)), ('original', header_original(paquete))):
+            if obtenido != esperado:
+                errores += 1
+                print("ERROR {}: {}... -> {} (esperado {})".format(nombre, paquete[:16].hex(), obtenido, esperado))
+    rnd = random.Random(0)
+    for _ in range(aleatorios):
+        paquete = bytes(rnd.choice((0, 0xff, rnd.randrange(256))) for _ in range(rnd.randrange(300)))
+        if create_checksum(paquete) != header_original(paquete):
+            errores += 1
+            print("ERROR aleatorio: {}".format(paquete.hex()))
+    print("{} vectores fijos y {} aleatorios, {} errores".format(len(VECTORES), aleatorios, errores))
+    return errores
+
+
+def medir():
+    casos = [
+        ('comando', pack('<4H', const.CMD_GET_FREE_SIZES, 0, 1234, 10)),
+        ('read_buffer', pack('<4H', const._CMD_READ_BUFFER, 0, 1234, 10) + pack('<ii', 0, 0xFFc0)),
+        ('chunk 1KB', pack('<4H', const.CMD_DATA, 0, 1234, 10) + os.urandom(1024)),
+    ]
+    for nombre, paquete in casos:
+        repeticiones = 2000 if len(paquete) > 100 else 50000
+        original = min(timeit.repeat(lambda: header_original(paquete), number=repeticiones, repeat=3))
+        nuevo = min(timeit.repeat(lambda: create_checksum(paquete), number=repeticiones, repeat=3))
+        print("{:<12} {:>5} bytes: original {:8.2f} us, nuevo {:6.2f} us ({:.0f}x)".format(
+            nombre, len(paquete), original / repeticiones * 1e6, nuevo / repeticiones * 1e6, original / nuevo))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del checksum del protocolo ZK')
+    parser.add_argument('--aleatorios', type=int, default=5000, help='paquetes aleatorios a comparar')
+    args = parser.parse_args()
+    errores = verificar(args.aleatorios)
+    medir()
+    sys.exit(1 if errores else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la recepción de datos del protocolo ZK.
+
+Levanta un equipo simulado por TCP (o usa uno real con --ip) y descarga un
+buffer con read_with_buffer, midiendo el tiempo, los bytes recibidos y la
+memoria asignada en el pico de la descarga por cada MB transferido. Con la
+recepción sin copias el pico debería quedar cerca de 1 MB por MB (solo el
+buffer final).
+
+Uso:
+    python benchmarks/bench_recepcion.py --mb 8 --repeticiones 3
+    python benchmarks/bench_recepcion.py --ip 10.0.0.50
+"""
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+from struct import pack, unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zk import ZK, const  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def _paquete(comando, sesion, respuesta, datos=b''):
+    # el cliente no verifica el checksum de las respuestas
+    cabecera = pack('<4H', comando, 0, sesion, respuesta) + datos
+    return pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, len(cabecera)) + cabecera
+
+
+class _EquipoSimulado(socketserver.BaseRequestHandler):
+    """Responde lo mínimo para conectar y leer un buffer por bloques."""
+    buffer = b''
+
+    def _leer(self, cantidad):
+        datos = b''
+        while len(datos) < cantidad:
+            parte = self.request.recv(cantidad - len(datos))
+            if not parte:
+                raise EOFError
+            datos += parte
+        return datos
+
+    def handle(self):
+        sesion = 1
+        try:
+            while True:
+                longitud = unpack('<HHI', self._leer(8))[2]
+                paquete = self._leer(longitud)
+                comando, _, _, respuesta = unpack('<4H', paquete[:8])
+                datos = paquete[8:]
+                if comando == const._CMD_PREPARE_BUFFER:
+                    self.request.sendall(_paquete(const.CMD_ACK_OK, sesion, respuesta,
+                                                  b'\x00' + pack('<I', len(self.buffer))))
+                elif comando == const._CMD_READ_BUFFER:
+                    inicio, cantidad = unpack('<ii', datos[:8])
+                    bloque = self.buffer[inicio:inicio + cantidad]
+                    self.request.sendall(
+                        _paquete(const.CMD_PREPARE_DATA, sesion, respuesta, pack('<II', len(bloque), 0)) +
+                        _paquete(const.CMD_DATA, sesion, respuesta, bloque) +
+                        _paquete(const.CMD_ACK_OK, sesion, respuesta))
+                elif comando == const.CMD_EXIT:
+                    self.request.sendall(_paquete(const.CMD_ACK_OK, sesion, respuesta))
+                    return
+                else:
+                    self.request.sendall(_paquete(const.CMD_ACK_OK, sesion, respuesta))
+        except (EOFError, ConnectionError):
+            return
+
+
+def iniciar_equipo_simulado(tamano):
+    _EquipoSimulado.buffer = os.urandom(tamano)
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    servidor = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _EquipoSimulado)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def medir(conn, comando, fct):
+    recibidos = conn.bytes_received
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    datos, tamano = conn.read_with_buffer(comando, fct)
+    duracion = time.perf_counter() - inicio
+    _actual, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del datos
+    return {
+        'tamano': tamano,
+        'segundos': duracion,
+        'recibidos': conn.bytes_received - recibidos,
+        'pico': pico,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de recepción del protocolo ZK')
+    parser.add_argument('--mb', type=float, default=8, help='tamaño del buffer simulado en MB')
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--ip', help='equipo real en lugar del simulado (descarga las marcaciones)')
+    parser.add_argument('--puerto', type=int, default=4370)
+    args = parser.parse_args()
+
+    servidor = None
+    if args.ip:
+        zk = ZK(args.ip, port=args.puerto, timeout=20)
+        comando, fct = const.CMD_ATTLOG_RRQ, 0
+    else:
+        servidor = iniciar_equipo_simulado(int(args.mb * MB))
+        zk = ZK('127.0.0.1', port=servidor.server_address[1], timeout=20, ommit_ping=True)
+        comando, fct = const.CMD_ATTLOG_RRQ, 0
+
+    conn = zk.connect()
+    try:
+        for numero in range(1, args.repeticiones + 1):
+            r = medir(conn, comando, fct)
+            mb = r['tamano'] / MB if r['tamano'] else 1
+            print("#{}: {:.2f} MB en {:.3f}s ({:.1f} MB/s), recibidos {} bytes, "
+                  "pico de memoria {:.2f} MB por MB transferido".format(
+                      numero, r['tamano'] / MB, r['segundos'], mb / r['segundos'] if r['segundos'] else 0,
+                      r['recibidos'], r['pico'] / MB / mb))
+    finally:
+        conn.disconnect()
+        if servidor:
+            servidor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de punta a punta de la sincronización.
+
+Levanta equipos simulados (zk.simulator) con datos sintéticos reproducibles
+(misma semilla, mismos registros) y mide, para cada cantidad de
+marcaciones, tres escenarios; cada uno corre en un proceso aparte para que
+el pico de memoria sea solo suyo:
+
+    cliente      el cliente ZK directo: conexión, usuarios, transferencia y
+                 decodificación del buffer de marcaciones
+    inicial      extraer_datos() con la BD vacía: todo se inserta
+    repetida     extraer_datos() sin marca de sincronización sobre una BD que
+                 ya tiene todo: se descarga y se descarta como duplicado
+
+Por defecto la BD es SQLite en un directorio temporal, con el mismo esquema
+y la misma clave única que rh_asistencias; con --bd mysql se usa la BD de
+--db-config (¡solo una BD de pruebas! se borran las filas BENCH*).
+
+Informa registros/s, bytes/s, viajes a la BD, pico de memoria (RSS) y el
+tiempo de cada fase (conexion, usuarios, transferencia, decodificacion,
+deduplicacion, insercion; en inicial y repetida, las fases que mide el
+propio sincronizador en cada equipo). Con varios equipos las fases suman el
+tiempo de todos los hilos. Los resultados se guardan en JSON para comparar versiones.
+
+Uso:
+    python benchmarks/bench_sincronizacion.py --registros 10000 100000 1000000
+    python benchmarks/bench_sincronizacion.py --salida actual.json --comparar anterior.json
+    python benchmarks/bench_sincronizacion.py --escenarios inicial --equipos 4 --latencia 0.02
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from datetime import time as hora_dia
+import multiprocessing
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+from zk import ZK, const, protocol  # noqa: E402
+from zk.simulator import SimulatedDevice, ZKSimulator  # noqa: E402
+
+ESCENARIOS = ('cliente', 'inicial', 'repetida')
+FASES = ('conexion', 'usuarios', 'transferencia', 'decodificacion', 'deduplicacion', 'insercion')
+MB = 1024 * 1024
+
+
+# --- MEDICIONES ---
+class Fases:
+    """Acumula segundos por fase desde varios hilos"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.segundos = dict((fase, 0.0) for fase in FASES)
+
+    def sumar(self, fase, segundos):
+        with self._lock:
+            self.segundos[fase] = self.segundos.get(fase, 0.0) + segundos
+
+
+def rss_pico_mb():
+    """Pico de memoria residente del proceso en MB (None si no se puede medir)"""
+    try:
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux informa KB, macOS bytes
+        return pico / MB if sys.platform == 'darwin' else pico / 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class CONTADORES(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        contadores = CONTADORES()
+        contadores.cb = ctypes.sizeof(contadores)
+        proceso = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(proceso, ctypes.byref(contadores), contadores.cb):
+            return contadores.PeakWorkingSetSize / MB
+    except Exception:
+        pass
+    return None
+
+
+# --- BD ---
+class CursorContado:
+    """Cursor que cuenta cada sentencia enviada a la BD"""
+    def __init__(self, cursor, conexion):
+        self._cursor = cursor
+        self._conexion = conexion
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, parametros=None):
+        self._conexion.viajes['execute'] += 1
+        return self._cursor.execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        self._conexion.viajes['execute'] += 1
+        return self._cursor.executemany(sql, parametros)
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+
+class ConexionContada:
+    """Envuelve una conexión (pymysql o ConexionSQLite) y cuenta sus viajes a la BD"""
+    def __init__(self, conexion, viajes):
+        self._conexion = conexion
+        self.viajes = viajes
+
+    def cursor(self):
+        return CursorContado(self._conexion.cursor(), self)
+
+    def _contar(self, nombre, *args, **kwargs):
+        self.viajes[nombre] += 1
+        return getattr(self._conexion, nombre)(*args, **kwargs)
+
+    def begin(self):
+        return self._contar('begin')
+
+    def commit(self):
+        return self._contar('commit')
+
+    def rollback(self):
+        return self._contar('rollback')
+
+    def ping(self, *args, **kwargs):
+        return self._contar('ping', *args, **kwargs)
+
+    def close(self):
+        return self._conexion.close()
+
+
+# Traducción de las sentencias MySQL de sincronizador.py a SQLite
+TRADUCCIONES_SQLITE = [
+    (re.compile(r'SHOW INDEX FROM (\w+) WHERE Key_name = (\S+)'),
+     r"SELECT name AS Key_name FROM sqlite_master WHERE type = 'index' AND tbl_name = '\1' AND name = \2"),
+    (re.compile(r'ON DUPLICATE KEY UPDATE id = id'), 'ON CONFLICT DO NOTHING'),
+    (re.compile(r'ON DUPLICATE KEY UPDATE'), 'ON CONFLICT(id_equipo) DO UPDATE SET'),
+    (re.compile(r'NOW\(\)'), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'%s'), '?'),
+]
+
+ESQUEMA_SQLITE = """
+CREATE TABLE IF NOT EXISTS rh_sincronizaciones (
+    id_equipo VARCHAR(50) PRIMARY KEY,
+    ultima_sincronizacion DATETIME,
+    created_at DATETIME,
+    updated_at DATETIME
+);
+CREATE TABLE IF NOT EXISTS rh_asistencias (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_equipo VARCHAR(50),
+    user_id VARCHAR(50),
+    fecha DATE,
+    hora TIME,
+    visible BOOLEAN DEFAULT 1,
+    created_at DATETIME,
+    updated_at DATETIME
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_equipo_usuario_fecha_hora ON rh_asistencias (id_equipo, user_id, fecha, hora);
+"""
+
+
+def a_sqlite(valor):
+    if isinstance(valor, (date, hora_dia)):
+        return valor.isoformat()
+    return valor
+
+
+def desde_sqlite(columna, valor):
+    """Devuelve los tipos que entrega pymysql (DATE, TIME como timedelta, DATETIME)"""
+    if valor is None:
+        return None
+    if columna == 'fecha':
+        return date.fromisoformat(valor)
+    if columna == 'hora':
+        h, m, s = (int(parte) for parte in valor.split(':'))
+        return timedelta(hours=h, minutes=m, seconds=s)
+    if columna == 'ultima_sincronizacion':
+        return datetime.fromisoformat(valor)
+    return valor
+
+
+class CursorSQLite:
+    """Cursor con la interfaz de pymysql (DictCursor) sobre sqlite3"""
+    def __init__(self, conexion):
+        self._cursor = conexion.cursor()
+        self._filas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, parametros=None):
+        for patron, reemplazo in TRADUCCIONES_SQLITE:
+            sql = patron.sub(reemplazo, sql)
+        self._cursor.execute(sql, [a_sqlite(valor) for valor in parametros or ()])
+        if self._cursor.description:
+            columnas = [d[0] for d in self._cursor.description]
+            self._filas = [dict((c, desde_sqlite(c, v)) for c, v in zip(columnas, fila))
+                           for fila in self._cursor.fetchall()]
+            return len(self._filas)
+        self._filas = []
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._filas.pop(0) if self._filas else None
+
+    def fetchall(self):
+        filas, self._filas = self._filas, []
+        return filas
+
+    def close(self):
+        self._cursor.close()
+
+
+class ConexionSQLite:
+    """Conexión a SQLite con la interfaz de pymysql usada por sincronizador.py (autocommit)"""
+    def __init__(self, ruta):
+        self._conexion = sqlite3.connect(ruta, timeout=60, isolation_level=None, check_same_thread=False)
+
+    def cursor(self):
+        return CursorSQLite(self._conexion)
+
+    def begin(self):
+        self._conexion.execute('BEGIN')
+
+    def commit(self):
+        if self._conexion.in_transaction:
+            self._conexion.execute('COMMIT')
+
+    def rollback(self):
+        if self._conexion.in_transaction:
+            self._conexion.execute('ROLLBACK')
+
+    def ping(self, reconnect=False):
+        return True
+
+    def close(self):
+        self._conexion.close()
+
+
+def preparar_bd(sincronizador, args, directorio, viajes):
+    """Conecta sincronizador.py a la BD del benchmark y la deja vacía"""
+    if args.bd == 'sqlite':
+        ruta = os.path.join(directorio, 'bench.sqlite')
+        with sqlite3.connect(ruta) as conexion:
+            conexion.executescript(ESQUEMA_SQLITE)
+            conexion.execute("PRAGMA journal_mode=WAL")
+        conectar = lambda **_config: ConexionContada(ConexionSQLite(ruta), viajes)  # noqa: E731
+    else:
+        conectar_mysql = sincronizador.pymysql.connect
+        conectar = lambda **config: ConexionContada(conectar_mysql(**config), viajes)  # noqa: E731
+    sincronizador.pymysql.connect = conectar
+    if args.bd == 'mysql':
+        sincronizador.inicializar_bd()
+        with sincronizador.conectar_db() as db:
+            with db.cursor() as cursor:
+                cursor.execute("DELETE FROM rh_asistencias WHERE id_equipo LIKE 'BENCH%'")
+                cursor.execute("DELETE FROM rh_sincronizaciones WHERE id_equipo LIKE 'BENCH%'")
+    for clave in list(viajes):
+        viajes[clave] = 0
+
+
+# --- ESCENARIOS ---
+def crear_equipo(args, registros):
+    return SimulatedDevice(users=args.usuarios, records=registros, record_size=args.formato,
+                           user_packet_size=args.formato_usuario, seed=args.semilla)
+
+
+def iniciar_simuladores(args, registros):
+    simuladores = []
+    for numero in range(args.equipos):
+        simulador = ZKSimulator(crear_equipo(args, registros), tcp=args.protocolo == 'tcp',
+                                udp=args.protocolo == 'udp', latency=args.latencia)
+        simulador.start()
+        simuladores.append(simulador)
+    return simuladores
+
+
+def escenario_cliente(args, registros, simuladores, fases):
+    zk = ZK('127.0.0.1', port=simuladores[0].port, timeout=60, ommit_ping=True,
+            force_udp=args.protocolo == 'udp', read_window=args.ventana)
+    inicio = time.perf_counter()
+    conn = zk.connect()
+    fases.sumar('conexion', time.perf_counter() - inicio)
+    try:
+        marca = time.perf_counter()
+        usuarios = conn.get_users()
+        fases.sumar('usuarios', time.perf_counter() - marca)
+
+        marca = time.perf_counter()
+        conn.read_sizes()
+        datos, tamano = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        fases.sumar('transferencia', time.perf_counter() - marca)
+
+        marca = time.perf_counter()
+        by_uid, by_user_id = protocol.index_users(usuarios)
+        record_size = (tamano - 4) // conn.records if conn.records else 0
+        marcaciones = protocol.decode_attendance(memoryview(datos)[4:], record_size, by_uid, by_user_id)
+        fases.sumar('decodificacion', time.perf_counter() - marca)
+    finally:
+        conn.disconnect()
+    return {'registros': len(marcaciones), 'segundos': time.perf_counter() - inicio}
+
+
+def escenario_sincronizacion(args, registros, simuladores, fases, directorio, escenario):
+    # sincronizador.py lee y escribe su configuración en el directorio actual
+    os.chdir(directorio)
+    logging.getLogger('sincronizador').setLevel(logging.WARNING)
+    import sincronizador
+
+    viajes = {'execute': 0, 'begin': 0, 'commit': 0, 'rollback': 0, 'ping': 0}
+    preparar_bd(sincronizador, args, directorio, viajes)
+    sincronizador.SYNC_CONFIG.update(
+        ventana_lectura_zk=args.ventana,
+        modo_deduplicacion=args.deduplicacion,
+        max_equipos_paralelos=args.equipos)
+    # La IP de cada equipo lleva el puerto de su simulador
+    sincronizador.ZK = lambda ip, port=4370, **opciones: ZK(
+        ip.split(':')[0], port=int(ip.split(':')[1]), ommit_ping=True,
+        force_udp=args.protocolo == 'udp', **opciones)
+    sincronizador.guardar_equipos(dict(
+        ('BENCH%02i' % numero, '127.0.0.1:%i' % simulador.port)
+        for numero, simulador in enumerate(simuladores, 1)))
+
+    if escenario == 'repetida':
+        sincronizador.extraer_datos()
+        os.remove(sincronizador.MARCAS_FILE)
+        for clave in viajes:
+            viajes[clave] = 0
+
+    with sincronizador.HISTORIAL_MEDICIONES_LOCK:
+        sincronizador.HISTORIAL_MEDICIONES.clear()
+    inicio = time.perf_counter()
+    resultado = sincronizador.extraer_datos()
+    segundos = time.perf_counter() - inicio
+    sincronizador.GESTOR_SESIONES.cerrar_todas()
+    if not resultado.exitoso:
+        raise RuntimeError(resultado.mensaje)
+
+    # Las fases las mide el propio sincronizador en cada equipo
+    for medicion in sincronizador.historial_mediciones():
+        for fase, duracion in medicion['fases'].items():
+            fases.sumar(fase, duracion)
+    return {
+        'registros': registros * args.equipos,
+        'segundos': segundos,
+        'insertados': resultado.registros_insertados,
+        'duplicados': resultado.registros_duplicados,
+        'errores': resultado.errores,
+        'viajes_bd': sum(viajes.values()),
+        'viajes_bd_detalle': viajes,
+    }
+
+
+def ejecutar_caso(args, registros, escenario):
+    """Ejecuta un escenario en el proceso actual y devuelve sus métricas"""
+    directorio = tempfile.mkdtemp(prefix='bench_sync_')
+    if args.db_config:
+        shutil.copy(args.db_config, os.path.join(directorio, 'db_config.json'))
+    else:
+        # Con SQLite la configuración de MySQL no se usa, pero debe existir
+        with open(os.path.join(directorio, 'db_config.json'), 'w', encoding='utf-8') as archivo:
+            json.dump({'host': 'sqlite'}, archivo)
+    simuladores = iniciar_simuladores(args, registros)
+    fases = Fases()
+    try:
+        if escenario == 'cliente':
+            metricas = escenario_cliente(args, registros, simuladores, fases)
+        else:
+            metricas = escenario_sincronizacion(args, registros, simuladores, fases, directorio, escenario)
+    finally:
+        for simulador in simuladores:
+            simulador.stop()
+        os.chdir(RAIZ)
+        shutil.rmtree(directorio, ignore_errors=True)
+    enviados = sum(simulador.stats['bytes_sent'] for simulador in simuladores)
+    segundos = metricas['segundos']
+    metricas.update(
+        escenario=escenario,
+        registros_equipo=registros,
+        registros_por_segundo=metricas['registros'] / segundos if segundos else 0,
+        bytes=enviados,
+        bytes_por_segundo=enviados / segundos if segundos else 0,
+        rss_pico_mb=rss_pico_mb(),
+        fases=dict((fase, round(valor, 4)) for fase, valor in fases.segundos.items()))
+    return metricas
+
+
+# --- RESULTADOS ---
+def version_codigo():
+    try:
+        salida = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=RAIZ,
+                                capture_output=True, text=True, timeout=10)
+        return salida.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def mostrar(caso):
+    rss = '{:.0f} MB'.format(caso['rss_pico_mb']) if caso['rss_pico_mb'] is not None else '-'
+    print("{:>9} {:>9}: {:8.2f}s {:>10.0f} reg/s {:>7.1f} MB/s  BD {:>6}  RSS {}".format(
+        caso['escenario'], caso['registros_equipo'], caso['segundos'], caso['registros_por_segundo'],
+        caso['bytes_por_segundo'] / MB, caso.get('viajes_bd', '-'), rss))
+    print("{:>20} {}".format('', '  '.join(
+        '{} {:.3f}s'.format(fase, segundos) for fase, segundos in caso['fases'].items() if segundos)))
+
+
+def comparar(resultados, ruta):
+    with open(ruta, encoding='utf-8') as archivo:
+        anterior = json.load(archivo)
+    previos = dict(((caso['escenario'], caso['registros_equipo']), caso) for caso in anterior['resultados'])
+    print("\nComparación con {} ({})".format(ruta, anterior.get('version')))
+    for caso in resultados:
+        previo = previos.get((caso['escenario'], caso['registros_equipo']))
+        if previo and caso['segundos']:
+            print("{:>9} {:>9}: {:.2f}x ({:.2f}s -> {:.2f}s)".format(
+                caso['escenario'], caso['registros_equipo'], previo['segundos'] / caso['segundos'],
+                previo['segundos'], caso['segundos']))
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description='Benchmark de punta a punta de la sincronización')
+    parser.add_argument('--registros', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='marcaciones por equipo de cada conjunto de datos')
+    parser.add_argument('--escenarios', nargs='+', choices=ESCENARIOS, default=list(ESCENARIOS))
+    parser.add_argument('--equipos', type=int, default=1)
+    parser.add_argument('--usuarios', type=int, default=500)
+    parser.add_argument('--formato', type=int, choices=(8, 16, 40), default=40, help='bytes por marcación')
+    parser.add_argument('--formato-usuario', type=int, choices=(28, 72), default=72, help='bytes por usuario')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--protocolo', choices=('tcp', 'udp'), default='tcp')
+    parser.add_argument('--latencia', type=float, default=0, help='segundos por paquete del simulador')
+    parser.add_argument('--ventana', type=int, default=1, help='ventana_lectura_zk')
+    parser.add_argument('--deduplicacion', choices=('bd', 'conjunto', 'consulta'), default='bd')
+    parser.add_argument('--bd', choices=('sqlite', 'mysql'), default='sqlite')
+    parser.add_argument('--db-config', help='db_config.json para --bd mysql')
+    parser.add_argument('--salida', help='guarda los resultados en este JSON')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior')
+    return parser
+
+
+def main():
+    args = crear_parser().parse_args()
+    if args.bd == 'mysql' and not args.db_config:
+        crear_parser().error('--bd mysql requiere --db-config')
+
+    resultados = []
+    for registros in args.registros:
+        for escenario in args.escenarios:
+            # Un proceso nuevo por caso: sincronizador.py se importa limpio y el pico de RSS es solo suyo
+            contexto = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as proceso:
+                caso = proceso.submit(ejecutar_caso, args, registros, escenario).result()
+            mostrar(caso)
+            resultados.append(caso)
+
+    informe = {
+        'version': version_codigo(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': dict((clave, valor) for clave, valor in vars(args).items()
+                           if clave not in ('salida', 'comparar', 'db_config')),
+        'resultados': resultados,
+    }
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            json.dump(informe, archivo, indent=2)
+        print("Resultados guardados en {}".format(args.salida))
+    if args.comparar:
+        comparar(resultados, args.comparar)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Métricas de la sincronización en el formato de texto de Prometheus.
+
+Sin dependencias externas: un registro en memoria de contadores, valores
+(gauges) e histogramas con etiquetas, y un servidor HTTP local (http.server)
+que los publica en /metrics. sincronizador.py alimenta el registro con la
+medición de cada equipo, la latencia de cada sentencia a la BD y el retraso
+del planificador; el servidor solo se inicia si metricas_habilitadas está
+activo en sync_config.json.
+
+Ejemplo de alertas:
+    time() - biometrico_ultima_sincronizacion_exitosa_timestamp_segundos > 3 * 3600
+    biometrico_equipo_alcanzable == 0
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTADOR = 'counter'
+VALOR = 'gauge'
+HISTOGRAMA = 'histogram'
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatear_numero(valor):
+    if valor == float('inf'):
+        return '+Inf'
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return repr(valor) if isinstance(valor, float) else str(valor)
+
+
+class Metricas:
+    """Registro de métricas seguro entre hilos"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._familias = {}  # nombre -> {'tipo', 'ayuda', 'buckets', 'series': {etiquetas: valor}}
+
+    def definir(self, nombre, tipo, ayuda, buckets=BUCKETS_SEGUNDOS):
+        with self._lock:
+            self._familias.setdefault(nombre, {
+                'tipo': tipo,
+                'ayuda': ayuda,
+                'buckets': tuple(sorted(buckets)) if tipo == HISTOGRAMA else None,
+                'series': {}
+            })
+
+    def _serie(self, nombre, etiquetas):
+        familia = self._familias[nombre]
+        clave = tuple(sorted(etiquetas.items()))
+        if clave not in familia['series']:
+            if familia['tipo'] == HISTOGRAMA:
+                familia['series'][clave] = {'buckets': [0] * len(familia['buckets']), 'suma': 0.0, 'cantidad': 0}
+            else:
+                familia['series'][clave] = 0
+        return familia, clave
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        with self._lock:
+            familia, clave = self._serie(nombre, etiquetas)
+            familia['series'][clave] += valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            familia, clave = self._serie(nombre, etiquetas)
+            familia['series'][clave] = valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            familia, clave = self._serie(nombre, etiquetas)
+            serie = familia['series'][clave]
+            for indice, limite in enumerate(familia['buckets']):
+                if valor <= limite:
+                    serie['buckets'][indice] += 1
+                    break
+            serie['suma'] += valor
+            serie['cantidad'] += 1
+
+    def exponer(self):
+        """Texto en el formato de exposición de Prometheus (versión 0.0.4)"""
+        lineas = []
+        with self._lock:
+            for nombre, familia in sorted(self._familias.items()):
+                lineas.append(f"# HELP {nombre} {familia['ayuda']}")
+                lineas.append(f"# TYPE {nombre} {familia['tipo']}")
+                for clave, serie in sorted(familia['series'].items()):
+                    if familia['tipo'] != HISTOGRAMA:
+                        lineas.append(f"{nombre}{self._etiquetas(clave)} {formatear_numero(serie)}")
+                        continue
+                    acumulado = 0
+                    for limite, cantidad in zip(familia['buckets'] + (float('inf'),),
+                                                serie['buckets'] + [serie['cantidad'] - sum(serie['buckets'])]):
+                        acumulado += cantidad
+                        etiquetas = self._etiquetas(clave + (('le', formatear_numero(float(limite))),))
+                        lineas.append(f"{nombre}_bucket{etiquetas} {acumulado}")
+                    lineas.append(f"{nombre}_sum{self._etiquetas(clave)} {formatear_numero(serie['suma'])}")
+                    lineas.append(f"{nombre}_count{self._etiquetas(clave)} {serie['cantidad']}")
+        return "\n".join(lineas) + "\n"
+
+    @staticmethod
+    def _etiquetas(clave):
+        if not clave:
+            return ''
+        return '{' + ','.join(f'{nombre}="{escapar(valor)}"' for nombre, valor in clave) + '}'
+
+
+# --- MÉTRICAS DE LA SINCRONIZACIÓN ---
+METRICAS = Metricas()
+METRICAS.definir('biometrico_sincronizaciones_total', CONTADOR, 'Sincronizaciones de equipos por estado final')
+METRICAS.definir('biometrico_registros_insertados_total', CONTADOR, 'Marcaciones insertadas en rh_asistencias')
+METRICAS.definir('biometrico_registros_duplicados_total', CONTADOR, 'Marcaciones descartadas por estar ya registradas')
+METRICAS.definir('biometrico_errores_total', CONTADOR, 'Errores al sincronizar un equipo')
+METRICAS.definir('biometrico_bytes_recibidos_total', CONTADOR, 'Bytes recibidos de los equipos')
+METRICAS.definir('biometrico_sentencias_bd_total', CONTADOR, 'Sentencias enviadas a la BD')
+METRICAS.definir('biometrico_fase_segundos_total', CONTADOR, 'Segundos acumulados en cada fase de la sincronización')
+METRICAS.definir('biometrico_sincronizacion_segundos', HISTOGRAMA, 'Duración de la sincronización de un equipo')
+METRICAS.definir('biometrico_equipo_alcanzable', VALOR, '1 si la última sincronización pudo conectar con el equipo')
+METRICAS.definir('biometrico_ultima_sincronizacion_exitosa_timestamp_segundos', VALOR,
+                 'Momento (epoch) de la última sincronización completada del equipo')
+METRICAS.definir('biometrico_bd_sentencia_segundos', HISTOGRAMA, 'Latencia de cada sentencia a la BD')
+METRICAS.definir('biometrico_planificador_retraso_segundos', HISTOGRAMA,
+                 'Demora entre el vencimiento de un turno programado y el inicio de la sincronización')
+
+
+def registrar_sincronizacion(registro):
+    """Acumula la medición de un equipo (ver sincronizador.registrar_medicion)"""
+    equipo = registro['equipo']
+    METRICAS.incrementar('biometrico_sincronizaciones_total', equipo=equipo, estado=registro['estado'])
+    registrar_insercion(equipo, registro['insertados'], registro['duplicados'], registro['errores'])
+    METRICAS.incrementar('biometrico_bytes_recibidos_total', registro['bytes_recibidos'], equipo=equipo)
+    METRICAS.incrementar('biometrico_sentencias_bd_total', registro['sentencias_bd'], equipo=equipo)
+    for fase, segundos in registro['fases'].items():
+        METRICAS.incrementar('biometrico_fase_segundos_total', segundos, equipo=equipo, fase=fase)
+    METRICAS.observar('biometrico_sincronizacion_segundos', registro['duracion'], equipo=equipo)
+    METRICAS.fijar('biometrico_equipo_alcanzable', 0 if registro['estado'] == 'ERROR_CONEXION' else 1, equipo=equipo)
+    if registro['estado'] == 'COMPLETADO':
+        METRICAS.fijar('biometrico_ultima_sincronizacion_exitosa_timestamp_segundos', time.time(), equipo=equipo)
+
+
+def registrar_insercion(equipo, insertados, duplicados, errores):
+    """Marcaciones registradas de un equipo (sincronización o tiempo real)"""
+    METRICAS.incrementar('biometrico_registros_insertados_total', insertados, equipo=equipo)
+    METRICAS.incrementar('biometrico_registros_duplicados_total', duplicados, equipo=equipo)
+    METRICAS.incrementar('biometrico_errores_total', errores, equipo=equipo)
+
+
+def registrar_latencia_bd(segundos):
+    METRICAS.observar('biometrico_bd_sentencia_segundos', segundos)
+
+
+def registrar_retraso_planificador(segundos):
+    METRICAS.observar('biometrico_planificador_retraso_segundos', max(0.0, segundos))
+
+
+# --- SERVIDOR HTTP ---
+class _ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        cuerpo = self.server.metricas.exponer().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass  # cada consulta de Prometheus ensuciaría el log
+
+
+class ServidorMetricas:
+    """Publica un registro de métricas por HTTP en un hilo en segundo plano"""
+    def __init__(self, metricas=METRICAS, host='127.0.0.1', puerto=9108):
+        self.metricas = metricas
+        self.host = host
+        self.puerto = puerto
+        self._servidor = None
+        self._hilo = None
+
+    def iniciar(self):
+        """Abre el puerto; lanza OSError si está ocupado"""
+        self._servidor = ThreadingHTTPServer((self.host, self.puerto), _ManejadorMetricas)
+        self._servidor.daemon_threads = True
+        self._servidor.metricas = self.metricas
+        self.puerto = self._servidor.server_address[1]
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, name='metricas', daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+            self._servidor = None
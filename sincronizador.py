@@ -0,0 +1,1916 @@
+# -*- coding: utf-8 -*-
+"""Núcleo del sincronizador biométrico, sin interfaz gráfica.
+
+Lo usa Biometrico_3.0.py y también se ejecuta solo, como servicio o tarea
+programada (systemd, cron, Programador de tareas):
+
+    python sincronizador.py --sync-once [--device ID ...]
+    python sincronizador.py --service [--device ID ...]
+    python sincronizador.py --tiempo-real [--device ID ...]
+
+Códigos de salida: 0 correcto, 1 sincronización con errores, 2 error de
+configuración (sin equipos o equipo desconocido).
+
+Con metricas_habilitadas en sync_config.json, --service, --tiempo-real y la
+interfaz publican métricas para Prometheus en http://127.0.0.1:9108/metrics
+(ver metricas.py).
+"""
+import pymysql
+import metricas
+from zk import ZK
+from zk.exception import ZKError, ZKNetworkError
+from datetime import datetime, time, timedelta
+import logging
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from collections import deque
+import json
+import threading
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor
+import random
+import time as time_module
+import sys
+import os
+import platform
+import argparse
+
+# Configurar la ruta de zk primero
+sys.path.insert(0, './zk')
+
+# --- ARCHIVOS DE CONFIGURACIÓN ---
+CONFIG_FILE = 'equipos.json'
+DB_CONFIG_FILE = 'db_config.json'
+SYNC_CONFIG_FILE = 'sync_config.json'
+MARCAS_FILE = 'marcas_sincronizacion.json'
+PLANIFICADOR_FILE = 'planificador_estado.json'
+CACHE_USUARIOS_DIR = 'cache_usuarios'
+SPOOL_ZK_DIR = 'spool_zk'
+LOG_FILE = 'biometric_sync.log'
+
+# --- CONFIGURACIONES BD ---
+DEFAULT_DB_CONFIG = {
+    'host': '10.0.0.7',
+    'user': 'root',
+    'password': 'S1st3m4s.',
+    'database': 'SIA',
+    'charset': 'utf8mb4',
+    'cursorclass': pymysql.cursors.DictCursor,
+    'autocommit': True
+}
+
+# --- CONFIGURACIÓN DE SINCRONIZACIÓN ---
+DEFAULT_SYNC_CONFIG = {
+    'horas_sincronizacion': ["08:00", "09:00", "10:00", "11:00", "12:00", "13:00", 
+                            "14:00", "14:35", "15:00", "16:00", "17:00", "18:00",
+                            "19:00", "20:00", "21:00", "22:00", "23:00", "00:00"],
+    'iniciar_con_sistema': False,
+    'sincronizacion_incremental': True,
+    'max_equipos_paralelos': 4,
+    'max_conexiones_bd': 2,
+    # 'bd': la clave única de rh_asistencias descarta duplicados al insertar (sin consultas previas)
+    # 'conjunto': una consulta por equipo, 'consulta': una por registro
+    'modo_deduplicacion': 'bd',
+    'tamano_lote_insercion': 500,
+    'pool_bd_tamano': 4,
+    'pool_bd_inactividad_segundos': 300,
+    'pool_bd_vida_segundos': 3600,
+    'cache_estado_segundos': 5,
+    # Usuarios de cada equipo guardados por número de serie; se vuelven a
+    # descargar si cambia la cantidad de usuarios o pasan estas horas
+    'cache_usuarios': True,
+    'cache_usuarios_horas': 24,
+    # Peticiones de lectura en vuelo por equipo (1 = una a la vez); subirlo
+    # acelera la descarga en enlaces con mucha latencia hacia las sucursales
+    'ventana_lectura_zk': 1,
+    # Por defecto se descarga el buffer crudo, se libera el equipo y recién
+    # después se decodifica e inserta de a tamano_lote_insercion marcaciones.
+    # Con descarga_en_flujo se decodifica e inserta a medida que llegan los
+    # bloques, con memoria constante aunque el log sea enorme, pero el equipo
+    # queda deshabilitado y ocupando un turno de max_conexiones_bd hasta
+    # terminar de escribir, y la descarga no se reanuda desde el spool
+    'descarga_en_flujo': False,
+    # Guarda en disco los bloques ya descargados; si se corta la conexión,
+    # la siguiente sincronización solo pide los bloques que faltan (solo sin
+    # descarga_en_flujo)
+    'reanudar_descargas': True,
+    # Registros insertados que se guardan para mostrar en el detalle
+    'detalle_registros_max': 1000,
+    # Conecta sin ping ni sondeo TCP previo y recuerda el protocolo de cada equipo
+    'conexion_rapida_zk': True,
+    'timeout_conexion_zk': 5,
+    # Mantiene abierta la conexión con cada equipo entre sincronizaciones
+    'sesiones_persistentes': True,
+    'keepalive_segundos': 60,
+    'sesion_inactiva_max_segundos': 7200,
+    # Modo --tiempo-real: las marcaciones se escriben en lotes de hasta este
+    # tamaño o cada intervalo, lo que ocurra primero
+    'tiempo_real_lote': 100,
+    'tiempo_real_intervalo_segundos': 2,
+    'tiempo_real_reintento_segundos': 30,
+    # Planificador: los equipos listados aquí se sincronizan cada tantos
+    # minutos ({"SUC01": 15}); el resto, en horas_sincronizacion
+    'intervalos_equipos': {},
+    # Demora aleatoria de hasta estos segundos por equipo, para que las
+    # sucursales no escriban todas a la vez en la BD
+    'jitter_sincronizacion_segundos': 120,
+    # Al iniciar, sincroniza los equipos cuyo último turno no se completó
+    # (aplicación cerrada o equipo apagado a esa hora)
+    'recuperar_sincronizaciones_perdidas': True,
+    'planificador_trabajadores': 2,
+    # Mediciones por equipo (tiempos por fase, bytes, sentencias) que se
+    # conservan en memoria; además cada una queda en el log como una línea JSON
+    'historial_mediciones': 200,
+    # Endpoint HTTP local con métricas para Prometheus (http://host:puerto/metrics)
+    'metricas_habilitadas': False,
+    'metricas_host': '127.0.0.1',
+    'metricas_puerto': 9108
+}
+
+# --- LOGGING ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler(LOG_FILE, encoding='utf-8')
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# --- FUNCIONES DE CONFIGURACIÓN ---
+def cargar_config_archivo(archivo, default_config):
+    """Carga configuración desde archivo JSON con manejo de errores robusto"""
+    try:
+        if Path(archivo).exists():
+            with open(archivo, 'r', encoding='utf-8') as f:
+                contenido = f.read().strip()
+                if contenido:  # Verificar que no esté vacío
+                    data = json.loads(contenido)
+                    # Combinar con defaults
+                    config_actualizada = {**default_config, **data}
+                    logger.info(f"Configuración cargada desde {archivo}")
+                    return config_actualizada
+                else:
+                    logger.warning(f"Archivo {archivo} está vacío. Usando configuración por defecto.")
+                    return default_config.copy()
+        else:
+            logger.info(f"Archivo {archivo} no encontrado. Creando con configuración por defecto.")
+            with open(archivo, 'w', encoding='utf-8') as f:
+                json.dump(default_config, f, indent=2, ensure_ascii=False)
+            return default_config.copy()
+    except json.JSONDecodeError as e:
+        logger.error(f"Error de JSON en {archivo}: {e}. Usando configuración por defecto.")
+        # Crear archivo nuevo si está corrupto
+        with open(archivo, 'w', encoding='utf-8') as f:
+            json.dump(default_config, f, indent=2, ensure_ascii=False)
+        return default_config.copy()
+    except Exception as e:
+        logger.error(f"Error cargando {archivo}: {e}", exc_info=True)
+        return default_config.copy()
+
+def cargar_db_config():
+    return cargar_config_archivo(DB_CONFIG_FILE, DEFAULT_DB_CONFIG)
+
+def cargar_sync_config():
+    return cargar_config_archivo(SYNC_CONFIG_FILE, DEFAULT_SYNC_CONFIG)
+
+def guardar_config_archivo(archivo, config):
+    """Guarda configuración en archivo JSON"""
+    try:
+        with open(archivo, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        logger.info(f"Configuración guardada en {archivo}")
+        return True
+    except Exception as e:
+        logger.error(f"Error guardando configuración en {archivo}: {e}", exc_info=True)
+        return False
+
+def guardar_db_config(config):
+    # Solo campos serializables
+    serializable_config = {k: v for k, v in config.items() 
+                         if k in ["host", "user", "password", "database", "port", "charset"]}
+    return guardar_config_archivo(DB_CONFIG_FILE, serializable_config)
+
+def guardar_sync_config(config):
+    return guardar_config_archivo(SYNC_CONFIG_FILE, config)
+
+# Cargar configuraciones globales
+DB_CONFIG = cargar_db_config()
+SYNC_CONFIG = cargar_sync_config()
+
+# --- CONFIGURACIÓN DE EQUIPOS ---
+def cargar_equipos():
+    return cargar_config_archivo(CONFIG_FILE, {})
+
+def guardar_equipos(equipos):
+    return guardar_config_archivo(CONFIG_FILE, equipos)
+
+def seleccionar_equipos(ids_equipos=None):
+    """Equipos configurados, o solo los indicados en ids_equipos.
+
+    Devuelve None si alguno de los ids pedidos no está en equipos.json.
+    """
+    equipos = cargar_equipos()
+    if not ids_equipos:
+        return equipos
+    desconocidos = [id_equipo for id_equipo in ids_equipos if id_equipo not in equipos]
+    if desconocidos:
+        logger.error(f"Equipos no configurados en {CONFIG_FILE}: {', '.join(desconocidos)}")
+        return None
+    return {id_equipo: equipos[id_equipo] for id_equipo in ids_equipos}
+
+# --- MARCAS DE SINCRONIZACIÓN INCREMENTAL ---
+MARCAS_LOCK = threading.Lock()
+
+def cargar_marcas():
+    """Carga la cantidad de registros ya leídos de cada equipo"""
+    return cargar_config_archivo(MARCAS_FILE, {})
+
+def marca_equipo(marcas, id_equipo):
+    """Marca de un equipo como la espera el cliente ZK: (registros ya leídos, último registro leído).
+
+    Con el último registro (usuario y fecha) el cliente detecta si el log se
+    borró y volvió a crecer desde la sincronización anterior.
+    """
+    marca = (marcas or {}).get(id_equipo, {})
+    ultimo = marca.get('ultimo')
+    if ultimo:
+        ultimo = (ultimo[0], datetime.strptime(ultimo[1], '%Y-%m-%d %H:%M:%S'))
+    return marca.get('registros'), ultimo or None
+
+def guardar_marca(marcas, id_equipo, registros, ultimo=None):
+    """Actualiza y persiste la marca de un equipo tras una sincronización sin errores.
+
+    Se relee el archivo para no pisar las marcas que guardaron otras
+    sincronizaciones en curso; llamar con MARCAS_LOCK tomado.
+    """
+    marcas[id_equipo] = {
+        'registros': registros,
+        'actualizado': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if ultimo:
+        marcas[id_equipo]['ultimo'] = [ultimo[0], ultimo[1].strftime('%Y-%m-%d %H:%M:%S')]
+    actuales = cargar_marcas()
+    actuales[id_equipo] = marcas[id_equipo]
+    return guardar_config_archivo(MARCAS_FILE, actuales)
+
+# --- CONFIGURACIÓN DE INICIO CON SISTEMA ---
+def configurar_inicio_sistema(habilitar=True):
+    """Configura la aplicación para iniciar con el sistema operativo"""
+    sistema = platform.system()
+    
+    try:
+        if sistema == "Windows":
+            from winreg import OpenKey, SetValueEx, CloseKey, HKEY_CURRENT_USER, KEY_SET_VALUE
+            from winreg import HKEYType, REG_SZ
+            
+            startup_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
+            app_name = "SincronizadorBiometrico"
+            app_path = os.path.abspath(sys.argv[0])
+            
+            key = OpenKey(HKEY_CURRENT_USER, startup_key, 0, KEY_SET_VALUE)
+            
+            if habilitar:
+                SetValueEx(key, app_name, 0, REG_SZ, f'"{app_path}"')
+                logger.info("Aplicación configurada para iniciar con Windows")
+            else:
+                try:
+                    from winreg import DeleteValue
+                    DeleteValue(key, app_name)
+                    logger.info("Aplicación removida del inicio de Windows")
+                except WindowsError:
+                    pass
+            
+            CloseKey(key)
+            
+        elif sistema == "Linux":
+            autostart_dir = os.path.expanduser("~/.config/autostart")
+            os.makedirs(autostart_dir, exist_ok=True)
+            
+            desktop_file = os.path.join(autostart_dir, "sincronizador-biometrico.desktop")
+            app_path = os.path.abspath(sys.argv[0])
+            
+            if habilitar:
+                desktop_content = f"""[Desktop Entry]
+Type=Application
+Name=Sincronizador Biométrico
+Exec=python3 "{app_path}"
+Hidden=false
+NoDisplay=false
+X-GNOME-Autostart-enabled=true
+"""
+                with open(desktop_file, 'w') as f:
+                    f.write(desktop_content)
+                os.chmod(desktop_file, 0o755)
+                logger.info("Aplicación configurada para iniciar con Linux")
+            else:
+                if os.path.exists(desktop_file):
+                    os.remove(desktop_file)
+                    logger.info("Aplicación removida del inicio de Linux")
+        
+        elif sistema == "Darwin":  # macOS
+            launchd_dir = os.path.expanduser("~/Library/LaunchAgents")
+            os.makedirs(launchd_dir, exist_ok=True)
+            
+            plist_file = os.path.join(launchd_dir, "com.sincronizador.biometrico.plist")
+            app_path = os.path.abspath(sys.argv[0])
+            
+            if habilitar:
+                plist_content = f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+    <key>Label</key>
+    <string>com.sincronizador.biometrico</string>
+    <key>ProgramArguments</key>
+    <array>
+        <string>python3</string>
+        <string>{app_path}</string>
+    </array>
+    <key>RunAtLoad</key>
+    <true/>
+    <key>KeepAlive</key>
+    <false/>
+</dict>
+</plist>"""
+                with open(plist_file, 'w') as f:
+                    f.write(plist_content)
+                logger.info("Aplicación configurada para iniciar con macOS")
+            else:
+                if os.path.exists(plist_file):
+                    os.remove(plist_file)
+                    logger.info("Aplicación removida del inicio de macOS")
+        
+        return True
+    except Exception as e:
+        logger.error(f"Error configurando inicio con sistema: {e}", exc_info=True)
+        return False
+
+# --- CONEXIONES ---
+def crear_zk(ip):
+    """Crea el cliente ZK del equipo con las opciones de sync_config.json"""
+    opciones = {'read_window': max(1, int(SYNC_CONFIG.get('ventana_lectura_zk', 1)))}
+    if SYNC_CONFIG.get('conexion_rapida_zk', True):
+        opciones['fast_connect'] = True
+        opciones['connect_timeout'] = SYNC_CONFIG.get('timeout_conexion_zk', 5)
+    if SYNC_CONFIG.get('cache_usuarios', True):
+        opciones['user_cache_dir'] = CACHE_USUARIOS_DIR
+        opciones['user_cache_ttl'] = SYNC_CONFIG.get('cache_usuarios_horas', 24) * 3600
+    if SYNC_CONFIG.get('reanudar_descargas', True):
+        opciones['spool_dir'] = SPOOL_ZK_DIR
+    return ZK(ip, port=4370, timeout=20, **opciones)
+
+class ErrorConexionEquipo(Exception):
+    """No se pudo abrir la sesión con el equipo biométrico"""
+
+class DescargaInterrumpida(Exception):
+    """Se cortó la descarga en flujo con marcaciones ya registradas.
+
+    GestorSesiones no la reintenta: volver a leer contaría lo ya insertado
+    como duplicado. La marca no avanza y se completa en la próxima sincronización.
+    """
+
+class GestorSesiones:
+    """Sesiones con los equipos biométricos que sobreviven entre sincronizaciones.
+
+    En lugar de conectar, autenticar y desconectar en cada sincronización,
+    mantiene una conexión abierta por equipo. Un hilo en segundo plano envía
+    un comando liviano (la hora del equipo) a las sesiones libres para
+    mantenerlas vivas, y cierra las que fallan o llevan demasiado tiempo sin
+    usarse. Cada sesión tiene su propio lock, así que un equipo nunca recibe
+    comandos de dos hilos a la vez.
+    Con persistente=False se conecta y desconecta en cada uso, como antes.
+    """
+    def __init__(self, persistente=True, intervalo_keepalive=60, inactividad_max=7200):
+        self.persistente = persistente
+        self.intervalo_keepalive = max(1, intervalo_keepalive)
+        self.inactividad_max = inactividad_max
+        self._lock = threading.Lock()
+        self._sesiones = {}  # ip -> {'conn', 'lock', 'ultimo_uso'}
+        self._ventana_reducida = set()  # ips que se leen de a un bloque
+        self._hilo = None
+        self._detener = threading.Event()
+        self.conexiones = 0
+        self.reutilizadas = 0
+        self.reconexiones = 0
+
+    def _sesion(self, ip):
+        with self._lock:
+            sesion = self._sesiones.get(ip)
+            if sesion is None:
+                sesion = self._sesiones[ip] = {'conn': None, 'lock': threading.Lock(), 'ultimo_uso': 0}
+            if self.persistente and self._hilo is None:
+                self._hilo = threading.Thread(target=self._mantener, name='keepalive-zk', daemon=True)
+                self._hilo.start()
+            return sesion
+
+    def _conectar(self, ip):
+        logger.info(f"Intentando conectar al equipo biométrico en {ip}")
+        try:
+            bio = crear_zk(ip)
+            if ip in self._ventana_reducida:
+                bio.read_window = 1
+            conn = bio.connect()
+        except Exception as e:
+            raise ErrorConexionEquipo(f"No se pudo conectar al equipo {ip}: {e}") from e
+        self.conexiones += 1
+        logger.info(f"Conexión exitosa al equipo biométrico en {ip}")
+        return conn
+
+    def _cerrar(self, ip, sesion):
+        conn, sesion['conn'] = sesion['conn'], None
+        if conn and conn.read_window == 1:
+            # Si el cliente bajó la ventana porque el equipo dejó de responder
+            # con varias lecturas en vuelo, se mantiene en las próximas conexiones
+            self._ventana_reducida.add(ip)
+        if conn:
+            try:
+                conn.disconnect()
+                logger.info(f"Conexión cerrada correctamente para el equipo en {ip}")
+            except Exception as e:
+                logger.warning(f"Error cerrando conexión para equipo {ip}: {str(e)}")
+
+    def ejecutar(self, ip, funcion, medicion=None):
+        """Ejecuta funcion(conn) con la sesión del equipo y devuelve su resultado.
+
+        Si una sesión reutilizada resulta estar caída (error de red), o si el
+        equipo dejó de responder a las lecturas en vuelo (el cliente baja su
+        ventana de lectura a 1), se reconecta y se reintenta una vez. Lanza ErrorConexionEquipo si no se
+        puede conectar; los demás errores de funcion se propagan. La conexión
+        y la desconexión se miden en medicion (MedicionEquipo).
+        """
+        medicion = medicion or MedicionEquipo()
+        sesion = self._sesion(ip)
+        with sesion['lock']:
+            try:
+                for intento in range(2):
+                    reutilizada = sesion['conn'] is not None
+                    if reutilizada:
+                        self.reutilizadas += 1
+                    else:
+                        with medicion.medir('conexion'):
+                            sesion['conn'] = self._conectar(ip)
+                    ventana = sesion['conn'].read_window
+                    try:
+                        resultado = funcion(sesion['conn'])
+                        sesion['ultimo_uso'] = time_module.monotonic()
+                        return resultado
+                    except (ZKNetworkError, OSError) as e:
+                        ventana_reducida = sesion['conn'].read_window < ventana
+                        self._cerrar(ip, sesion)
+                        if not (reutilizada or ventana_reducida) or intento:
+                            raise
+                        self.reconexiones += 1
+                        logger.warning(f"Sesión con el equipo {ip} caída ({e}), reconectando")
+                    except Exception:
+                        self._cerrar(ip, sesion)
+                        raise
+            finally:
+                if not self.persistente:
+                    with medicion.medir('desconexion'):
+                        self._cerrar(ip, sesion)
+
+    def _mantener(self):
+        while not self._detener.wait(self.intervalo_keepalive):
+            with self._lock:
+                sesiones = list(self._sesiones.items())
+            for ip, sesion in sesiones:
+                # Las sesiones en uso ya demuestran estar vivas
+                if sesion['conn'] is None or not sesion['lock'].acquire(blocking=False):
+                    continue
+                try:
+                    if sesion['conn'] is None:
+                        continue
+                    if time_module.monotonic() - sesion['ultimo_uso'] > self.inactividad_max:
+                        logger.info(f"Cerrando sesión inactiva con el equipo {ip}")
+                        self._cerrar(ip, sesion)
+                    else:
+                        sesion['conn'].get_time()
+                except Exception as e:
+                    logger.warning(f"Keepalive fallido con el equipo {ip}: {str(e)}")
+                    self._cerrar(ip, sesion)
+                finally:
+                    sesion['lock'].release()
+
+    def cerrar_todas(self):
+        self._detener.set()
+        with self._lock:
+            sesiones = list(self._sesiones.items())
+        for ip, sesion in sesiones:
+            with sesion['lock']:
+                self._cerrar(ip, sesion)
+
+    def descripcion(self):
+        abiertas = sum(1 for sesion in list(self._sesiones.values()) if sesion['conn'] is not None)
+        return (f"Equipos: {abiertas} sesiones abiertas, {self.conexiones} conexiones, "
+                f"{self.reutilizadas} reutilizadas, {self.reconexiones} reconexiones")
+
+GESTOR_SESIONES = GestorSesiones(
+    persistente=SYNC_CONFIG.get('sesiones_persistentes', True),
+    intervalo_keepalive=int(SYNC_CONFIG.get('keepalive_segundos', 60)),
+    inactividad_max=int(SYNC_CONFIG.get('sesion_inactiva_max_segundos', 7200))
+)
+
+class PoolConexionesBD:
+    """Pool de conexiones a MySQL compartido por la interfaz, el planificador y la sincronización.
+
+    Reutiliza conexiones abiertas en lugar de hacer el handshake completo en
+    cada consulta. Al entregar una conexión se verifica con ping; las que
+    pasan demasiado tiempo inactivas o superan su vida máxima se cierran.
+    Si todas están en uso, obtener() espera hasta que se libere una.
+    """
+    def __init__(self, tamano=4, inactividad_max=300, vida_max=3600, espera_max=30):
+        self.tamano = max(1, tamano)
+        self.inactividad_max = inactividad_max
+        self.vida_max = vida_max
+        self.espera_max = espera_max
+        self._condicion = threading.Condition()
+        self._libres = []  # (conexión, creada, último uso, generación)
+        self._en_uso = 0
+        self._generacion = 0
+        self.creadas = 0
+        self.reutilizadas = 0
+        self.descartadas = 0
+
+    def _vencida(self, creada, ultimo_uso, ahora):
+        return ahora - ultimo_uso > self.inactividad_max or ahora - creada > self.vida_max
+
+    def _cerrar(self, conn):
+        self.descartadas += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def obtener(self):
+        """Entrega una conexión libre y verificada, o abre una nueva si hay lugar"""
+        limite = time_module.monotonic() + self.espera_max
+        while True:
+            candidata = None
+            with self._condicion:
+                while True:
+                    ahora = time_module.monotonic()
+                    while self._libres:
+                        conn, creada, ultimo_uso, generacion = self._libres.pop()
+                        if generacion != self._generacion or self._vencida(creada, ultimo_uso, ahora):
+                            self._cerrar(conn)
+                            continue
+                        candidata = (conn, creada, generacion)
+                        break
+                    if candidata or self._en_uso + len(self._libres) < self.tamano:
+                        self._en_uso += 1
+                        generacion_actual = self._generacion
+                        break
+                    if ahora >= limite or not self._condicion.wait(limite - ahora):
+                        raise TimeoutError(f"No hay conexiones a BD disponibles (pool de {self.tamano})")
+
+            if candidata:
+                conn, creada, generacion = candidata
+                try:
+                    conn.ping(reconnect=False)
+                    self.reutilizadas += 1
+                    conn._pool_info = (creada, generacion)
+                    return conn
+                except Exception:
+                    self._cerrar(conn)
+                    with self._condicion:
+                        self._en_uso -= 1
+                    continue
+
+            try:
+                conn = pymysql.connect(**DB_CONFIG)
+            except Exception:
+                with self._condicion:
+                    self._en_uso -= 1
+                    self._condicion.notify()
+                raise
+            self.creadas += 1
+            conn._pool_info = (time_module.monotonic(), generacion_actual)
+            logger.info(f"Nueva conexión a BD abierta ({self.descripcion()})")
+            return conn
+
+    def devolver(self, conn, descartar=False):
+        """Devuelve una conexión al pool; se cierra si falló o si el pool fue reiniciado"""
+        creada, generacion = getattr(conn, '_pool_info', (0, -1))
+        with self._condicion:
+            self._en_uso -= 1
+            ahora = time_module.monotonic()
+            if descartar or generacion != self._generacion or ahora - creada > self.vida_max:
+                self._cerrar(conn)
+            else:
+                self._libres.append((conn, creada, ahora, generacion))
+            self._condicion.notify()
+
+    def reiniciar(self):
+        """Cierra las conexiones libres; las que están en uso se cierran al devolverse"""
+        with self._condicion:
+            self._generacion += 1
+            libres, self._libres = self._libres, []
+            for conn, _creada, _ultimo_uso, _generacion in libres:
+                self._cerrar(conn)
+        logger.info("Pool de conexiones a BD reiniciado")
+
+    def estadisticas(self):
+        with self._condicion:
+            return {
+                'tamano': self.tamano,
+                'en_uso': self._en_uso,
+                'libres': len(self._libres),
+                'creadas': self.creadas,
+                'reutilizadas': self.reutilizadas,
+                'descartadas': self.descartadas
+            }
+
+    def descripcion(self):
+        e = self.estadisticas()
+        return (f"BD: {e['en_uso']}/{e['tamano']} en uso, {e['libres']} libres, "
+                f"{e['creadas']} creadas, {e['reutilizadas']} reutilizadas")
+
+POOL_BD = PoolConexionesBD(
+    tamano=int(SYNC_CONFIG.get('pool_bd_tamano', 4)),
+    inactividad_max=int(SYNC_CONFIG.get('pool_bd_inactividad_segundos', 300)),
+    vida_max=int(SYNC_CONFIG.get('pool_bd_vida_segundos', 3600))
+)
+
+# Equipos escribiendo a la vez en la BD, entre todas las sincronizaciones en
+# curso (botón, planificador y servicio)
+LIMITE_BD = threading.BoundedSemaphore(max(1, int(SYNC_CONFIG.get('max_conexiones_bd', 2))))
+
+@contextmanager
+def conectar_db():
+    """Toma una conexión del pool; entrega None si no se pudo conectar"""
+    try:
+        conn = POOL_BD.obtener()
+    except Exception as e:
+        logger.error(f"Error conectando a la base de datos: {str(e)}", exc_info=True)
+        conn = None
+
+    if conn is None:
+        yield None
+        return
+
+    completado = False
+    try:
+        yield conn
+        completado = True
+    finally:
+        # Una conexión que quedó a mitad de una operación fallida no se reutiliza
+        POOL_BD.devolver(conn, descartar=not completado)
+
+# --- PROCESAMIENTO ---
+def ajustar_minutos(user_id, hora):
+    try:
+        if user_id != "6833216":
+            return hora
+        if hora < time(9, 10):
+            minutos = hora.minute
+            if time(8, 35) <= hora < time(8, 40):
+                minutos -= int(minutos * 0.12)
+            elif time(8, 40) <= hora < time(8, 45):
+                minutos -= int(minutos * 0.17)
+            elif hora >= time(8, 45):
+                minutos -= int(minutos * 0.20)
+            minutos = max(minutos, 0)
+            return time(hora.hour, minutos, hora.second)
+        return hora
+    except Exception as e:
+        logger.error(f"Error ajustando minutos para user_id {user_id}: {str(e)}", exc_info=True)
+        return hora
+
+def verificar_duplicado(cursor, id_equipo, user_id, fecha, hora):
+    try:
+        cursor.execute(
+            """
+            SELECT COUNT(*) as count FROM rh_asistencias 
+            WHERE id_equipo = %s AND user_id = %s AND fecha = %s AND hora = %s
+            """,
+            (id_equipo, user_id, fecha, hora)
+        )
+        result = cursor.fetchone()
+        return result['count'] > 0
+    except Exception as e:
+        logger.error(f"Error verificando duplicado para {user_id} en {fecha} {hora}: {str(e)}", exc_info=True)
+        return True
+
+def normalizar_hora(valor):
+    """pymysql devuelve las columnas TIME como timedelta; se convierten a time"""
+    if isinstance(valor, timedelta):
+        segundos = int(valor.total_seconds())
+        return time(segundos // 3600 % 24, segundos // 60 % 60, segundos % 60)
+    return valor
+
+def obtener_claves_existentes(cursor, id_equipo, fecha_desde, fecha_hasta):
+    """Obtiene en una sola consulta las marcaciones ya registradas de un equipo en un rango de fechas"""
+    cursor.execute(
+        """
+        SELECT user_id, fecha, hora FROM rh_asistencias
+        WHERE id_equipo = %s AND fecha BETWEEN %s AND %s
+        """,
+        (id_equipo, fecha_desde, fecha_hasta)
+    )
+    return {(str(fila['user_id']), fila['fecha'], normalizar_hora(fila['hora'])) for fila in cursor.fetchall()}
+
+# Se activa cuando rh_asistencias tiene la clave única (ver asegurar_clave_unica)
+CLAVE_UNICA_ASISTENCIAS = False
+NOMBRE_CLAVE_UNICA = 'uq_equipo_usuario_fecha_hora'
+
+SQL_INSERTAR_ASISTENCIAS = """
+    INSERT INTO rh_asistencias (id_equipo, user_id, fecha, hora, visible, created_at, updated_at)
+    VALUES {valores}
+"""
+VALORES_ASISTENCIA = "(%s, %s, %s, %s, 1, NOW(), NOW())"
+# Con la clave única un duplicado no falla: no cambia nada y devuelve 0 filas afectadas
+SQL_IGNORAR_DUPLICADO = "ON DUPLICATE KEY UPDATE id = id"
+
+def sql_insertar_asistencias(cantidad):
+    """Sentencia INSERT para la cantidad de filas indicada"""
+    sql = SQL_INSERTAR_ASISTENCIAS.format(valores=", ".join([VALORES_ASISTENCIA] * cantidad))
+    if CLAVE_UNICA_ASISTENCIAS:
+        sql += SQL_IGNORAR_DUPLICADO
+    return sql
+
+def modo_deduplicacion():
+    """Modo configurado; 'bd' requiere la clave única, si no existe se usa 'conjunto'"""
+    modo = SYNC_CONFIG.get('modo_deduplicacion', 'bd')
+    if modo == 'bd' and not CLAVE_UNICA_ASISTENCIAS:
+        return 'conjunto'
+    return modo
+
+def insertar_asistencias(db, id_equipo, filas):
+    """Inserta un lote de marcaciones con una sola sentencia dentro de una transacción.
+
+    Cada fila es (user_id, fecha, hora, hora_original); hora_original solo se
+    usa para el detalle. Con la clave única las duplicadas no se insertan y
+    las filas afectadas indican cuántas se insertaron, así que el lote se
+    confirma siempre; en un lote mixto no se sabe cuáles eran las nuevas. Si
+    la sentencia falla (un error que no es de duplicado) se revierte y se
+    inserta fila por fila para saber exactamente cuáles fallaron.
+    Devuelve (cantidad insertada, filas insertadas conocidas, duplicadas, errores).
+    """
+    if not filas:
+        return 0, [], 0, 0
+
+    try:
+        db.begin()
+        with db.cursor() as cursor:
+            afectadas = cursor.execute(
+                sql_insertar_asistencias(len(filas)),
+                [valor for fila in filas for valor in (id_equipo,) + tuple(fila[:3])]
+            )
+        db.commit()
+        if afectadas == len(filas):
+            return len(filas), list(filas), 0, 0
+        return afectadas, [], len(filas) - afectadas, 0
+    except Exception as e:
+        logger.warning(f"Falló el lote de {len(filas)} registros del equipo {id_equipo}, se inserta registro por registro: {str(e)}")
+        try:
+            db.rollback()
+        except Exception:
+            pass
+
+    insertadas = []
+    duplicadas = 0
+    errores = 0
+    with db.cursor() as cursor:
+        for fila in filas:
+            user_id, fecha, hora = fila[:3]
+            try:
+                if cursor.execute(sql_insertar_asistencias(1), (id_equipo, user_id, fecha, hora)):
+                    insertadas.append(fila)
+                else:
+                    duplicadas += 1
+            except Exception as e:
+                errores += 1
+                logger.error(
+                    f"Error procesando registro del equipo {id_equipo} - Usuario: {user_id}, Fecha: {fecha}, Hora: {hora}: {str(e)}", 
+                    exc_info=True
+                )
+    return len(insertadas), insertadas, duplicadas, errores
+
+def registrar_lote(db, id_equipo, filas, detalle, registros_detalle):
+    """Inserta un lote y acumula el resultado en el detalle del equipo"""
+    cantidad, insertadas, duplicadas, errores = insertar_asistencias(db, id_equipo, filas)
+    detalle['registros_insertados'] += cantidad
+    detalle['registros_duplicados'] += duplicadas
+    detalle['errores'] += errores
+    espacio = max(0, int(SYNC_CONFIG.get('detalle_registros_max', 1000)) - len(registros_detalle))
+    for user_id, fecha, hora, hora_original in insertadas[:espacio]:
+        registros_detalle.append({
+            'user_id': user_id,
+            'fecha': str(fecha),
+            'hora_original': str(hora_original),
+            'hora_ajustada': str(hora),
+            'equipo': id_equipo
+        })
+
+# Caché breve de las últimas sincronizaciones para no consultar la BD en cada refresco de la lista
+CACHE_SINCRONIZACIONES = {'datos': None, 'momento': 0.0}
+CACHE_SINCRONIZACIONES_LOCK = threading.Lock()
+
+def invalidar_cache_sincronizaciones():
+    with CACHE_SINCRONIZACIONES_LOCK:
+        CACHE_SINCRONIZACIONES['datos'] = None
+
+def obtener_ultimas_sincronizaciones():
+    """Última sincronización de todos los equipos en una sola consulta.
+
+    Devuelve {id_equipo: datetime}, o None si la BD no está disponible. El
+    resultado se reutiliza durante cache_estado_segundos.
+    """
+    vigencia = SYNC_CONFIG.get('cache_estado_segundos', 5)
+    with CACHE_SINCRONIZACIONES_LOCK:
+        datos = CACHE_SINCRONIZACIONES['datos']
+        if datos is not None and time_module.monotonic() - CACHE_SINCRONIZACIONES['momento'] < vigencia:
+            return datos
+
+    try:
+        with conectar_db() as db:
+            if not db:
+                return None
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id_equipo, ultima_sincronizacion FROM rh_sincronizaciones")
+                datos = {str(fila['id_equipo']): fila['ultima_sincronizacion'] for fila in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Error obteniendo últimas sincronizaciones: {e}")
+        return None
+
+    with CACHE_SINCRONIZACIONES_LOCK:
+        CACHE_SINCRONIZACIONES['datos'] = datos
+        CACHE_SINCRONIZACIONES['momento'] = time_module.monotonic()
+    return datos
+
+def actualizar_ultima_sincronizacion(db, id_equipo):
+    try:
+        with db.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO rh_sincronizaciones (id_equipo, ultima_sincronizacion, created_at, updated_at)
+                VALUES (%s, NOW(), NOW(), NOW())
+                ON DUPLICATE KEY UPDATE ultima_sincronizacion=NOW(), updated_at=NOW()
+                """,
+                (id_equipo,)
+            )
+        invalidar_cache_sincronizaciones()
+        logger.info(f"Actualizada última sincronización para equipo {id_equipo}")
+    except Exception as e:
+        logger.error(f"Error actualizando última sincronización para equipo {id_equipo}: {str(e)}", exc_info=True)
+
+class ResultadoSincronizacion:
+    """Clase para almacenar resultados de sincronización"""
+    def __init__(self):
+        self.exitoso = False
+        self.total_equipos = 0
+        self.equipos_procesados = 0
+        self.registros_insertados = 0
+        self.registros_duplicados = 0
+        self.errores = 0
+        self.detalle_equipos = []
+        self.detalle_registros = []
+        self.mensaje = ""
+        self.timestamp = datetime.now()
+        self.duracion = 0.0
+
+class MedicionEquipo:
+    """Tiempos por fase, bytes recibidos y sentencias a la BD de la sincronización de un equipo.
+
+    Una fase medida dentro de otra se descuenta de la de afuera, así la suma
+    de las fases no cuenta dos veces el mismo tiempo.
+    """
+    # Fases que mide el propio cliente ZK (ZK.timings)
+    FASES_ZK = {'read_sizes': 'tamanos', 'users': 'usuarios', 'transfer': 'transferencia', 'parse': 'decodificacion'}
+
+    def __init__(self):
+        self.inicio = datetime.now()
+        self._comienzo = time_module.perf_counter()
+        self._abiertas = []
+        self.duracion = 0.0
+        self.fases = {}
+        self.bytes_recibidos = 0
+        self.sentencias_bd = 0
+
+    @contextmanager
+    def medir(self, fase):
+        comienzo = time_module.perf_counter()
+        self._abiertas.append(0.0)
+        try:
+            yield
+        finally:
+            duracion = time_module.perf_counter() - comienzo
+            self.sumar(fase, duracion - self._abiertas.pop())
+            if self._abiertas:
+                self._abiertas[-1] += duracion
+
+    def sumar(self, fase, segundos):
+        self.fases[fase] = self.fases.get(fase, 0.0) + segundos
+
+    def agregar_zk(self, tiempos, desde=None):
+        """Suma las fases del cliente ZK; con desde, las descuenta de esa fase que las contenía"""
+        for nombre, segundos in tiempos.items():
+            self.sumar(self.FASES_ZK.get(nombre, nombre), segundos)
+            if desde is not None:
+                self.sumar(desde, -segundos)
+
+    def como_dict(self):
+        self.duracion = time_module.perf_counter() - self._comienzo
+        return {
+            'inicio': self.inicio.strftime('%Y-%m-%d %H:%M:%S'),
+            'duracion': round(self.duracion, 3),
+            'fases': {fase: round(segundos, 3) for fase, segundos in self.fases.items()},
+            'bytes_recibidos': self.bytes_recibidos,
+            'sentencias_bd': self.sentencias_bd
+        }
+
+def iterar_medido(iterable, medicion, fase):
+    """Recorre iterable sumando a fase solo el tiempo de obtener cada elemento.
+
+    Al cerrarse (o al terminar) cierra también el iterador de origen.
+    """
+    iterador = iter(iterable)
+    try:
+        while True:
+            with medicion.medir(fase):
+                try:
+                    elemento = next(iterador)
+                except StopIteration:
+                    return
+            yield elemento
+    finally:
+        cerrar = getattr(iterador, 'close', None)
+        if cerrar:
+            cerrar()
+
+class CursorContado:
+    """Cursor que cuenta en la medición cada sentencia enviada a la BD"""
+    def __init__(self, cursor, medicion):
+        self._cursor = cursor
+        self._medicion = medicion
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+    def execute(self, *args, **kwargs):
+        self._medicion.sentencias_bd += 1
+        comienzo = time_module.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            metricas.registrar_latencia_bd(time_module.perf_counter() - comienzo)
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+class ConexionContada:
+    """Conexión del pool cuyos cursores cuentan las sentencias en la medición"""
+    def __init__(self, conn, medicion):
+        self._conn = conn
+        self._medicion = medicion
+
+    def cursor(self):
+        return CursorContado(self._conn.cursor(), self._medicion)
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+# Últimas mediciones de cada sincronización de equipo, la más reciente al final
+HISTORIAL_MEDICIONES = deque(maxlen=max(1, int(SYNC_CONFIG.get('historial_mediciones', 200))))
+HISTORIAL_MEDICIONES_LOCK = threading.Lock()
+
+def registrar_medicion(detalle, medicion):
+    """Agrega la medición al detalle del equipo, al log (una línea JSON) y al historial"""
+    detalle['medicion'] = medicion.como_dict()
+    registro = {
+        'equipo': detalle['equipo'],
+        'ip': detalle['ip'],
+        'estado': detalle['estado'],
+        'insertados': detalle['registros_insertados'],
+        'duplicados': detalle['registros_duplicados'],
+        'errores': detalle['errores'],
+        **detalle['medicion']
+    }
+    logger.info("Medición " + json.dumps(registro, ensure_ascii=False))
+    with HISTORIAL_MEDICIONES_LOCK:
+        HISTORIAL_MEDICIONES.append(registro)
+    metricas.registrar_sincronizacion(registro)
+
+def historial_mediciones(id_equipo=None):
+    """Copia del historial de mediciones, opcionalmente de un solo equipo"""
+    with HISTORIAL_MEDICIONES_LOCK:
+        registros = list(HISTORIAL_MEDICIONES)
+    if id_equipo is not None:
+        registros = [registro for registro in registros if registro['equipo'] == id_equipo]
+    return registros
+
+def describir_medicion(medicion):
+    """Resumen en una línea: duración, fases de mayor a menor, bytes y sentencias"""
+    fases = sorted(medicion['fases'].items(), key=lambda fase: fase[1], reverse=True)
+    partes = [f"{fase} {segundos:.2f}s" for fase, segundos in fases if segundos >= 0.005]
+    return (f"{medicion['duracion']:.2f}s ({', '.join(partes) or 'sin fases'}) | "
+            f"{medicion['bytes_recibidos'] / 1024:.0f} KB | {medicion['sentencias_bd']} sentencias BD")
+
+def descargar_equipo(bio, id_equipo, marca, medicion=None):
+    """Descarga las marcaciones posteriores a la marca con una conexión abierta.
+
+    marca es (registros ya leídos, último registro leído), ver marca_equipo.
+    El equipo queda deshabilitado solo mientras se descarga el buffer crudo;
+    las marcaciones se decodifican después, de a tamano_lote_insercion, al
+    recorrer los lotes (sin usar la conexión). Devuelve (lotes, marca nueva,
+    bytes reanudados del spool).
+    """
+    medicion = medicion or MedicionEquipo()
+    tamano_lote = max(1, int(SYNC_CONFIG.get('tamano_lote_insercion', 500)))
+    reanudados = bio.resumed_bytes
+    recibidos = bio.bytes_received
+    bio.timings.clear()
+    with medicion.medir('deshabilitar'):
+        bio.disable_device()
+    try:
+        lotes = bio.get_attendance_batches(*marca, batch_size=tamano_lote)
+    finally:
+        medicion.agregar_zk(bio.timings)
+        medicion.bytes_recibidos += bio.bytes_received - recibidos
+        try:
+            with medicion.medir('habilitar'):
+                bio.enable_device()
+        except Exception as e:
+            logger.warning(f"No se pudo habilitar el equipo {id_equipo}: {str(e)}")
+    return lotes, (bio.records, bio.last_record), bio.resumed_bytes - reanudados
+
+def registrar_en_flujo(bio, id_equipo, marca, limite_bd, detalle, registros_detalle, medicion=None):
+    """Descarga y registra las marcaciones posteriores a la marca a medida que llegan.
+
+    Solo se mantienen en memoria los bloques en vuelo y un lote de
+    tamano_lote_insercion marcaciones, sin importar el tamaño del log. El
+    equipo queda deshabilitado hasta terminar de escribir en la BD.
+    Si la conexión se corta después de registrar marcaciones se lanza
+    DescargaInterrumpida, para que no se reintente en la misma sincronización.
+    Devuelve (marcaciones leídas, marca nueva), como descargar_equipo.
+    """
+    medicion = medicion or MedicionEquipo()
+    tamano_lote = max(1, int(SYNC_CONFIG.get('tamano_lote_insercion', 500)))
+    recibidos = bio.bytes_received
+    procesados = detalle['registros_insertados'] + detalle['registros_duplicados'] + detalle['errores']
+    bio.timings.clear()
+    with medicion.medir('deshabilitar'):
+        bio.disable_device()
+    lotes = iterar_medido(bio.iter_attendance(marca[0], batch_size=tamano_lote, last=marca[1]), medicion, 'descarga')
+    try:
+        leidos = registrar_marcaciones(id_equipo, lotes, limite_bd, detalle, registros_detalle, medicion)
+    except (ZKNetworkError, OSError) as e:
+        if detalle['registros_insertados'] + detalle['registros_duplicados'] + detalle['errores'] > procesados:
+            raise DescargaInterrumpida(str(e)) from e
+        raise
+    finally:
+        try:
+            lotes.close()
+        except Exception as e:
+            logger.warning(f"No se pudo liberar el buffer del equipo {id_equipo}: {str(e)}")
+        medicion.agregar_zk(bio.timings, desde='descarga')
+        medicion.bytes_recibidos += bio.bytes_received - recibidos
+        try:
+            with medicion.medir('habilitar'):
+                bio.enable_device()
+        except Exception as e:
+            logger.warning(f"No se pudo habilitar el equipo {id_equipo}: {str(e)}")
+    return leidos, (bio.records, bio.last_record)
+
+def registrar_marcaciones(id_equipo, lotes, limite_bd, detalle, registros_detalle, medicion=None):
+    """Registra en la BD las marcaciones de un equipo, recibidas en lotes
+    (listas de objetos Attendance, o un iterador de ellas).
+
+    Acumula insertados, duplicados y errores en detalle; si no hay conexión
+    a la BD deja el estado ERROR_BD. La escritura queda limitada por el
+    semáforo limite_bd para no abrir una conexión por cada equipo.
+    Devuelve la cantidad de marcaciones recibidas.
+    """
+    medicion = medicion or MedicionEquipo()
+    tamano_lote = max(1, int(SYNC_CONFIG.get('tamano_lote_insercion', 500)))
+    leidos = 0
+    comienzo = time_module.perf_counter()
+    with limite_bd:
+        with conectar_db() as db:
+            medicion.sumar('espera_bd', time_module.perf_counter() - comienzo)
+            if not db:
+                detalle.update(estado='ERROR_BD', errores=detalle['errores'] + 1)
+                logger.error(f"No se pudo conectar a la base de datos para el equipo {id_equipo}")
+                return leidos
+
+            db = ConexionContada(db, medicion)
+            modo = modo_deduplicacion()
+            with medicion.medir('deduplicacion'), db.cursor() as cursor:
+                for registros in lotes:
+                    leidos += len(registros)
+                    # Claves ya registradas en el rango del lote, para no consultar registro por registro
+                    claves_existentes = None
+                    if registros and modo == 'conjunto':
+                        fechas = [r.timestamp.date() for r in registros]
+                        try:
+                            claves_existentes = obtener_claves_existentes(cursor, id_equipo, min(fechas), max(fechas))
+                        except Exception as e:
+                            logger.error(f"Error obteniendo registros existentes del equipo {id_equipo}, se verificará registro por registro: {str(e)}", exc_info=True)
+
+                    claves_procesadas = set()
+                    pendientes = []
+                    for r in registros:
+                        try:
+                            user_id = str(r.user_id)
+                            fecha = r.timestamp.date()
+                            hora_original = r.timestamp.time()
+                            hora = ajustar_minutos(user_id, hora_original)
+
+                            clave = (user_id, fecha, hora)
+                            if clave in claves_procesadas:
+                                duplicado = True
+                            elif claves_existentes is not None:
+                                duplicado = clave in claves_existentes
+                            elif modo == 'consulta':
+                                duplicado = verificar_duplicado(cursor, id_equipo, user_id, fecha, hora)
+                            else:
+                                duplicado = False  # lo resuelve la clave única al insertar
+                            if duplicado:
+                                detalle['registros_duplicados'] += 1
+                                continue
+
+                            claves_procesadas.add(clave)
+                            pendientes.append((user_id, fecha, hora, hora_original))
+
+                        except Exception as e:
+                            detalle['errores'] += 1
+                            logger.error(
+                                f"Error procesando registro del equipo {id_equipo} - Usuario: {user_id}, Fecha: {fecha}, Hora: {hora}: {str(e)}", 
+                                exc_info=True
+                            )
+
+                        if len(pendientes) >= tamano_lote:
+                            with medicion.medir('insercion'):
+                                registrar_lote(db, id_equipo, pendientes, detalle, registros_detalle)
+                            pendientes = []
+
+                    with medicion.medir('insercion'):
+                        registrar_lote(db, id_equipo, pendientes, detalle, registros_detalle)
+
+            with medicion.medir('marca'):
+                actualizar_ultima_sincronizacion(db, id_equipo)
+    return leidos
+
+# Equipos con una sincronización en curso (botón, planificador o servicio)
+EQUIPOS_EN_CURSO = set()
+EQUIPOS_EN_CURSO_LOCK = threading.Lock()
+
+def equipo_en_curso(id_equipo):
+    with EQUIPOS_EN_CURSO_LOCK:
+        return id_equipo in EQUIPOS_EN_CURSO
+
+def procesar_equipo_exclusivo(id_equipo, ip, marcas, limite_bd):
+    """procesar_equipo, salvo que el equipo ya se esté sincronizando"""
+    with EQUIPOS_EN_CURSO_LOCK:
+        en_curso = id_equipo in EQUIPOS_EN_CURSO
+        EQUIPOS_EN_CURSO.add(id_equipo)
+    if en_curso:
+        logger.warning(f"Equipo {id_equipo} omitido: la sincronización anterior sigue en curso")
+        detalle = {
+            'equipo': id_equipo,
+            'ip': ip,
+            'estado': 'OMITIDO_EN_CURSO',
+            'registros_insertados': 0,
+            'registros_duplicados': 0,
+            'errores': 0
+        }
+        return detalle, []
+    try:
+        return procesar_equipo(id_equipo, ip, marcas, limite_bd)
+    finally:
+        with EQUIPOS_EN_CURSO_LOCK:
+            EQUIPOS_EN_CURSO.discard(id_equipo)
+
+def procesar_equipo(id_equipo, ip, marcas, limite_bd):
+    """Descarga las marcaciones de un equipo y las registra en la BD.
+
+    Devuelve el detalle del equipo (mismo formato que detalle_equipos, con
+    la medición de tiempos en 'medicion') y la lista de registros insertados.
+    """
+    detalle = {
+        'equipo': id_equipo,
+        'ip': ip,
+        'estado': 'COMPLETADO',
+        'registros_insertados': 0,
+        'registros_duplicados': 0,
+        'errores': 0
+    }
+    medicion = MedicionEquipo()
+    try:
+        return sincronizar_equipo(id_equipo, ip, marcas, limite_bd, detalle, medicion)
+    finally:
+        registrar_medicion(detalle, medicion)
+
+def sincronizar_equipo(id_equipo, ip, marcas, limite_bd, detalle, medicion):
+    """Cuerpo de procesar_equipo; completa detalle y mide cada fase en medicion"""
+    registros_detalle = []
+    logger.info(f"Procesando equipo {id_equipo} ({ip})")
+
+    marca = marca_equipo(marcas, id_equipo)
+
+    if SYNC_CONFIG.get('descarga_en_flujo', False):
+        # Se espera el turno de la BD antes de conectar, para no tener el
+        # equipo deshabilitado mientras tanto
+        comienzo = time_module.perf_counter()
+        try:
+            with limite_bd:
+                medicion.sumar('espera_bd', time_module.perf_counter() - comienzo)
+                leidos, marca_nueva = GESTOR_SESIONES.ejecutar(
+                    ip, lambda bio: registrar_en_flujo(bio, id_equipo, marca, nullcontext(), detalle,
+                                                       registros_detalle, medicion), medicion)
+            logger.info(f"Obtenidos {leidos} registros nuevos del equipo {id_equipo} (marca: {marca[0]})")
+        except ErrorConexionEquipo as e:
+            detalle.update(estado='ERROR_CONEXION', errores=1)
+            logger.error(f"No se pudo conectar al equipo {id_equipo}: {str(e)}")
+            return detalle, registros_detalle
+        except (ZKError, OSError, DescargaInterrumpida) as e:
+            # Lo ya insertado queda en la BD; la marca no avanza y se reintenta el resto
+            detalle.update(estado='ERROR_LECTURA', errores=detalle['errores'] + 1)
+            logger.error(f"Error obteniendo registros del equipo {id_equipo}: {str(e)}", exc_info=True)
+            return detalle, registros_detalle
+    else:
+        # Descarga: el equipo se libera antes de decodificar y escribir en la BD
+        try:
+            lotes, marca_nueva, reanudados = GESTOR_SESIONES.ejecutar(
+                ip, lambda bio: descargar_equipo(bio, id_equipo, marca, medicion), medicion)
+            if reanudados:
+                logger.info(f"Descarga reanudada en el equipo {id_equipo}: {reanudados} bytes recuperados del spool")
+        except ErrorConexionEquipo as e:
+            detalle.update(estado='ERROR_CONEXION', errores=1)
+            logger.error(f"No se pudo conectar al equipo {id_equipo}: {str(e)}")
+            return detalle, registros_detalle
+        except Exception as e:
+            detalle.update(estado='ERROR_LECTURA', errores=1)
+            logger.error(f"Error obteniendo registros del equipo {id_equipo}: {str(e)}", exc_info=True)
+            return detalle, registros_detalle
+
+        leidos = registrar_marcaciones(id_equipo, iterar_medido(lotes, medicion, 'decodificacion'),
+                                       limite_bd, detalle, registros_detalle, medicion)
+        logger.info(f"Obtenidos {leidos} registros nuevos del equipo {id_equipo} (marca: {marca[0]})")
+
+    if detalle['estado'] == 'ERROR_BD':
+        return detalle, registros_detalle
+
+    # Solo se avanza la marca si no hubo errores, para reintentar lo fallido
+    if marcas is not None and detalle['errores'] == 0:
+        with medicion.medir('marca'), MARCAS_LOCK:
+            guardar_marca(marcas, id_equipo, *marca_nueva)
+
+    logger.info(
+        f"Resumen equipo {id_equipo}:\n"
+        f"Registros insertados: {detalle['registros_insertados']}\n"
+        f"Registros duplicados: {detalle['registros_duplicados']}\n"
+        f"Errores: {detalle['errores']}"
+    )
+    return detalle, registros_detalle
+
+def extraer_datos(ids_equipos=None):
+    """Función principal de extracción de datos con resultados detallados.
+
+    ids_equipos limita la sincronización a esos equipos (por defecto, todos).
+    """
+    resultado = ResultadoSincronizacion()
+    comienzo = time_module.perf_counter()
+    
+    try:
+        logger.info("Iniciando proceso de extracción de datos")
+        equipos = seleccionar_equipos(ids_equipos)
+        if equipos is None:
+            resultado.mensaje = "Hay equipos solicitados que no están configurados"
+            return resultado
+        incremental = SYNC_CONFIG.get('sincronizacion_incremental', True)
+        marcas = cargar_marcas() if incremental else None
+        resultado.total_equipos = len(equipos)
+        
+        if not equipos:
+            resultado.mensaje = "No hay equipos configurados para sincronizar"
+            logger.warning(resultado.mensaje)
+            return resultado
+
+        with conectar_db() as db:
+            if not db:
+                resultado.mensaje = "No se pudo conectar a la base de datos"
+                logger.error(resultado.mensaje)
+                return resultado
+            if not CLAVE_UNICA_ASISTENCIAS:
+                with db.cursor() as cursor:
+                    verificar_clave_unica(cursor)
+
+        # Los equipos se procesan en paralelo; la BD admite pocas conexiones simultáneas
+        max_paralelos = max(1, int(SYNC_CONFIG.get('max_equipos_paralelos', 4)))
+        limite_bd = LIMITE_BD
+
+        with ThreadPoolExecutor(max_workers=min(max_paralelos, len(equipos)), thread_name_prefix='sync') as executor:
+            futuros = [
+                (id_equipo, ip, executor.submit(procesar_equipo_exclusivo, id_equipo, ip, marcas, limite_bd))
+                for id_equipo, ip in equipos.items()
+            ]
+
+            # Se combinan en el orden de equipos.json, igual que en el proceso secuencial
+            for id_equipo, ip, futuro in futuros:
+                resultado.equipos_procesados += 1
+                try:
+                    detalle, registros_detalle = futuro.result()
+                except Exception as e:
+                    logger.error(f"Error inesperado procesando equipo {id_equipo}: {str(e)}", exc_info=True)
+                    detalle = {
+                        'equipo': id_equipo,
+                        'ip': ip,
+                        'estado': 'ERROR',
+                        'registros_insertados': 0,
+                        'registros_duplicados': 0,
+                        'errores': 1
+                    }
+                    registros_detalle = []
+
+                resultado.registros_insertados += detalle['registros_insertados']
+                resultado.registros_duplicados += detalle['registros_duplicados']
+                resultado.errores += detalle['errores']
+                resultado.detalle_equipos.append(detalle)
+                espacio = max(0, int(SYNC_CONFIG.get('detalle_registros_max', 1000)) - len(resultado.detalle_registros))
+                resultado.detalle_registros.extend(registros_detalle[:espacio])
+
+        resultado.exitoso = True
+        resultado.mensaje = "Sincronización completada exitosamente"
+        resultado.duracion = time_module.perf_counter() - comienzo
+        logger.info(f"Proceso completado en {resultado.duracion:.1f}s: {resultado.registros_insertados} registros insertados, {resultado.registros_duplicados} duplicados, {resultado.errores} errores")
+        logger.info(f"Pool de conexiones: {POOL_BD.descripcion()}")
+        logger.info(f"Sesiones con equipos: {GESTOR_SESIONES.descripcion()}")
+        
+    except Exception as e:
+        resultado.exitoso = False
+        resultado.mensaje = f"Error en sincronización: {str(e)}"
+        logger.error(f"Error en proceso de extracción: {str(e)}", exc_info=True)
+    
+    return resultado
+
+# --- CAPTURA EN TIEMPO REAL ---
+
+class EscritorTiempoReal:
+    """Escribe en la BD las marcaciones recibidas en vivo, en micro-lotes.
+
+    Los hilos de captura solo encolan; un único hilo agrupa las marcaciones
+    por equipo y las registra cuando se junta un lote o vence el intervalo.
+    Si la BD no está disponible, el lote se conserva y se reintenta.
+    """
+    def __init__(self, tamano_lote=100, intervalo=2.0):
+        self.tamano_lote = max(1, tamano_lote)
+        self.intervalo = intervalo
+        self._cola = queue.Queue()
+        self._detener = threading.Event()
+        self.limite_bd = threading.BoundedSemaphore(1)
+        self._hilo = threading.Thread(target=self._ejecutar, name='escritor-tiempo-real', daemon=True)
+        self.insertados = 0
+        self.duplicados = 0
+        self.errores = 0
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def agregar(self, id_equipo, asistencia):
+        self._cola.put((id_equipo, asistencia))
+
+    def detener(self):
+        """Escribe lo pendiente y termina el hilo"""
+        self._detener.set()
+        self._hilo.join()
+
+    def _ejecutar(self):
+        pendientes = {}
+        cantidad = 0
+        primero = None
+        while True:
+            espera = self.intervalo if primero is None else max(0, primero + self.intervalo - time_module.monotonic())
+            try:
+                id_equipo, asistencia = self._cola.get(timeout=min(espera, 0.5))
+                pendientes.setdefault(id_equipo, []).append(asistencia)
+                cantidad += 1
+                if primero is None:
+                    primero = time_module.monotonic()
+            except queue.Empty:
+                pass
+            vencido = primero is not None and time_module.monotonic() - primero >= self.intervalo
+            terminar = self._detener.is_set() and self._cola.empty()
+            if cantidad and (cantidad >= self.tamano_lote or vencido or terminar):
+                pendientes = self._escribir(pendientes)
+                cantidad = sum(len(registros) for registros in pendientes.values())
+                primero = time_module.monotonic() if cantidad else None
+            if terminar:
+                if cantidad:
+                    logger.error(f"Tiempo real: {cantidad} marcaciones sin registrar al detener")
+                return
+
+    def _escribir(self, pendientes):
+        """Registra los pendientes; devuelve los que quedan para reintentar"""
+        restantes = {}
+        for id_equipo, registros in pendientes.items():
+            detalle = {'estado': 'COMPLETADO', 'registros_insertados': 0, 'registros_duplicados': 0, 'errores': 0}
+            registrar_marcaciones(id_equipo, [registros], self.limite_bd, detalle, [])
+            if detalle['estado'] == 'ERROR_BD':
+                restantes[id_equipo] = registros
+                continue
+            self.insertados += detalle['registros_insertados']
+            self.duplicados += detalle['registros_duplicados']
+            self.errores += detalle['errores']
+            metricas.registrar_insercion(id_equipo, detalle['registros_insertados'],
+                                         detalle['registros_duplicados'], detalle['errores'])
+            logger.info(f"Tiempo real {id_equipo}: {detalle['registros_insertados']} insertadas, "
+                        f"{detalle['registros_duplicados']} duplicadas, {detalle['errores']} errores")
+        return restantes
+
+class CapturaEquipo:
+    """Escucha los eventos de marcación de un equipo con live_capture.
+
+    Al conectar (y en cada reconexión) primero descarga en bloque lo marcado
+    desde la última marca de sincronización, para no perder lo ocurrido
+    mientras no había conexión; después encola cada evento en el escritor.
+    Lo marcado entre ese relleno y el registro de eventos no llega como
+    evento: una vez registrados se repite el relleno por otra conexión, y el
+    escritor descarta como duplicado lo que llegue por los dos caminos.
+    """
+    def __init__(self, id_equipo, ip, escritor, reintento=30, espera_evento=10):
+        self.id_equipo = id_equipo
+        self.ip = ip
+        self.escritor = escritor
+        self.reintento = reintento
+        self.espera_evento = espera_evento
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name=f'captura-{id_equipo}', daemon=True)
+        self.eventos = 0
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def esperar(self):
+        self._hilo.join()
+
+    def _rellenar(self, bio):
+        """Descarga y registra lo marcado desde la última marca"""
+        with MARCAS_LOCK:
+            marca = marca_equipo(cargar_marcas(), self.id_equipo)
+        detalle = {'estado': 'COMPLETADO', 'registros_insertados': 0, 'registros_duplicados': 0, 'errores': 0}
+        if SYNC_CONFIG.get('descarga_en_flujo', False):
+            with self.escritor.limite_bd:
+                leidos, marca_nueva = registrar_en_flujo(
+                    bio, self.id_equipo, marca, nullcontext(), detalle, [])
+        else:
+            lotes, marca_nueva, _reanudados = descargar_equipo(bio, self.id_equipo, marca)
+            leidos = registrar_marcaciones(self.id_equipo, lotes, self.escritor.limite_bd, detalle, [])
+        if detalle['estado'] == 'COMPLETADO' and detalle['errores'] == 0:
+            with MARCAS_LOCK:
+                guardar_marca(cargar_marcas(), self.id_equipo, *marca_nueva)
+        logger.info(f"Tiempo real {self.id_equipo}: recuperadas {leidos} marcaciones "
+                    f"({detalle['registros_insertados']} insertadas, estado {detalle['estado']})")
+
+    def _cerrar_hueco(self, bio):
+        """Repite el relleno por otra conexión, con los eventos ya registrados en bio.
+
+        No se usa la conexión de bio porque sus respuestas se mezclarían con
+        los eventos. Si falla, corta la captura para que la reconexión
+        vuelva a rellenar.
+        """
+        otro = None
+        try:
+            otro = crear_zk(self.ip).connect()
+            self._rellenar(otro)
+        except Exception as e:
+            logger.error(f"Tiempo real: no se pudo completar el relleno del equipo {self.id_equipo}, se reconectará: {str(e)}")
+            bio.end_live_capture = True
+        finally:
+            if otro:
+                try:
+                    otro.disconnect()
+                except Exception:
+                    pass
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            bio = None
+            hueco = None
+            try:
+                bio = crear_zk(self.ip).connect()
+                logger.info(f"Tiempo real: conectado al equipo {self.id_equipo} ({self.ip})")
+                self._rellenar(bio)
+                for asistencia in bio.live_capture(new_timeout=self.espera_evento):
+                    if hueco is None:
+                        # live_capture ya envió reg_event: se rellena lo marcado mientras tanto
+                        hueco = threading.Thread(target=self._cerrar_hueco, args=(bio,),
+                                                 name=f'relleno-{self.id_equipo}', daemon=True)
+                        hueco.start()
+                    if self._detener.is_set():
+                        bio.end_live_capture = True
+                    if asistencia is None:
+                        continue
+                    self.eventos += 1
+                    self.escritor.agregar(self.id_equipo, asistencia)
+            except Exception as e:
+                logger.error(f"Tiempo real: error con el equipo {self.id_equipo} ({self.ip}): {str(e)}")
+            finally:
+                if hueco:
+                    hueco.join()
+                if bio:
+                    try:
+                        bio.disconnect()
+                    except Exception:
+                        pass
+            if self._detener.wait(self.reintento):
+                break
+
+def ejecutar_tiempo_real(ids_equipos=None):
+    """Servicio sin interfaz: captura en vivo de los equipos configurados"""
+    inicializar_bd()
+    equipos = seleccionar_equipos(ids_equipos)
+    if equipos is None:
+        return SALIDA_CONFIGURACION
+    if not equipos:
+        logger.error("No hay equipos configurados para la captura en tiempo real")
+        return SALIDA_CONFIGURACION
+
+    escritor = EscritorTiempoReal(
+        tamano_lote=int(SYNC_CONFIG.get('tiempo_real_lote', 100)),
+        intervalo=float(SYNC_CONFIG.get('tiempo_real_intervalo_segundos', 2))
+    )
+    servidor_metricas = iniciar_metricas()
+    escritor.iniciar()
+    capturas = [CapturaEquipo(id_equipo, ip, escritor, reintento=int(SYNC_CONFIG.get('tiempo_real_reintento_segundos', 30)))
+                for id_equipo, ip in equipos.items()]
+    for captura in capturas:
+        captura.iniciar()
+    logger.info(f"Captura en tiempo real iniciada para {len(capturas)} equipos")
+
+    esperar_senal_detener()
+
+    logger.info("Deteniendo la captura en tiempo real")
+    for captura in capturas:
+        captura.detener()
+    for captura in capturas:
+        captura.esperar()
+    escritor.detener()
+    logger.info(f"Captura en tiempo real detenida: {escritor.insertados} insertadas, "
+                f"{escritor.duplicados} duplicadas, {escritor.errores} errores")
+    if servidor_metricas:
+        servidor_metricas.detener()
+    return SALIDA_OK
+
+# --- JOBS PROGRAMADOS ---
+FORMATO_TURNO = '%Y-%m-%d %H:%M:%S'
+
+class PlanificadorSincronizacion:
+    """Dispara las sincronizaciones programadas de cada equipo.
+
+    Cada equipo tiene su próximo turno (una de horas_sincronizacion, o cada
+    intervalos_equipos minutos) más una demora aleatoria. El hilo del
+    planificador duerme hasta el vencimiento más cercano y entrega los
+    equipos vencidos a un pool de trabajadores, sin esperar a que terminen.
+    El último turno ejecutado de cada equipo se guarda en PLANIFICADOR_FILE
+    para recuperar al iniciar los turnos perdidos.
+    """
+    ESPERA_MAXIMA = 300  # relee el reloj al menos cada 5 minutos (cambios de hora)
+
+    def __init__(self, ids_equipos=None):
+        self.ids_equipos = ids_equipos
+        self._condicion = threading.Condition()
+        self._estado_lock = threading.Lock()
+        self._programados = {}  # id_equipo -> (turno, vencimiento con demora)
+        self._detenido = False
+        self._hilo = None
+        self._ejecutor = None
+
+    def iniciar(self):
+        self._ejecutor = ThreadPoolExecutor(
+            max_workers=max(1, int(SYNC_CONFIG.get('planificador_trabajadores', 2))),
+            thread_name_prefix='planificado')
+        with self._condicion:
+            self._programados = self._calcular_programa(
+                recuperar=SYNC_CONFIG.get('recuperar_sincronizaciones_perdidas', True))
+        self._hilo = threading.Thread(target=self._ejecutar, name='planificador', daemon=True)
+        self._hilo.start()
+
+    def detener(self, esperar=True):
+        """Deja de programar; con esperar, también aguarda las sincronizaciones en curso"""
+        with self._condicion:
+            self._detenido = True
+            self._condicion.notify_all()
+        if self._hilo:
+            self._hilo.join()
+        if self._ejecutor:
+            self._ejecutor.shutdown(wait=esperar)
+
+    def reprogramar(self):
+        """Recalcula los turnos tras cambiar horas, intervalos o equipos (seguro desde cualquier hilo)"""
+        with self._condicion:
+            ahora = datetime.now()
+            programados = self._calcular_programa(recuperar=False)
+            # Los turnos ya alcanzados que esperan su demora se conservan
+            for id_equipo, (turno, vence) in self._programados.items():
+                if id_equipo in programados and turno <= ahora:
+                    programados[id_equipo] = (turno, vence)
+            self._programados = programados
+            self._condicion.notify_all()
+
+    def proximas(self):
+        """{id_equipo: vencimiento} de los turnos programados"""
+        with self._condicion:
+            return {id_equipo: vence for id_equipo, (_turno, vence) in self._programados.items()}
+
+    def _horas(self):
+        horas = set()
+        for hora in SYNC_CONFIG.get('horas_sincronizacion', []):
+            try:
+                horas.add(datetime.strptime(hora, "%H:%M").time())
+            except (TypeError, ValueError) as e:
+                logger.error(f"Error programando hora {hora}: {e}")
+        return sorted(horas)
+
+    def _turnos_del_dia(self, id_equipo, dia, horas):
+        intervalo = SYNC_CONFIG.get('intervalos_equipos', {}).get(id_equipo)
+        if intervalo:
+            inicio = datetime.combine(dia, time())
+            return [inicio + timedelta(minutes=minuto) for minuto in range(0, 24 * 60, max(1, int(intervalo)))]
+        return [datetime.combine(dia, hora) for hora in horas]
+
+    def siguiente_turno(self, id_equipo, momento, horas=None):
+        """Primer turno del equipo posterior a momento (None si no tiene turnos)"""
+        horas = self._horas() if horas is None else horas
+        for dia in (momento.date(), momento.date() + timedelta(days=1)):
+            for turno in self._turnos_del_dia(id_equipo, dia, horas):
+                if turno > momento:
+                    return turno
+        return None
+
+    def ultimo_turno(self, id_equipo, momento, horas=None):
+        """Último turno del equipo hasta momento (None si no tiene turnos)"""
+        horas = self._horas() if horas is None else horas
+        for dia in (momento.date(), momento.date() - timedelta(days=1)):
+            for turno in reversed(self._turnos_del_dia(id_equipo, dia, horas)):
+                if turno <= momento:
+                    return turno
+        return None
+
+    def _demora(self):
+        return timedelta(seconds=random.uniform(0, max(0, float(SYNC_CONFIG.get('jitter_sincronizacion_segundos', 0)))))
+
+    def _calcular_programa(self, recuperar):
+        equipos = seleccionar_equipos(self.ids_equipos) or {}
+        horas = self._horas()
+        ahora = datetime.now()
+        ejecutados = cargar_config_archivo(PLANIFICADOR_FILE, {}) if recuperar else {}
+        programados = {}
+        for id_equipo in equipos:
+            anterior = self.ultimo_turno(id_equipo, ahora, horas)
+            ejecutado = ejecutados.get(id_equipo)
+            if anterior and ejecutado and ejecutado < anterior.strftime(FORMATO_TURNO):
+                logger.info(f"Recuperando la sincronización de {anterior:%Y-%m-%d %H:%M} del equipo {id_equipo}")
+                programados[id_equipo] = (anterior, ahora + self._demora())
+                continue
+            turno = self.siguiente_turno(id_equipo, ahora, horas)
+            if turno:
+                programados[id_equipo] = (turno, turno + self._demora())
+        if programados:
+            proximo = min(vence for _turno, vence in programados.values())
+            logger.info(f"Planificador: {len(programados)} equipos programados, próximo a las {proximo:%H:%M:%S}")
+        else:
+            logger.warning("Planificador: no hay equipos ni horas de sincronización programadas")
+        return programados
+
+    def _ejecutar(self):
+        with self._condicion:
+            while not self._detenido:
+                ahora = datetime.now()
+                vencidos = [id_equipo for id_equipo, (_turno, vence) in self._programados.items() if vence <= ahora]
+                if not vencidos:
+                    espera = self.ESPERA_MAXIMA
+                    if self._programados:
+                        proximo = min(vence for _turno, vence in self._programados.values())
+                        espera = min(espera, (proximo - ahora).total_seconds())
+                    self._condicion.wait(max(0.0, espera))
+                    continue
+
+                horas = self._horas()
+                lote = {}
+                vencimientos = {}
+                for id_equipo in vencidos:
+                    turno, vence = self._programados.pop(id_equipo)
+                    siguiente = self.siguiente_turno(id_equipo, max(turno, ahora), horas)
+                    if siguiente:
+                        self._programados[id_equipo] = (siguiente, siguiente + self._demora())
+                    if equipo_en_curso(id_equipo):
+                        logger.warning(f"Turno de {turno:%H:%M} del equipo {id_equipo} omitido: la sincronización anterior sigue en curso")
+                        continue
+                    lote[id_equipo] = turno
+                    vencimientos[id_equipo] = vence
+                if lote:
+                    self._ejecutor.submit(self._sincronizar, lote, vencimientos)
+
+    def _sincronizar(self, lote, vencimientos=None):
+        """Sincroniza los equipos del lote y registra el turno de los que se completaron.
+
+        Los que fallaron (equipo apagado, error de BD) no se registran, así
+        al iniciar se recupera su turno.
+        """
+        # Retraso respecto del vencimiento: hilo dormido de más o trabajadores ocupados
+        ahora = datetime.now()
+        for vence in (vencimientos or {}).values():
+            metricas.registrar_retraso_planificador((ahora - vence).total_seconds())
+        try:
+            resultado = extraer_datos(list(lote))
+        except Exception as e:
+            logger.error(f"Error en sincronización programada: {e}", exc_info=True)
+            return
+        procesados = [detalle['equipo'] for detalle in resultado.detalle_equipos
+                      if detalle['estado'] == 'COMPLETADO']
+        if not procesados:
+            return
+        with self._estado_lock:
+            ejecutados = cargar_config_archivo(PLANIFICADOR_FILE, {})
+            for id_equipo in procesados:
+                ejecutados[id_equipo] = lote[id_equipo].strftime(FORMATO_TURNO)
+            guardar_config_archivo(PLANIFICADOR_FILE, ejecutados)
+
+# --- INICIALIZACIÓN DE BD ---
+def verificar_clave_unica(cursor):
+    """Consulta si rh_asistencias ya tiene la clave única y actualiza CLAVE_UNICA_ASISTENCIAS"""
+    global CLAVE_UNICA_ASISTENCIAS
+    try:
+        cursor.execute("SHOW INDEX FROM rh_asistencias WHERE Key_name = %s", (NOMBRE_CLAVE_UNICA,))
+        CLAVE_UNICA_ASISTENCIAS = bool(cursor.fetchall())
+    except Exception as e:
+        logger.error(f"Error verificando la clave única de rh_asistencias: {e}", exc_info=True)
+        CLAVE_UNICA_ASISTENCIAS = False
+    return CLAVE_UNICA_ASISTENCIAS
+
+def asegurar_clave_unica(cursor):
+    """Migración: elimina marcaciones repetidas y agrega la clave única a rh_asistencias.
+
+    De cada grupo repetido se conserva la fila más antigua (menor id). El
+    índice anterior queda cubierto por la clave única y se elimina.
+    """
+    if verificar_clave_unica(cursor):
+        return True
+
+    logger.info("Agregando clave única a rh_asistencias")
+    try:
+        eliminadas = cursor.execute("""
+        DELETE duplicada FROM rh_asistencias duplicada
+        JOIN rh_asistencias original
+            ON duplicada.id_equipo = original.id_equipo
+            AND duplicada.user_id = original.user_id
+            AND duplicada.fecha = original.fecha
+            AND duplicada.hora = original.hora
+            AND duplicada.id > original.id
+        """)
+        logger.info(f"Eliminadas {eliminadas} marcaciones duplicadas de rh_asistencias")
+
+        cursor.execute(f"""
+        ALTER TABLE rh_asistencias
+        ADD UNIQUE KEY {NOMBRE_CLAVE_UNICA} (id_equipo, user_id, fecha, hora)
+        """)
+
+        cursor.execute("SHOW INDEX FROM rh_asistencias WHERE Key_name = 'idx_equipo_usuario_fecha_hora'")
+        if cursor.fetchall():
+            cursor.execute("ALTER TABLE rh_asistencias DROP INDEX idx_equipo_usuario_fecha_hora")
+    except Exception as e:
+        logger.error(f"Error agregando la clave única a rh_asistencias: {e}", exc_info=True)
+
+    return verificar_clave_unica(cursor)
+
+def inicializar_bd():
+    """Inicializar tablas de base de datos si no existen"""
+    try:
+        with conectar_db() as db:
+            if db:
+                with db.cursor() as cursor:
+                    # Tabla de sincronizaciones
+                    cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS rh_sincronizaciones (
+                        id_equipo VARCHAR(50) PRIMARY KEY,
+                        ultima_sincronizacion DATETIME,
+                        created_at DATETIME,
+                        updated_at DATETIME
+                    )
+                    """)
+                    
+                    # Tabla de asistencias
+                    cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS rh_asistencias (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        id_equipo VARCHAR(50),
+                        user_id VARCHAR(50),
+                        fecha DATE,
+                        hora TIME,
+                        visible BOOLEAN DEFAULT 1,
+                        created_at DATETIME,
+                        updated_at DATETIME,
+                        UNIQUE KEY uq_equipo_usuario_fecha_hora (id_equipo, user_id, fecha, hora)
+                    )
+                    """)
+
+                    # Tablas creadas con versiones anteriores solo tienen un índice no único
+                    asegurar_clave_unica(cursor)
+                    
+                    db.commit()
+                    logger.info("Tablas de base de datos verificadas/creadas")
+    except Exception as e:
+        logger.error(f"Error inicializando base de datos: {e}", exc_info=True)
+
+# --- MODO SIN INTERFAZ ---
+SALIDA_OK = 0
+SALIDA_ERROR = 1
+SALIDA_CONFIGURACION = 2
+
+def esperar_senal_detener(detener=None):
+    """Bloquea hasta recibir SIGTERM o Ctrl+C (o hasta que se active detener)"""
+    detener = detener or threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: detener.set())
+    try:
+        while not detener.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+def iniciar_metricas():
+    """Inicia el endpoint de métricas si está habilitado; devuelve el servidor o None"""
+    if not SYNC_CONFIG.get('metricas_habilitadas', False):
+        return None
+    servidor = metricas.ServidorMetricas(
+        host=SYNC_CONFIG.get('metricas_host', '127.0.0.1'),
+        puerto=int(SYNC_CONFIG.get('metricas_puerto', 9108)))
+    try:
+        servidor.iniciar()
+    except OSError as e:
+        logger.error(f"No se pudo iniciar el endpoint de métricas en el puerto {servidor.puerto}: {e}")
+        return None
+    logger.info(f"Métricas disponibles en http://{servidor.host}:{servidor.puerto}/metrics")
+    return servidor
+
+def sincronizar_una_vez(ids_equipos=None):
+    """Una sincronización completa; devuelve el código de salida"""
+    inicializar_bd()
+    equipos = seleccionar_equipos(ids_equipos)
+    if not equipos:
+        if equipos is not None:
+            logger.error("No hay equipos configurados para sincronizar")
+        return SALIDA_CONFIGURACION
+    try:
+        resultado = extraer_datos(ids_equipos)
+    finally:
+        GESTOR_SESIONES.cerrar_todas()
+    if not resultado.exitoso:
+        logger.error(resultado.mensaje)
+        return SALIDA_ERROR
+    if resultado.errores:
+        return SALIDA_ERROR
+    return SALIDA_OK
+
+def ejecutar_servicio(ids_equipos=None):
+    """Sincronizaciones programadas en primer plano, hasta SIGTERM o Ctrl+C"""
+    inicializar_bd()
+    equipos = seleccionar_equipos(ids_equipos)
+    if not equipos:
+        if equipos is not None:
+            logger.error("No hay equipos configurados para sincronizar")
+        return SALIDA_CONFIGURACION
+
+    servidor_metricas = iniciar_metricas()
+    planificador = PlanificadorSincronizacion(ids_equipos)
+    planificador.iniciar()
+    logger.info(f"Servicio de sincronización iniciado para {len(equipos)} equipos")
+    esperar_senal_detener()
+
+    logger.info("Deteniendo el servicio de sincronización")
+    planificador.detener()
+    GESTOR_SESIONES.cerrar_todas()
+    if servidor_metricas:
+        servidor_metricas.detener()
+    return SALIDA_OK
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Sincronizador de marcaciones de equipos biométricos (sin interfaz)")
+    modo = parser.add_mutually_exclusive_group(required=True)
+    modo.add_argument('--sync-once', action='store_true', help="sincroniza una vez y termina")
+    modo.add_argument('--service', action='store_true', help="sincroniza en las horas de sync_config.json hasta recibir SIGTERM")
+    modo.add_argument('--tiempo-real', action='store_true', help="captura las marcaciones en vivo hasta recibir SIGTERM")
+    parser.add_argument('--device', action='append', dest='equipos', metavar='ID',
+                        help="solo este equipo de equipos.json (se puede repetir)")
+    return parser
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+    if args.tiempo_real:
+        return ejecutar_tiempo_real(args.equipos)
+    if args.service:
+        return ejecutar_servicio(args.equipos)
+    return sincronizar_una_vez(args.equipos)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio client, to talk with many devices at once from a single thread.
+
+only TCP is supported; the packets are built and decoded with the same
+functions (protocol.py) as the blocking client ZK
+"""
+import asyncio
+from struct import pack, unpack
+
+from . import const, protocol
+from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
+from .user import User
+
+
+class AsyncZK(object):
+    """
+    asyncio version of ZK (connect, read_sizes, get_users, get_attendance,
+    live_capture, set_user...), every method is a coroutine
+
+    usage::
+
+        zk = AsyncZK('192.168.1.201')
+        await zk.connect()
+        attendances = await zk.get_attendance()
+        await zk.disconnect()
+    """
+
+    def __init__(self, ip, port=4370, timeout=60, password=0, verbose=False, encoding='UTF-8'):
+        """
+        :param ip: IP address of the device
+        :param port: port number
+        :param timeout: seconds to wait for every answer of the device
+        :param password: the communication password of the device
+        :param verbose: print debug messages
+        :param encoding: user encoding
+        """
+        User.encoding = encoding
+        self.__address = (ip, port)
+        self.__timeout = timeout
+        self.__password = password
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        self.__reader = None
+        self.__writer = None
+        self.__response = None
+        self.__data = None
+        self.bytes_received = 0
+
+        self.is_connect = False
+        self.is_enabled = True
+        self.verbose = verbose
+        self.encoding = encoding
+        self.tcp = True
+        self.users = 0
+        self.fingers = 0
+        self.records = 0
+        self.last_record = None
+        self.dummy = 0
+        self.cards = 0
+        self.fingers_cap = 0
+        self.users_cap = 0
+        self.rec_cap = 0
+        self.faces = 0
+        self.faces_cap = 0
+        self.fingers_av = 0
+        self.users_av = 0
+        self.rec_av = 0
+        self.next_uid = 1
+        self.next_user_id = '1'
+        self.user_packet_size = 72 # default zk8
+        self.end_live_capture = False
+
+    def __str__(self):
+        return "ZK tcp://%s:%s (async)" % self.__address
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.is_connect:
+            try:
+                await self.disconnect()
+            except ZKNetworkError:
+                pass
+
+    async def __recieve_packet(self, timeout=None):
+        """
+        recieve one complete tcp packet
+
+        only a timeout waiting for the top header is raised as TimeoutError
+        (nothing was read, the caller can keep using the stream); once the
+        top is read, a timeout on the body leaves the stream out of sync, so
+        the connection is dropped and ZKNetworkError is raised
+
+        :return: the packet, without the top header
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        try:
+            top = await asyncio.wait_for(self.__reader.readexactly(8), timeout)
+        except asyncio.IncompleteReadError:
+            raise ZKNetworkError("connection closed by the device")
+        except asyncio.TimeoutError:
+            raise # an OSError since python 3.11
+        except OSError as e:
+            raise ZKNetworkError(str(e))
+        try:
+            packet = await asyncio.wait_for(self.__reader.readexactly(protocol.parse_tcp_top(top)), self.__timeout)
+        except asyncio.TimeoutError:
+            self.__close()
+            raise ZKNetworkError("timed out in the middle of a packet")
+        except asyncio.IncompleteReadError:
+            raise ZKNetworkError("connection closed by the device")
+        except OSError as e:
+            raise ZKNetworkError(str(e))
+        self.bytes_received += 8 + len(packet)
+        return packet
+
+    async def __send(self, command, command_string=b'', reply_id=None):
+        if reply_id is None:
+            reply_id = self.__reply_id
+        buf = protocol.create_header(command, command_string, self.__session_id, reply_id)
+        try:
+            self.__writer.write(protocol.create_tcp_top(buf))
+            await self.__writer.drain()
+        except OSError as e:
+            raise ZKNetworkError(str(e))
+
+    async def __send_command(self, command, command_string=b''):
+        """
+        send command to the terminal and read its answer
+        """
+        if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
+            raise ZKErrorConnection("instance are not connected.")
+        await self.__send(command, command_string)
+        try:
+            packet = await self.__recieve_packet()
+        except asyncio.TimeoutError:
+            raise ZKNetworkError("timed out")
+        header = protocol.parse_header(packet)
+        self.__response = header[0]
+        self.__reply_id = header[3]
+        self.__data = packet[8:]
+        return header, {
+            'status': self.__response in [const.CMD_ACK_OK, const.CMD_PREPARE_DATA, const.CMD_DATA],
+            'code': self.__response
+        }
+
+    async def __ack_ok(self):
+        """
+        event ack ok
+        """
+        await self.__send(const.CMD_ACK_OK, b'', const.USHRT_MAX - 1)
+
+    async def connect(self):
+        """
+        connect to the device
+
+        :return: self
+        """
+        self.end_live_capture = False
+        try:
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(*self.__address), self.__timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ZKNetworkError("can't connect to %s:%i (%s)" % (self.__address[0], self.__address[1], e)) from e
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        try:
+            header, cmd_response = await self.__send_command(const.CMD_CONNECT)
+            self.__session_id = header[2]
+            if cmd_response.get('code') == const.CMD_ACK_UNAUTH:
+                if self.verbose: print ("try auth")
+                command_string = protocol.make_commkey(self.__password, self.__session_id)
+                header, cmd_response = await self.__send_command(const.CMD_AUTH, command_string)
+        except Exception:
+            self.__close()
+            raise
+        if cmd_response.get('status'):
+            self.is_connect = True
+            return self
+        self.__close()
+        if cmd_response["code"] == const.CMD_ACK_UNAUTH:
+            raise ZKErrorResponse("Unauthenticated")
+        if self.verbose: print ("connect err response {} ".format(cmd_response["code"]))
+        raise ZKErrorResponse("Invalid response: Can't connect")
+
+    def __close(self):
+        self.is_connect = False
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+    async def disconnect(self):
+        """
+        diconnect from the connected device
+
+        :return: bool
+        """
+        try:
+            _header, cmd_response = await self.__send_command(const.CMD_EXIT)
+        finally:
+            self.__close()
+        if cmd_response.get('status'):
+            return True
+        raise ZKErrorResponse("can't disconnect")
+
+    async def enable_device(self):
+        """
+        re-enable the connected device and allow user activity in device again
+
+        :return: bool
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_ENABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = True
+            return True
+        raise ZKErrorResponse("Can't enable device")
+
+    async def disable_device(self):
+        """
+        disable (lock) device, to ensure no user activity in device while some process run
+
+        :return: bool
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_DISABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = False
+            return True
+        raise ZKErrorResponse("Can't disable device")
+
+    async def get_time(self):
+        """
+        :return: the machine's time
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_GET_TIME)
+        if cmd_response.get('status'):
+            return protocol.decode_time(self.__data[:4])
+        raise ZKErrorResponse("can't get time")
+
+    async def read_sizes(self):
+        """
+        read the memory ussage
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_GET_FREE_SIZES)
+        if cmd_response.get('status'):
+            for name, value in protocol.decode_sizes(self.__data).items():
+                setattr(self, name, value)
+            return True
+        raise ZKErrorResponse("can't read sizes")
+
+    async def refresh_data(self):
+        """
+        shortcut for refreshing the data on the device
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_REFRESHDATA)
+        if cmd_response.get('status'):
+            return True
+        raise ZKErrorResponse("can't refresh data")
+
+    async def free_data(self):
+        """
+        clear buffer
+
+        :return: bool
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_FREE_DATA)
+        if cmd_response.get('status'):
+            return True
+        raise ZKErrorResponse("can't free data")
+
+    async def __recieve_chunk(self, into):
+        """
+        recieve the data of a CMD_DATA or CMD_PREPARE_DATA answer into the
+        (writable) memoryview
+
+        :return: True if the chunk is complete
+        """
+        if self.__response == const.CMD_DATA:
+            if len(self.__data) != len(into):
+                return False
+            into[:] = self.__data
+            return True
+        if self.__response != const.CMD_PREPARE_DATA:
+            if self.verbose: print ("invalid response %s" % self.__response)
+            return False
+        size = unpack('I', self.__data[:4])[0]
+        complete = size == len(into)
+        recieved = 0
+        while recieved < size:
+            packet = await self.__recieve_packet()
+            if protocol.parse_header(packet)[0] != const.CMD_DATA:
+                if self.verbose: print ("incorrect response!!! {}".format(protocol.parse_header(packet)[0]))
+                return False
+            payload = memoryview(packet)[8:]
+            count = min(len(payload), size - recieved)
+            if complete:
+                into[recieved:recieved + count] = payload[:count]
+            recieved += count
+        packet = await self.__recieve_packet()
+        return complete and protocol.parse_header(packet)[0] == const.CMD_ACK_OK
+
+    async def read_with_buffer(self, command, fct=0, ext=0):
+        """
+        Test read info with buffered command (ZK6: 1503)
+
+        :return: (bytearray data, size)
+        """
+        command_string = protocol.encode_prepare_buffer(command, fct, ext)
+        _header, cmd_response = await self.__send_command(const._CMD_PREPARE_BUFFER, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("RWB Not supported")
+        if cmd_response['code'] == const.CMD_DATA:
+            return bytearray(self.__data), len(self.__data)
+        size = unpack('I', self.__data[1:5])[0]
+        data = bytearray(size)
+        view = memoryview(data)
+        for start, chunk in protocol.buffer_ranges(size, protocol.TCP_MAX_CHUNK):
+            for _retries in range(3):
+                await self.__send_command(const._CMD_READ_BUFFER, protocol.encode_read_buffer(start, chunk))
+                if await self.__recieve_chunk(view[start:start + chunk]):
+                    break
+            else:
+                raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, chunk))
+        await self.free_data()
+        return data, size
+
+    async def get_users(self):
+        """
+        :return: list of User object
+        """
+        await self.read_sizes()
+        if self.users == 0:
+            self.next_uid = 1
+            self.next_user_id = '1'
+            return []
+        userdata, size = await self.read_with_buffer(const.CMD_USERTEMP_RRQ, const.FCT_USER)
+        if size <= 4:
+            print("WRN: missing user data")
+            return []
+        total_size = unpack("I", userdata[:4])[0]
+        self.user_packet_size = total_size / self.users
+        if not self.user_packet_size in [28, 72]:
+            if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
+        users = protocol.decode_users(userdata[4:], self.user_packet_size, self.encoding)
+        _, by_user_id = protocol.index_users(users)
+        self.next_uid, self.next_user_id = protocol.next_user_ids(users, by_user_id)
+        return users
+
+    async def set_user(self, uid=None, name='', privilege=0, password='', group_id='', user_id='', card=0):
+        """
+        create or update user by uid (see ZK.set_user)
+        """
+        if uid is None:
+            uid = self.next_uid
+            if not user_id:
+                user_id = self.next_user_id
+        if not user_id:
+            user_id = str(uid) #ZK6 needs uid2 == uid
+        if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
+            privilege = const.USER_DEFAULT
+        privilege = int(privilege)
+        command_string = protocol.encode_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
+        _header, cmd_response = await self.__send_command(const.CMD_USER_WRQ, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("Can't set user")
+        await self.refresh_data()
+        if self.next_uid == uid:
+            self.next_uid += 1 # better recalculate again
+        if self.next_user_id == user_id:
+            self.next_user_id = str(self.next_uid)
+
+    async def get_attendance(self, since=None, last=None):
+        """
+        return attendance record
+
+        :param since: None (all records), datetime (records with a later
+            timestamp) or int (amount of records already read), like
+            ZK.get_attendance_since
+        :param last: self.last_record after the previous download, like
+            ZK.get_attendance_since
+        :return: List of Attendance object
+        """
+        self.last_record = None
+        await self.read_sizes()
+        if self.records == 0:
+            return []
+        start, since_time, check = protocol.attendance_start(self.records, since, last)
+        if start is None:
+            return []
+        users = await self.get_users()
+        attendance_data, size = await self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        if size < 4:
+            if self.verbose: print ("WRN: no attendance data")
+            return []
+        records, record_size = protocol.split_attendance(attendance_data, self.records)
+        by_uid, by_user_id = protocol.index_users(users)
+        if check and protocol.attendance_key(records[(start - 1) * record_size:start * record_size],
+                                             record_size, by_uid, by_user_id) != tuple(last):
+            if self.verbose: print ("the log was cleared, reading it from the start")
+            start = 0
+        self.last_record = protocol.attendance_key(records[(self.records - 1) * record_size:self.records * record_size],
+                                                   record_size, by_uid, by_user_id)
+        return protocol.decode_attendance(records[start * record_size:], record_size, by_uid, by_user_id, since_time)
+
+    async def reg_event(self, flags):
+        """
+        reg events
+        """
+        _header, cmd_response = await self.__send_command(const.CMD_REG_EVENT, pack("I", flags))
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("cant' reg events %i" % flags)
+
+    async def live_capture(self, new_timeout=10):
+        """
+        try live capture of events, as an async generator: yields Attendance
+        objects, or None every new_timeout seconds without events
+
+        set end_live_capture to stop it
+        """
+        was_enabled = self.is_enabled
+        users = await self.get_users()
+        _, by_user_id = protocol.index_users(users)
+        await self.__send_command(const.CMD_CANCELCAPTURE)
+        await self.__send_command(const.CMD_STARTVERIFY)
+        if not self.is_enabled:
+            await self.enable_device()
+        if self.verbose: print ("start live_capture")
+        await self.reg_event(const.EF_ATTLOG)
+        self.end_live_capture = False
+        while not self.end_live_capture:
+            try:
+                packet = await self.__recieve_packet(new_timeout)
+            except asyncio.TimeoutError:
+                if self.verbose: print ("time out")
+                yield None # return to keep watching
+                continue
+            await self.__ack_ok()
+            if protocol.parse_header(packet)[0] != const.CMD_REG_EVENT:
+                if self.verbose: print("not event! %x" % protocol.parse_header(packet)[0])
+                continue
+            for event in protocol.decode_events(bytes(packet[8:]), by_user_id):
+                yield event
+        if self.verbose: print ("exit gracefully")
+        await self.reg_event(0)
+        if not was_enabled:
+            await self.disable_device()
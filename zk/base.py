@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
-import sys
-from datetime import datetime
+import json
+import os
+from calendar import timegm
+from time import time as now
 from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, socket, timeout
 from struct import pack, unpack
 import codecs
+from collections import deque
 
-from . import const
-from .attendance import Attendance
+from . import const, decoder
 from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
 from .user import User
 from .finger import Finger
+from .spool import Spool
+from . import protocol
+from .protocol import create_checksum, make_commkey
 
 
 def safe_cast(val, to_type, default=None):
@@ -20,43 +25,6 @@ def safe_cast(val, to_type, default=None):
         return default
 
 
-def make_commkey(key, session_id, ticks=50):
-    """
-    take a password and session_id and scramble them to send to the machine.
-    copied from commpro.c - MakeKey
-    """
-    key = int(key)
-    session_id = int(session_id)
-    k = 0
-    for i in range(32):
-        if (key & (1 << i)):
-            k = (k << 1 | 1)
-        else:
-            k = k << 1
-    k += session_id
-
-    k = pack(b'I', k)
-    k = unpack(b'BBBB', k)
-    k = pack(
-        b'BBBB',
-        k[0] ^ ord('Z'),
-        k[1] ^ ord('K'),
-        k[2] ^ ord('S'),
-        k[3] ^ ord('O'))
-    k = unpack(b'HH', k)
-    k = pack(b'HH', k[1], k[0])
-
-    B = 0xff & ticks
-    k = unpack(b'BBBB', k)
-    k = pack(
-        b'BBBB',
-        k[0] ^ B,
-        k[1] ^ B,
-        B,
-        k[3] ^ B)
-    return k
-
-
 class ZK_helper(object):
     """
     ZK helper class
@@ -110,7 +78,12 @@ class ZK(object):
     """
     ZK main class
     """
-    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8'):
+    # users downloaded per device serial number, shared by all the connections
+    _users_cache = {}
+    # protocol detected by fast_connect per (ip, port)
+    _protocol_cache = {}
+
+    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8', cache_users=False, user_cache_dir=None, user_cache_ttl=None, read_window=1, spool_dir=None, fast_connect=False, connect_timeout=3):
         """
         Construct a new 'ZK' object.
 
@@ -122,6 +95,18 @@ class ZK(object):
         :param omit_ping: check ip using ping before connect
         :param verbose: showing log while run the commands
         :param encoding: user encoding
+        :param cache_users: reuse the users of the previous get_users() while
+            the user count of the device doesn't change
+        :param user_cache_dir: directory to keep the cached users between runs
+        :param user_cache_ttl: seconds after which the cached users are
+            downloaded again anyway (None: never)
+        :param read_window: buffer chunk requests kept in flight at once over
+            TCP (1: wait each response before the next request)
+        :param spool_dir: directory to checkpoint the chunks of big buffers,
+            so an interrupted read_with_buffer resumes where it stopped
+        :param fast_connect: skip the ping and tcp probe, open the session
+            with a single connect and remember the protocol of the device
+        :param connect_timeout: timeout of the fast_connect handshake
         """
         User.encoding = encoding
         self.__address = (ip, port)
@@ -133,6 +118,7 @@ class ZK(object):
         self.__reply_id = const.USHRT_MAX - 1
         self.__data_recv = None
         self.__data = None
+        self.bytes_received = 0
 
         self.is_connect = False
         self.is_enabled = True
@@ -145,6 +131,7 @@ class ZK(object):
         self.users = 0
         self.fingers = 0
         self.records = 0
+        self.last_record = None
         self.dummy = 0
         self.cards = 0
         self.fingers_cap = 0
@@ -159,6 +146,17 @@ class ZK(object):
         self.next_user_id='1'
         self.user_packet_size = 28 # default zk6
         self.end_live_capture = False
+        self.__user_index = None
+        self.cache_users = cache_users or bool(user_cache_dir)
+        self.user_cache_dir = user_cache_dir
+        self.user_cache_ttl = user_cache_ttl
+        self.read_window = read_window
+        self.spool_dir = spool_dir
+        self.resumed_bytes = 0
+        self.timings = {}
+        self.fast_connect = fast_connect
+        self.connect_timeout = connect_timeout
+        self.__serialnumber = None
 
     def __nonzero__(self):
         """
@@ -179,60 +177,13 @@ class ZK(object):
         """
         witch the complete packet set top header
         """
-        length = len(packet)
-        top = pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, length)
-        return top + packet
+        return protocol.create_tcp_top(packet)
 
     def __create_header(self, command, command_string, session_id, reply_id):
         """
         Puts a the parts that make up a packet together and packs them into a byte string
         """
-        buf = pack('<4H', command, 0, session_id, reply_id) + command_string
-        buf = unpack('8B' + '%sB' % len(command_string), buf)
-        checksum = unpack('H', self.__create_checksum(buf))[0]
-        reply_id += 1
-        if reply_id >= const.USHRT_MAX:
-            reply_id -= const.USHRT_MAX
-
-        buf = pack('<4H', command, checksum, session_id, reply_id)
-        return buf + command_string
-
-    def __create_checksum(self, p):
-        """
-        Calculates the checksum of the packet to be sent to the time clock
-        Copied from zkemsdk.c
-        """
-        l = len(p)
-        checksum = 0
-        while l > 1:
-            checksum += unpack('H', pack('BB', p[0], p[1]))[0]
-            p = p[2:]
-            if checksum > const.USHRT_MAX:
-                checksum -= const.USHRT_MAX
-            l -= 2
-        if l:
-            checksum = checksum + p[-1]
-
-        while checksum > const.USHRT_MAX:
-            checksum -= const.USHRT_MAX
-
-        checksum = ~checksum
-
-        while checksum < 0:
-            checksum += const.USHRT_MAX
-
-        return pack('H', checksum)
-
-    def __test_tcp_top(self, packet):
-        """
-        return size!
-        """
-        if len(packet)<=8:
-            return 0
-        tcp_header = unpack('<HHI', packet[:8])
-        if tcp_header[0] == const.MACHINE_PREPARE_DATA_1 and tcp_header[1] == const.MACHINE_PREPARE_DATA_2:
-            return tcp_header[2]
-        return 0
+        return protocol.create_header(command, command_string, session_id, reply_id)
 
     def __send_command(self, command, command_string=b'', response_size=8):
         """
@@ -246,15 +197,14 @@ class ZK(object):
             if self.tcp:
                 top = self.__create_tcp_top(buf)
                 self.__sock.send(top)
-                self.__tcp_data_recv = self.__sock.recv(response_size + 8)
-                self.__tcp_length = self.__test_tcp_top(self.__tcp_data_recv)
-                if self.__tcp_length == 0:
-                    raise ZKNetworkError("TCP packet invalid")
-                self.__header = unpack('<4H', self.__tcp_data_recv[8:16])
-                self.__data_recv = self.__tcp_data_recv[8:]
+                # read exactly one packet, the data that follows (if any) is
+                # left in the socket for __recieve_chunk
+                self.__data_recv = self.__recieve_tcp_packet()
+                self.__header = unpack('<4H', self.__data_recv[:8])
             else:
                 self.__sock.sendto(buf, self.__address)
                 self.__data_recv = self.__sock.recv(response_size)
+                self.bytes_received += len(self.__data_recv)
                 self.__header = unpack('<4H', self.__data_recv[:8])
         except Exception as e:
             raise ZKNetworkError(str(e))
@@ -313,48 +263,19 @@ class ZK(object):
         copied from zkemsdk.c - DecodeTime
         """
 
-        t = unpack("<I", t)[0]
-        second = t % 60
-        t = t // 60
-
-        minute = t % 60
-        t = t // 60
-
-        hour = t % 24
-        t = t // 24
-
-        day = t % 31 + 1
-        t = t // 31
-
-        month = t % 12 + 1
-        t = t // 12
-
-        year = t + 2000
-
-        d = datetime(year, month, day, hour, minute, second)
-
-        return d
+        return protocol.decode_time(t)
 
     def __decode_timehex(self, timehex):
         """
         timehex string of six bytes
         """
-        year, month, day, hour, minute, second = unpack("6B", timehex)
-        year += 2000
-        d = datetime(year, month, day, hour, minute, second)
-        return d
+        return protocol.decode_timehex(timehex)
 
     def __encode_time(self, t):
         """
         Encode a timestamp so that it can be read on the timeclock
         """
-        # formula taken from zkemsdk.c - EncodeTime
-        # can also be found in the technical manual
-        d = (
-            ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
-            (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
-        )
-        return d
+        return protocol.encode_time(t)
 
     def connect(self):
         """
@@ -363,11 +284,65 @@ class ZK(object):
         :return: bool
         """
         self.end_live_capture = False
+        if self.fast_connect:
+            return self.__fast_connect()
         if not self.ommit_ping and not self.helper.test_ping():
             raise ZKNetworkError("can't reach device (ping %s)" % self.__address[0])
         if not self.force_udp and self.helper.test_tcp() == 0:
             self.user_packet_size = 72 # default zk8
         self.__create_socket()
+        return self.__open_session()
+
+    def __fast_connect(self):
+        """
+        connect without ping nor tcp probe: reuse the protocol detected on a
+        previous connect, or try TCP and fall back to UDP if it is refused
+        """
+        cached = ZK._protocol_cache.get(self.__address)
+        if cached is not None:
+            self.tcp, self.user_packet_size = cached
+            try:
+                return self.__fast_open()
+            except ZKNetworkError as e:
+                if self.verbose: print ("cached protocol failed: {}".format(e))
+                ZK._protocol_cache.pop(self.__address, None)
+        self.tcp = not self.force_udp
+        self.user_packet_size = 72 if self.tcp else 28
+        try:
+            return self.__fast_open()
+        except ZKNetworkError as e:
+            if not self.tcp or not isinstance(e.__cause__, ConnectionRefusedError):
+                raise
+            if self.verbose: print ("tcp refused, trying udp")
+        self.tcp = False
+        self.user_packet_size = 28
+        return self.__fast_open()
+
+    def __fast_open(self):
+        if self.tcp:
+            self.__sock = socket(AF_INET, SOCK_STREAM)
+            self.__sock.settimeout(self.connect_timeout)
+            try:
+                self.__sock.connect(self.__address)
+            except Exception as e:
+                self.__sock.close()
+                raise ZKNetworkError("can't connect to %s:%i (%s)" % (self.__address[0], self.__address[1], e)) from e
+        else:
+            self.__sock = socket(AF_INET, SOCK_DGRAM)
+            self.__sock.settimeout(self.connect_timeout)
+        try:
+            self.__open_session()
+        except Exception:
+            self.__sock.close()
+            raise
+        self.__sock.settimeout(self.__timeout)
+        ZK._protocol_cache[self.__address] = (self.tcp, self.user_packet_size)
+        return self
+
+    def __open_session(self):
+        """
+        CMD_CONNECT (and CMD_AUTH) exchange on the already created socket
+        """
         self.__session_id = 0
         self.__reply_id = const.USHRT_MAX - 1
         cmd_response = self.__send_command(const.CMD_CONNECT)
@@ -391,7 +366,13 @@ class ZK(object):
 
         :return: bool
         """
-        cmd_response = self.__send_command(const.CMD_EXIT)
+        try:
+            cmd_response = self.__send_command(const.CMD_EXIT)
+        except ZKNetworkError:
+            # the connection is already broken, release the socket anyway
+            self.is_connect = False
+            self.__sock.close()
+            raise
         if cmd_response.get('status'):
             self.is_connect = False
             if self.__sock:
@@ -658,25 +639,8 @@ class ZK(object):
         cmd_response = self.__send_command(command,b'', response_size)
         if cmd_response.get('status'):
             if self.verbose: print(codecs.encode(self.__data,'hex'))
-            size = len(self.__data)
-            if len(self.__data) >= 80:
-                fields = unpack('20i', self.__data[:80])
-                self.users = fields[4]
-                self.fingers = fields[6]
-                self.records = fields[8]
-                self.dummy = fields[10] #???
-                self.cards = fields[12]
-                self.fingers_cap = fields[14]
-                self.users_cap = fields[15]
-                self.rec_cap = fields[16]
-                self.fingers_av = fields[17]
-                self.users_av = fields[18]
-                self.rec_av = fields[19]
-                self.__data = self.__data[80:]
-            if len(self.__data) >= 12: #face info
-                fields = unpack('3i', self.__data[:12]) #dirty hack! we need more information
-                self.faces = fields[0]
-                self.faces_cap = fields[2]
+            for name, value in protocol.decode_sizes(self.__data).items():
+                setattr(self, name, value)
             return True
         else:
             raise ZKErrorResponse("can't read sizes")
@@ -903,25 +867,18 @@ class ZK(object):
         if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
             privilege = const.USER_DEFAULT
         privilege = int(privilege)
-        if self.user_packet_size == 28: #self.firmware == 6:
-            if not group_id:
-                group_id = 0
-            try:
-                command_string = pack('HB5s8sIxBHI', uid, privilege, password.encode(self.encoding, errors='ignore'), name.encode(self.encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
-            except Exception as e:
-                if self.verbose: print("s_h Error pack: %s" % e)
-                if self.verbose: print("Error pack: %s" % sys.exc_info()[0])
-                raise ZKErrorResponse("Can't pack user")
-        else:
-            name_pad = name.encode(self.encoding, errors='ignore').ljust(24, b'\x00')[:24]
-            card_str = pack('<I', int(card))[:4]
-            command_string = pack('HB8s24s4sx7sx24s', uid, privilege, password.encode(self.encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
+        try:
+            command_string = protocol.encode_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
+        except ZKErrorResponse as e:
+            if self.verbose: print("s_h Error pack: %s" % e)
+            raise
         response_size = 1024 #TODO check response?
         cmd_response = self.__send_command(command, command_string, response_size)
         if self.verbose: print("Response: %s" % cmd_response)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't set user")
         self.refresh_data()
+        self.__forget_users()
         if self.next_uid == uid:
             self.next_uid += 1 # better recalculate again
         if self.next_user_id == user_id:
@@ -983,6 +940,7 @@ class ZK(object):
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't save usertemplates")
         self.refresh_data()
+        self.__forget_users()
 
     def _send_with_buffer(self, buffer):
         MAX_CHUNK = 1024
@@ -1060,6 +1018,7 @@ class ZK(object):
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't delete user")
         self.refresh_data()
+        self.__forget_users()
         if uid == (self.next_uid - 1):
             self.next_uid = uid
 
@@ -1082,7 +1041,7 @@ class ZK(object):
             cmd_response = self.__send_command(command, command_string, response_size)
             data = self.__recieve_chunk()
             if data is not None:
-                resp = data[:-1]
+                resp = bytes(data[:-1])
                 if resp[-6:] == b'\x00\x00\x00\x00\x00\x00': # padding? bug?
                     resp = resp[:-6]
                 return Finger(uid, temp_id, 1, resp)
@@ -1116,8 +1075,9 @@ class ZK(object):
             total_size -= size
         return templates
 
-    def get_users(self):
+    def get_users(self, refresh=False):
         """
+        :param refresh: download the users even if they are cached
         :return: list of User object
         """
         self.read_sizes()
@@ -1125,8 +1085,10 @@ class ZK(object):
             self.next_uid = 1
             self.next_user_id='1'
             return []
-        users = []
-        max_uid = 0
+        if self.cache_users and not refresh:
+            users = self.__load_cached_users()
+            if users is not None:
+                return users
         userdata, size = self.read_with_buffer(const.CMD_USERTEMP_RRQ, const.FCT_USER)
         if self.verbose: print("user size {} (= {})".format(size, len(userdata)))
         if size <= 4:
@@ -1136,46 +1098,110 @@ class ZK(object):
         self.user_packet_size = total_size / self.users
         if not self.user_packet_size in [28, 72]:
             if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
-        userdata = userdata[4:]
-        if self.user_packet_size == 28:
-            while len(userdata) >= 28:
-                uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI',userdata.ljust(28, b'\x00')[:28])
-                if uid > max_uid: max_uid = uid
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = str(group_id)
-                user_id = str(user_id)
-                #TODO: check card value and find in ver8
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                if self.verbose: print("[6]user:",uid, privilege, password, name, card, group_id, timezone, user_id)
-                userdata = userdata[28:]
-        else:
-            while len(userdata) >= 72:
-                uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata.ljust(72, b'\x00')[:72])
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = (group_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                user_id = (user_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                if uid > max_uid: max_uid = uid
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                userdata = userdata[72:]
-        max_uid += 1
-        self.next_uid = max_uid
-        self.next_user_id = str(max_uid)
-        while True:
-            if any(u for u in users if u.user_id == self.next_user_id):
-                max_uid += 1
-                self.next_user_id = str(max_uid)
-            else:
-                break
+        elif self.__address in ZK._protocol_cache:
+            ZK._protocol_cache[self.__address] = (self.tcp, self.user_packet_size)
+        users = protocol.decode_users(userdata[4:], self.user_packet_size, self.encoding)
+        if self.verbose: print(users)
+        _, by_user_id = self.__index_users(users)
+        self.next_uid, self.next_user_id = protocol.next_user_ids(users, by_user_id)
+        if self.cache_users:
+            self.__save_cached_users(users)
         return users
 
+    def __device_key(self):
+        if self.__serialnumber is None:
+            try:
+                self.__serialnumber = self.get_serialnumber()
+            except ZKErrorResponse:
+                return None
+        return self.__serialnumber or None
+
+    def __user_cache_file(self, key):
+        name = ''.join(c if c.isalnum() else '_' for c in key)
+        return os.path.join(self.user_cache_dir, 'users_%s.json' % name)
+
+    def __load_cached_users(self):
+        """
+        :return: the cached list of User object, or None if it is missing or
+            the device user count changed
+        """
+        key = self.__device_key()
+        if key is None:
+            return None
+        cached = ZK._users_cache.get(key)
+        if cached is None and self.user_cache_dir:
+            try:
+                with open(self.__user_cache_file(key), 'r') as f:
+                    cached = json.load(f)
+                cached['users'] = [User.json_unpack(u) for u in cached['users']]
+                ZK._users_cache[key] = cached
+            except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+                if self.verbose: print("no cached users for {}: {}".format(key, e))
+                return None
+        if cached is None or cached['count'] != self.users:
+            return None
+        if self.user_cache_ttl is not None and now() - cached['updated'] > self.user_cache_ttl:
+            return None
+        if self.verbose: print("using {} cached users of {}".format(cached['count'], key))
+        self.user_packet_size = cached['user_packet_size']
+        self.next_uid = cached['next_uid']
+        self.next_user_id = cached['next_user_id']
+        return cached['users']
+
+    def __save_cached_users(self, users):
+        key = self.__device_key()
+        if key is None:
+            return
+        cached = {
+            'count': self.users,
+            'updated': now(),
+            'user_packet_size': self.user_packet_size,
+            'next_uid': self.next_uid,
+            'next_user_id': self.next_user_id,
+            'users': users,
+        }
+        ZK._users_cache[key] = cached
+        if not self.user_cache_dir:
+            return
+        filename = self.__user_cache_file(key)
+        try:
+            if not os.path.isdir(self.user_cache_dir):
+                os.makedirs(self.user_cache_dir)
+            data = dict(cached, users=[u.json_pack() for u in users])
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            if self.verbose: print("can't save cached users: {}".format(e))
+
+    def __forget_users(self):
+        """
+        drop the cached users after changing them on the device
+        """
+        key = self.__serialnumber
+        if key is None:
+            return
+        ZK._users_cache.pop(key, None)
+        if self.user_cache_dir:
+            try:
+                os.remove(self.__user_cache_file(key))
+            except (IOError, OSError):
+                pass
+
+    def __index_users(self, users):
+        """
+        index users by uid and by user_id, reusing the previous index while
+        the device returns the same (unchanged) user list
+
+        :return: (dict uid -> User, dict user_id -> User)
+        """
+        index = self.__user_index
+        if index is not None and index[0] is users and index[1] == len(users):
+            return index[2], index[3]
+        by_uid, by_user_id = protocol.index_users(users)
+        self.__user_index = (users, len(users), by_uid, by_user_id)
+        return by_uid, by_user_id
+
     def cancel_capture(self):
         """
         cancel capturing finger
@@ -1318,6 +1344,7 @@ class ZK(object):
         """
         was_enabled = self.is_enabled
         users = self.get_users()
+        _, by_user_id = self.__index_users(users)
         self.cancel_capture()
         self.verify_user()
         if not self.is_enabled:
@@ -1329,13 +1356,16 @@ class ZK(object):
         while not self.end_live_capture:
             try:
                 if self.verbose: print ("esperando event")
-                data_recv = self.__sock.recv(1032)
-                self.__ack_ok()
                 if self.tcp:
-                    size = unpack('<HHI', data_recv[:8])[2]
-                    header = unpack('HHHH', data_recv[8:16])
-                    data = data_recv[16:]
+                    # one event per packet, even if several arrive together
+                    packet = self.__recieve_tcp_packet()
+                    self.__ack_ok()
+                    size = len(packet)
+                    header = unpack('<4H', packet[:8])
+                    data = bytes(packet[8:])
                 else:
+                    data_recv = self.__sock.recv(1032)
+                    self.__ack_ok()
                     size = len(data_recv)
                     header = unpack('<4H', data_recv[:8])
                     data = data_recv[8:]
@@ -1345,39 +1375,8 @@ class ZK(object):
                 if not len(data):
                     if self.verbose: print ("empty")
                     continue
-                while len(data) >= 10:
-                    if len(data) == 10:
-                        user_id, status, punch, timehex = unpack('<HBB6s', data)
-                        data = data[10:]
-                    elif len(data) == 12:
-                        user_id, status, punch, timehex = unpack('<IBB6s', data)
-                        data = data[12:]
-                    elif len(data) == 14:
-                        user_id, status, punch, timehex, _other = unpack('<HBB6s4s', data)
-                        data = data[14:]
-                    elif len(data) == 32:
-                        user_id,  status, punch, timehex = unpack('<24sBB6s', data[:32])
-                        data = data[32:]
-                    elif len(data) == 36:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s4s', data[:36])
-                        data = data[36:]
-                    elif len(data) == 37:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s5s', data[:37])
-                        data = data[37:]
-                    elif len(data) >= 52:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s20s', data[:52])
-                        data = data[52:]
-                    if isinstance(user_id, int):
-                        user_id = str(user_id)
-                    else:
-                        user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                    timestamp = self.__decode_timehex(timehex)
-                    tuser = list(filter(lambda x: x.user_id == user_id, users))
-                    if not tuser:
-                        uid = int(user_id)
-                    else:
-                        uid = tuser[0].uid
-                    yield Attendance(user_id, timestamp, status, punch, uid)
+                for event in protocol.decode_events(data, by_user_id):
+                    yield event
             except timeout:
                 if self.verbose: print ("time out")
                 yield None # return to keep watching
@@ -1401,201 +1400,356 @@ class ZK(object):
         cmd_response = self.__send_command(command, command_string)
         if cmd_response.get('status'):
             self.next_uid = 1
+            self.__forget_users()
             return True
         else:
             raise ZKErrorResponse("can't clear data")
 
-    def __recieve_tcp_data(self, data_recv, size):
-        """ data_recv, raw tcp packet
-         must analyze tcp_length
-
-         must return data, broken
-         """
-        data = []
-        tcp_length = self.__test_tcp_top(data_recv)
-        if self.verbose: print ("tcp_length {}, size {}".format(tcp_length, size))
-        if tcp_length <= 0:
-            if self.verbose: print ("Incorrect tcp packet")
-            return None, b""
-        if (tcp_length - 8) < size:
-            if self.verbose: print ("tcp length too small... retrying")
-            resp, bh = self.__recieve_tcp_data(data_recv, tcp_length - 8)
-            data.append(resp)
-            size -= len(resp)
-            if self.verbose: print ("new tcp DATA packet to fill misssing {}".format(size))
-            data_recv = bh + self.__sock.recv(size + 16 )
-            if self.verbose: print ("new tcp DATA starting with {} bytes".format(len(data_recv)))
-            resp, bh = self.__recieve_tcp_data(data_recv, size)
-            data.append(resp)
-            if self.verbose: print ("for misssing {} recieved {} with extra {}".format(size, len(resp), len(bh)))
-            return b''.join(data), bh
-        recieved = len(data_recv)
-        if self.verbose: print ("recieved {}, size {}".format(recieved, size))
-        response = unpack('HHHH', data_recv[8:16])[0]
-        if recieved >= (size + 32):
+    def __recieve_into(self, view):
+        """
+        fill the whole (writable) memoryview from the socket
+        """
+        size = len(view)
+        recieved = 0
+        while recieved < size:
+            count = self.__sock.recv_into(view[recieved:])
+            if not count:
+                raise ZKNetworkError("connection closed by the device")
+            recieved += count
+        self.bytes_received += size
+        return view
+
+    def __recieve_tcp_top(self):
+        """
+        recieve the top header of a tcp packet
+
+        :return: length of the packet that follows
+        """
+        top = bytearray(8)
+        self.__recieve_into(memoryview(top))
+        return protocol.parse_tcp_top(top)
+
+    def __recieve_tcp_packet(self):
+        """
+        recieve one complete tcp packet
+
+        :return: bytearray with the packet, without the top header
+        """
+        packet = bytearray(self.__recieve_tcp_top())
+        self.__recieve_into(memoryview(packet))
+        return packet
+
+    def __recieve_tcp_chunk(self, into):
+        """
+        recieve the CMD_DATA packets that follow a CMD_PREPARE_DATA straight
+        into the buffer, then the final CMD_ACK_OK
+
+        :return: into, or None if the device sent something else
+        """
+        size = len(into)
+        header = bytearray(8)
+        recieved = 0
+        while recieved < size:
+            tcp_length = self.__recieve_tcp_top()
+            self.__recieve_into(memoryview(header))
+            response = unpack('<4H', header)[0]
+            length = tcp_length - 8
+            if response != const.CMD_DATA:
+                if self.verbose: print ("incorrect response!!! {}".format(response))
+                if length:
+                    self.__recieve_into(memoryview(bytearray(length)))
+                return None
+            if self.verbose: print ("tcp DATA packet of {} bytes, still need {}".format(length, size - recieved))
+            count = min(length, size - recieved)
+            self.__recieve_into(into[recieved:recieved + count])
+            if length > count:
+                if self.verbose: print ("discarding {} extra bytes".format(length - count))
+                self.__recieve_into(memoryview(bytearray(length - count)))
+            recieved += count
+        packet = self.__recieve_tcp_packet()
+        response = unpack('<4H', packet[:8])[0]
+        if response == const.CMD_ACK_OK:
+            if self.verbose: print ("chunk tcp ACK OK!")
+            return into
+        if self.verbose: print ("bad response %s" % response)
+        return None
+
+    def __recieve_udp_chunk(self, into):
+        """
+        recieve the CMD_DATA packets that follow a CMD_PREPARE_DATA into the
+        buffer, until the final CMD_ACK_OK
+
+        :return: the filled part of into
+        """
+        size = len(into)
+        packet = bytearray(1024 + 8)
+        payload = memoryview(packet)[8:]
+        recieved = 0
+        while True:
+            count = self.__sock.recv_into(packet)
+            self.bytes_received += count
+            response = unpack('<4H', packet[:8])[0]
+            if self.verbose: print ("# packet response is: {}".format(response))
             if response == const.CMD_DATA:
-                resp = data_recv[16 : size + 16]
-                if self.verbose: print ("resp complete len {}".format(len(resp)))
-                return resp, data_recv[size + 16:]
+                count = min(count - 8, size - recieved)
+                into[recieved:recieved + count] = payload[:count]
+                recieved += count
+            elif response == const.CMD_ACK_OK:
+                break
             else:
-                if self.verbose: print("incorrect response!!! {}".format(response))
-                return None, b""
-        else:
-            if self.verbose: print ("try DATA incomplete (actual valid {})".format(recieved-16))
-            data.append(data_recv[16 : size + 16 ])
-            size -= recieved - 16
-            broken_header = b""
-            if size < 0:
-                broken_header = data_recv[size:]
-                if self.verbose: print ("broken", (broken_header).encode('hex'))
-            if size > 0:
-                data_recv = self.__recieve_raw_data(size)
-                data.append(data_recv)
-            return b''.join(data), broken_header
-
-    def __recieve_raw_data(self, size):
-        """ partial data ? """
-        data = []
-        if self.verbose: print ("expecting {} bytes raw data".format(size))
-        while size > 0:
-            data_recv = self.__sock.recv(size)
-            recieved = len(data_recv)
-            if self.verbose: print ("partial recv {}".format(recieved))
-            if recieved < 100 and self.verbose: print ("   recv {}".format(codecs.encode(data_recv, 'hex')))
-            data.append(data_recv)
-            size -= recieved
-            if self.verbose: print ("still need {}".format(size))
-        return b''.join(data)
-
-    def __recieve_chunk(self):
-        """ recieve a chunk """
+                if self.verbose: print ("broken!")
+                break
+            if self.verbose: print ("still needs %s" % (size - recieved))
+        return into[:recieved]
+
+    def __recieve_chunk(self, into=None):
+        """ recieve a chunk
+
+        :param into: writable memoryview to fill instead of a new buffer
+        :return: the chunk data, or None
+        """
         if self.__response == const.CMD_DATA:
-            if self.tcp:
-                if self.verbose: print ("_rc_DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data])
-                else:
-                    if self.verbose: print ("Enough data")
-                    return self.__data
-            else:
-                if self.verbose: print ("_rc len is {}".format(len(self.__data)))
+            # __send_command already read the whole packet
+            if self.verbose: print ("_rc_DATA! is {} bytes".format(len(self.__data)))
+            if into is None:
                 return self.__data
+            if len(self.__data) != len(into):
+                if self.verbose: print ("unexpected chunk size {} /{}".format(len(self.__data), len(into)))
+                return None
+            into[:] = self.__data
+            return into
         elif self.__response == const.CMD_PREPARE_DATA:
-            data = []
             size = self.__get_data_size()
             if self.verbose: print ("recieve chunk: prepare data size is {}".format(size))
+            if into is None:
+                data = bytearray(size)
+                view = memoryview(data)
+            elif size == len(into):
+                data = view = into
+            else:
+                if self.verbose: print ("unexpected chunk size {} /{}".format(size, len(into)))
+                data = None
+                view = memoryview(bytearray(size))
             if self.tcp:
-                if len(self.__data) >= (8 + size):
-                    data_recv = self.__data[8:]
-                else:
-                    data_recv = self.__data[8:] + self.__sock.recv(size + 32)
-                resp, broken_header = self.__recieve_tcp_data(data_recv, size)
-                data.append(resp)
-                # get CMD_ACK_OK
-                if len(broken_header) < 16:
-                    data_recv = broken_header + self.__sock.recv(16)
-                else:
-                    data_recv = broken_header
-                if len(data_recv) < 16:
-                    print ("trying to complete broken ACK %s /16" % len(data_recv))
-                    if self.verbose: print (data_recv.encode('hex'))
-                    data_recv += self.__sock.recv(16 - len(data_recv)) #TODO: CHECK HERE_!
-                if not self.__test_tcp_top(data_recv):
-                    if self.verbose: print ("invalid chunk tcp ACK OK")
-                    return None
-                response = unpack('HHHH', data_recv[8:16])[0]
-                if response == const.CMD_ACK_OK:
-                    if self.verbose: print ("chunk tcp ACK OK!")
-                    return b''.join(data)
-                if self.verbose: print("bad response %s" % data_recv)
-                if self.verbose: print (codecs.encode(data,'hex'))
+                view = self.__recieve_tcp_chunk(view)
+            else:
+                view = self.__recieve_udp_chunk(view)
+            if view is None or data is None:
                 return None
-
-                return resp
-            while True:
-                data_recv = self.__sock.recv(1024+8)
-                response = unpack('<4H', data_recv[:8])[0]
-                if self.verbose: print ("# packet response is: {}".format(response))
-                if response == const.CMD_DATA:
-                    data.append(data_recv[8:])
-                    size -= 1024
-                elif response == const.CMD_ACK_OK:
-                    break
-                else:
-                    if self.verbose: print ("broken!")
-                    break
-                if self.verbose: print ("still needs %s" % size)
-            return b''.join(data)
+            if len(view) < size:
+                if into is not None:
+                    # udp datagrams lost on the way, read the chunk again
+                    if self.verbose: print ("incomplete chunk {} /{}".format(len(view), size))
+                    return None
+                return data[:len(view)]
+            return data
         else:
             if self.verbose: print ("invalid response %s" % self.__response)
             return None
 
-    def __read_chunk(self, start, size):
+    def __read_chunk(self, start, size, into=None):
         """
         read a chunk from buffer
+
+        :param into: writable memoryview to fill instead of a new buffer
         """
         for _retries in range(3):
             command = const._CMD_READ_BUFFER
-            command_string = pack('<ii', start, size)
+            command_string = protocol.encode_read_buffer(start, size)
             if self.tcp:
                 response_size = size + 32
             else:
                 response_size = 1024 + 8
-            cmd_response = self.__send_command(command, command_string, response_size)
-            data = self.__recieve_chunk()
+            try:
+                cmd_response = self.__send_command(command, command_string, response_size)
+                data = self.__recieve_chunk(into)
+            except (timeout, ZKNetworkError):
+                if self.tcp:
+                    raise
+                if self.verbose: print ("chunk {}:[{}] timed out, retrying".format(start, size))
+                self.__drain_udp()
+                continue
             if data is not None:
                 return data
+            if not self.tcp:
+                self.__drain_udp()
         else:
             raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, size))
 
-    def read_with_buffer(self, command, fct=0 ,ext=0):
+    def __drain_udp(self, wait=0.2):
         """
-        Test read info with buffered command (ZK6: 1503)
+        discard the late datagrams of a failed udp exchange, so they are not
+        taken as the answer of the next command
         """
-        if self.tcp:
-            MAX_CHUNK = 0xFFc0
-        else:
-            MAX_CHUNK = 16 * 1024
-        command_string = pack('<bhii', 1, command, fct, ext)
+        self.__sock.settimeout(min(wait, self.__timeout))
+        try:
+            while True:
+                self.bytes_received += len(self.__sock.recv(1024 + 8))
+        except (timeout, OSError):
+            pass
+        finally:
+            self.__sock.settimeout(self.__timeout)
+
+    def __read_chunks_pipelined(self, view, ranges, on_chunk=None, base=0):
+        """
+        read buffer chunks keeping up to read_window _CMD_READ_BUFFER
+        requests in flight; the responses come back in request order and are
+        matched to their range by reply id. Ranges that fail are requested
+        again. If the device stops answering, the window is disabled
+        (read_window = 1) and ZKNetworkError is raised: the responses still
+        in flight could arrive later and be taken as the answer of another
+        range, so the caller has to reconnect before reading again
+
+        :param view: writable memoryview of the whole buffer
+        :param ranges: list of (start, size)
+        :param on_chunk: called with (start, data) for every chunk read
+        :param base: buffer offset of view[0], when view holds only the ranges
+        """
+        pending = deque(ranges)
+        in_flight = deque()
+        retries = {}
+        reply_id = self.__reply_id
+        while pending or in_flight:
+            while pending and len(in_flight) < self.read_window:
+                start, size = pending.popleft()
+                buf = self.__create_header(const._CMD_READ_BUFFER, protocol.encode_read_buffer(start, size), self.__session_id, reply_id)
+                reply_id = unpack('<4H', buf[:8])[3]
+                try:
+                    self.__sock.send(self.__create_tcp_top(buf))
+                except Exception as e:
+                    raise ZKNetworkError(str(e))
+                in_flight.append((reply_id, start, size))
+            try:
+                packet = self.__recieve_tcp_packet()
+            except timeout:
+                if self.verbose: print ("read window timeout, {} chunks missing".format(len(in_flight) + len(pending)))
+                self.read_window = 1
+                raise ZKNetworkError("read window timeout, %i chunks missing" % (len(in_flight) + len(pending)))
+            response, _checksum, _session, answer_id = unpack('<4H', packet[:8])
+            if not any(reply == answer_id for reply, _start, _size in in_flight):
+                answer_id = in_flight[0][0] # no echo, trust the order
+            while in_flight[0][0] != answer_id:
+                # the device skipped this request
+                _reply, start, size = in_flight.popleft()
+                pending.append((start, size))
+            _reply, start, size = in_flight.popleft()
+            self.__reply_id = answer_id
+            into = view[start - base:start - base + size]
+            data = None
+            if response == const.CMD_PREPARE_DATA:
+                announced = unpack('<I', packet[8:12])[0]
+                if announced == size:
+                    data = self.__recieve_tcp_chunk(into)
+                else:
+                    self.__recieve_tcp_chunk(memoryview(bytearray(announced)))
+            elif response == const.CMD_DATA and len(packet) - 8 == size:
+                into[:] = memoryview(packet)[8:]
+                data = into
+            if data is not None:
+                if on_chunk: on_chunk(start, data)
+            else:
+                retries[start] = retries.get(start, 0) + 1
+                if retries[start] >= 3:
+                    raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, size))
+                if self.verbose: print ("retry chunk {}:[{}]".format(start, size))
+                pending.append((start, size))
+        self.__reply_id = reply_id
+
+    def __prepare_buffer(self, command, fct=0, ext=0):
+        """
+        ask the device to prepare a buffered read (ZK6: 1503)
+
+        :return: (size, data), data is the whole buffer when the device sent
+            it right away, or None when it has to be read in chunks
+        """
+        command_string = protocol.encode_prepare_buffer(command, fct, ext)
         if self.verbose: print ("rwb cs", command_string)
         response_size = 1024
-        data = []
-        start = 0
         cmd_response = self.__send_command(const._CMD_PREPARE_BUFFER, command_string, response_size)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("RWB Not supported")
         if cmd_response['code'] == const.CMD_DATA:
-            if self.tcp:
-                if self.verbose: print ("DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data]), len(self.__data) + len(more_data)
-                else:
-                    if self.verbose: print ("Enough data")
-                    size = len(self.__data)
-                    return self.__data, size
-            else:
-                size = len(self.__data)
-                return self.__data, size
+            if self.verbose: print ("DATA! is {} bytes".format(len(self.__data)))
+            return len(self.__data), self.__data
         size = unpack('I', self.__data[1:5])[0]
         if self.verbose: print ("size fill be %i" % size)
-        remain = size % MAX_CHUNK
-        packets = (size-remain) // MAX_CHUNK # should be size /16k
-        if self.verbose: print ("rwb: #{} packets of max {} bytes, and extra {} bytes remain".format(packets, MAX_CHUNK, remain))
-        for _wlk in range(packets):
-            data.append(self.__read_chunk(start,MAX_CHUNK))
-            start += MAX_CHUNK
-        if remain:
-            data.append(self.__read_chunk(start, remain))
-            start += remain
+        return size, None
+
+    def __iter_chunks(self, start, size):
+        """
+        read a prepared buffer from start to size, yielding every group of
+        chunks (read_window chunks over tcp) as soon as it arrives
+
+        :return: iterator of memoryview, reused for the next group
+        """
+        if self.tcp:
+            MAX_CHUNK = protocol.TCP_MAX_CHUNK
+        else:
+            MAX_CHUNK = protocol.UDP_MAX_CHUNK
+        ranges = [(start + offset, chunk) for offset, chunk in protocol.buffer_ranges(size - start, MAX_CHUNK)]
+        window = self.read_window if self.tcp and self.read_window > 1 else 1
+        buf = memoryview(bytearray(MAX_CHUNK * min(window, len(ranges) or 1)))
+        for index in range(0, len(ranges), window):
+            group = ranges[index:index + window]
+            base = group[0][0]
+            view = buf[:sum(chunk for _offset, chunk in group)]
+            started = now()
+            if len(group) > 1:
+                self.__read_chunks_pipelined(view, group, base=base)
+            else:
+                self.__read_chunk(base, group[0][1], view)
+            self.__add_timing('transfer', started)
+            yield view
+
+    def read_with_buffer(self, command, fct=0 ,ext=0):
+        """
+        Test read info with buffered command (ZK6: 1503)
+
+        the chunks are recieved straight into one preallocated buffer
+
+        :return: (bytearray data, size)
+        """
+        if self.tcp:
+            MAX_CHUNK = protocol.TCP_MAX_CHUNK
+        else:
+            MAX_CHUNK = protocol.UDP_MAX_CHUNK
+        start = 0
+        size, data = self.__prepare_buffer(command, fct, ext)
+        if data is not None:
+            return data, size
+        data = bytearray(size)
+        view = memoryview(data)
+        if self.verbose: print ("rwb: {} bytes in chunks of max {} bytes".format(size, MAX_CHUNK))
+        ranges = protocol.buffer_ranges(size, MAX_CHUNK)
+        spool = None
+        on_chunk = None
+        if self.spool_dir and len(ranges) > 1:
+            key = self.__device_key()
+            if key is not None:
+                spool = Spool(self.spool_dir, '%s_%i_%i_%i' % (key, command, fct, ext), size,
+                              grows=(command == const.CMD_ATTLOG_RRQ))
+                resumed = spool.load(view)
+                if resumed:
+                    if self.verbose: print ("rwb: resuming, {} bytes from spool".format(resumed))
+                    self.resumed_bytes += resumed
+                    ranges = spool.missing(ranges)
+                on_chunk = spool.save
+        try:
+            if self.tcp and self.read_window > 1 and len(ranges) > 1:
+                self.__read_chunks_pipelined(view, ranges, on_chunk)
+            else:
+                for offset, chunk in ranges:
+                    chunk_data = self.__read_chunk(offset, chunk, view[offset:offset + chunk])
+                    if on_chunk: on_chunk(offset, chunk_data)
+        finally:
+            if spool is not None:
+                spool.close()
+        if spool is not None:
+            spool.discard()
+        start = size
         self.free_data()
         if self.verbose: print ("_read w/chunk %i bytes" % start)
-        return b''.join(data), start
+        return data, start
 
     def get_attendance(self):
         """
@@ -1603,64 +1757,242 @@ class ZK(object):
 
         :return: List of Attendance object
         """
+        return self.get_attendance_since()
+
+    def get_attendance_since(self, since=None, last=None):
+        """
+        return only the attendance records newer than a watermark
+
+        :param since: None (all records), datetime (records with a later
+            timestamp) or int (amount of records already read, i.e. the
+            value of self.records after the previous download)
+        :param last: self.last_record after the previous download; with an
+            int since, the records are read from the start when the record
+            at since - 1 is no longer that one (the log was cleared)
+        :return: List of Attendance object
+        """
+        attendance = self.__read_attendance(since, last)
+        if attendance is None:
+            return []
+        started = now()
+        attendances = self.__decode_attendance(*attendance)
+        self.__add_timing('parse', started)
+        return attendances
+
+    def get_attendance_batches(self, since=None, last=None, batch_size=1000):
+        """
+        download the attendance records newer than a watermark, and decode
+        them lazily in batches: only the raw buffer is kept in memory, and
+        the connection is not used any more once this returns, so the
+        device can be released before the records are processed
+
+        :param since: same as get_attendance_since
+        :param last: same as get_attendance_since
+        :param batch_size: records per batch
+        :return: iterator of lists of Attendance object
+        """
+        attendance = self.__read_attendance(since, last)
+        if attendance is None:
+            return iter(())
+        attendance_data, record_size, users, since_time = attendance
+        by_uid, by_user_id = self.__index_users(users)
+        return protocol.iter_attendance_batches(attendance_data, record_size, by_uid, by_user_id, since_time, batch_size)
+
+    def get_attendance_columns(self, since=None, last=None):
+        """
+        return the attendance records as columns (see decoder.attendance_columns)
+        instead of a list of Attendance objects
+
+        :param since: same as get_attendance_since
+        :param last: same as get_attendance_since
+        :return: dict of arrays/lists
+        """
+        attendance = self.__read_attendance(since, last)
+        if attendance is None:
+            return decoder.attendance_columns(b'', 8)
+        attendance_data, record_size, users, since_time = attendance
+        since_epoch = timegm(since_time.timetuple()) if since_time is not None else None
+        by_uid, by_user_id = self.__index_users(users)
+        user_ids = dict((uid, user.user_id) for uid, user in by_uid.items())
+        uids = dict((user_id, user.uid) for user_id, user in by_user_id.items())
+        started = now()
+        columns = decoder.attendance_columns(attendance_data, record_size, since_epoch, user_ids, uids)
+        self.__add_timing('parse', started)
+        return columns
+
+    def __read_attendance(self, since=None, last=None):
+        """
+        download the attendance buffer, skipping the transfer when there are
+        no records newer than the watermark
+
+        :return: (records data, record size, users, since_time) or None
+        """
+        self.last_record = None
+        started = now()
         self.read_sizes()
+        self.__add_timing('read_sizes', started)
         if self.records == 0:
-            return []
+            return None
+        start, since_time, check = protocol.attendance_start(self.records, since, last)
+        if start is None:
+            if self.verbose: print ("no new records since {}".format(since))
+            return None
+        started = now()
         users = self.get_users()
+        self.__add_timing('users', started)
         if self.verbose: print (users)
-        attendances = []
+        by_uid, by_user_id = self.__index_users(users)
+        if check and start == self.records:
+            # nothing new, unless the log was cleared: read only the last record
+            started = now()
+            size, data = self.__prepare_buffer(const.CMD_ATTLOG_RRQ)
+            try:
+                key = self.__attendance_key_at(start - 1, size, data, by_uid, by_user_id)
+            finally:
+                if data is None:
+                    self.free_data()
+            self.__add_timing('transfer', started)
+            if key == tuple(last):
+                if self.verbose: print ("no new records since {}".format(since))
+                self.last_record = key
+                return None
+            start = 0
+        started = now()
         attendance_data, size = self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        self.__add_timing('transfer', started)
         if size < 4:
             if self.verbose: print ("WRN: no attendance data")
-            return []
-        total_size = unpack("I", attendance_data[:4])[0]
-        record_size = total_size // self.records
+            return None
+        if check and start:
+            if self.__attendance_key_at(start - 1, size, attendance_data, by_uid, by_user_id) != tuple(last):
+                if self.verbose: print ("the log was cleared, reading it from the start")
+                start = 0
+        self.last_record = self.__attendance_key_at(self.records - 1, size, attendance_data, by_uid, by_user_id)
+        attendance_data, record_size = protocol.split_attendance(attendance_data, self.records, start)
         if self.verbose: print ("record_size is ", record_size)
-        attendance_data = attendance_data[4:]
-        if record_size == 8:
-            while len(attendance_data) >= 8:
-                uid, status, timestamp, punch = unpack('HB4sB', attendance_data.ljust(8, b'\x00')[:8])
-                if self.verbose: print (codecs.encode(attendance_data[:8], 'hex'))
-                attendance_data = attendance_data[8:]
-                tuser = list(filter(lambda x: x.uid == uid, users))
-                if not tuser:
-                    user_id = str(uid)
-                else:
-                    user_id = tuser[0].user_id
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-        elif record_size == 16:
-            while len(attendance_data) >= 16:
-                user_id, timestamp, status, punch, reserved, workcode = unpack('<I4sBB2sI', attendance_data.ljust(16, b'\x00')[:16])
-                user_id = str(user_id)
-                if self.verbose: print(codecs.encode(attendance_data[:16], 'hex'))
-                attendance_data = attendance_data[16:]
-                tuser = list(filter(lambda x: x.user_id == user_id, users))
-                if not tuser:
-                    if self.verbose: print("no uid {}", user_id)
-                    uid = str(user_id)
-                    tuser = list(filter(lambda x: x.uid == user_id, users))
-                    if not tuser:
-                        uid = str(user_id)
-                    else:
-                        uid = tuser[0].uid
-                        user_id = tuser[0].user_id
-                else:
-                    uid = tuser[0].uid
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
+        return attendance_data, record_size, users, since_time
+
+    def __attendance_key_at(self, index, size, data, by_uid, by_user_id):
+        """
+        :param size: size of the prepared attendance buffer
+        :param data: the whole buffer, or None to read only that record
+            from the device
+        :return: protocol.attendance_key of the record at index
+        """
+        if data is not None:
+            records, record_size = protocol.split_attendance(data, self.records)
+            record = records[index * record_size:(index + 1) * record_size]
+        else:
+            record_size = (size - 4) // self.records
+            record = self.__read_chunk(4 + index * record_size, record_size)
+        return protocol.attendance_key(record, record_size, by_uid, by_user_id)
+
+    def iter_attendance(self, since=None, batch_size=None, last=None):
+        """
+        iterate the attendance records while the buffer is downloaded, so the
+        memory used does not depend on the size of the log: only one group of
+        chunks and the records decoded from it are kept at a time. The
+        buffer is read from the first record newer than since, when since
+        is an amount of records.
+
+        :param since: same as get_attendance_since
+        :param batch_size: yield lists of up to batch_size records instead of
+            single records
+        :param last: same as get_attendance_since
+        :return: iterator of Attendance object (or of lists of them)
+        """
+        self.last_record = None
+        started = now()
+        self.read_sizes()
+        self.__add_timing('read_sizes', started)
+        if self.records == 0:
+            return
+        start, since_time, check = protocol.attendance_start(self.records, since, last)
+        if start is None:
+            if self.verbose: print ("no new records since {}".format(since))
+            return
+        started = now()
+        users = self.get_users()
+        self.__add_timing('users', started)
+        by_uid, by_user_id = self.__index_users(users)
+        started = now()
+        size, data = self.__prepare_buffer(const.CMD_ATTLOG_RRQ)
+        if size < 4:
+            if self.verbose: print ("WRN: no attendance data")
+            return
+        if check:
+            try:
+                key = self.__attendance_key_at(start - 1, size, data, by_uid, by_user_id)
+            except Exception:
+                if data is None:
+                    self.free_data()
+                raise
+            if key != tuple(last):
+                if self.verbose: print ("the log was cleared, reading it from the start")
+                start = 0
+            elif start == self.records:
+                if self.verbose: print ("no new records since {}".format(since))
+                self.last_record = key
+                if data is None:
+                    self.free_data()
+                return
+        self.__add_timing('transfer', started)
+        if data is not None:
+            records, record_size = protocol.split_attendance(data, self.records, start)
+            chunks = [records]
         else:
-            while len(attendance_data) >= 40:
-                uid, user_id, status, timestamp, punch, space = unpack('<H24sB4sB8s', attendance_data.ljust(40, b'\x00')[:40])
-                if self.verbose: print (codecs.encode(attendance_data[:40], 'hex'))
-                user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                timestamp = self.__decode_time(timestamp)
-
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-                attendance_data = attendance_data[record_size:]
+            record_size = (size - 4) // self.records
+            chunks = self.__iter_chunks(min(size, 4 + start * record_size), size)
+        if self.verbose: print ("record_size is ", record_size)
+        if record_size < 8:
+            raise ZKErrorResponse("invalid attendance record size %i" % record_size)
+        batch = []
+        pending = b''
+        last_raw = None
+        try:
+            for chunk in chunks:
+                started = now()
+                if pending:
+                    chunk = pending + chunk
+                usable = len(chunk) - len(chunk) % record_size
+                records = protocol.decode_attendance(chunk[:usable], record_size, by_uid, by_user_id, since_time)
+                pending = bytes(chunk[usable:])
+                if usable:
+                    last_raw = bytes(chunk[usable - record_size:usable])
+                self.__add_timing('parse', started)
+                if batch_size is None:
+                    for record in records:
+                        yield record
+                    continue
+                batch.extend(records)
+                while len(batch) >= batch_size:
+                    yield batch[:batch_size]
+                    batch = batch[batch_size:]
+            if last_raw is not None:
+                self.last_record = protocol.attendance_key(last_raw, record_size, by_uid, by_user_id)
+            if batch:
+                yield batch
+        except GeneratorExit:
+            if data is None:
+                self.free_data()
+            raise
+        if data is None:
+            self.free_data()
+
+    def __add_timing(self, name, started):
+        """
+        add the seconds elapsed since started to self.timings[name]; the
+        caller clears self.timings when it wants a new measure
+        """
+        self.timings[name] = self.timings.get(name, 0) + now() - started
+
+    def __decode_attendance(self, attendance_data, record_size, users, since_time=None):
+        """
+        decode raw attendance records, skipping the ones not newer than since_time
+        """
+        by_uid, by_user_id = self.__index_users(users)
+        attendances = protocol.decode_attendance(attendance_data, record_size, by_uid, by_user_id, since_time)
+        if self.verbose: print (attendances)
         return attendances
 
     def clear_attendance(self):
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+bulk decoders for the raw buffers downloaded from the device
+"""
+from array import array
+from calendar import timegm
+from datetime import datetime, timedelta
+from struct import Struct
+
+ATT_RECORD_8 = Struct('<HBIB')          # uid, status, time, punch
+ATT_RECORD_16 = Struct('<IIBB2xI')      # user_id, time, status, punch, (reserved), workcode
+ATT_RECORD_40 = Struct('<H24sBIB8x')    # uid, user_id, status, time, punch, (space)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class TimeDecoder(object):
+    """
+    decode packed timestamps (zkemsdk.c - DecodeTime) using arithmetic on
+    the whole day number, so the date part is built once per distinct day
+    """
+
+    def __init__(self):
+        self._days = {}
+
+    def _day(self, day):
+        base = self._days.get(day)
+        if base is None:
+            date = datetime(day // 372 + 2000, day // 31 % 12 + 1, day % 31 + 1)
+            base = self._days[day] = (date, timegm(date.timetuple()))
+        return base
+
+    def to_datetime(self, t):
+        """
+        :return: datetime of a packed timestamp
+        """
+        day, seconds = divmod(t, SECONDS_PER_DAY)
+        return self._day(day)[0] + timedelta(seconds=seconds)
+
+    def to_epoch(self, t):
+        """
+        :return: seconds since 1970-01-01 of the (naive, device local) timestamp
+        """
+        day, seconds = divmod(t, SECONDS_PER_DAY)
+        return self._day(day)[1] + seconds
+
+
+def decode_times(times):
+    """
+    decode a sequence of packed timestamps
+
+    :return: list of datetime
+    """
+    decoder = TimeDecoder()
+    return [decoder.to_datetime(t) for t in times]
+
+
+def iter_attendance_records(data, record_size):
+    """
+    iterate the raw attendance records of a buffer without copying it
+
+    :param data: bytes-like buffer, starting at the first record
+    :param record_size: 8, 16 or 40 (or bigger, only the first 40 bytes are used)
+    :return: iterator of (uid, user_id, time, status, punch); uid is None
+        for 16 byte records, user_id is None for 8 byte records, an int for
+        16 byte records and the raw 24 bytes for 40 byte records
+    """
+    view = memoryview(data)
+    if record_size == 8:
+        view = view[:len(view) - len(view) % 8]
+        for uid, status, t, punch in ATT_RECORD_8.iter_unpack(view):
+            yield uid, None, t, status, punch
+    elif record_size == 16:
+        view = view[:len(view) - len(view) % 16]
+        for user_id, t, status, punch, _workcode in ATT_RECORD_16.iter_unpack(view):
+            yield None, user_id, t, status, punch
+    elif record_size == ATT_RECORD_40.size:
+        view = view[:len(view) - len(view) % 40]
+        for uid, user_id, status, t, punch in ATT_RECORD_40.iter_unpack(view):
+            yield uid, user_id, t, status, punch
+    else:
+        offset = 0
+        while len(view) - offset >= ATT_RECORD_40.size:
+            uid, user_id, status, t, punch = ATT_RECORD_40.unpack_from(view, offset)
+            offset += record_size
+            yield uid, user_id, t, status, punch
+
+
+def decode_user_id(raw):
+    """
+    decode a zero padded user_id field
+    """
+    return (raw.split(b'\x00')[0]).decode(errors='ignore')
+
+
+def attendance_columns(data, record_size, since_epoch=None, user_ids=None, uids=None):
+    """
+    decode attendance records into columns instead of Attendance objects
+
+    :param since_epoch: only keep records with a later timestamp
+    :param user_ids: dict uid -> user_id, used for 8 byte records
+    :param uids: dict user_id -> uid, used for 16 byte records
+    :return: dict of 'uid' (array), 'user_id' (list of str),
+        'timestamp' (array of seconds since 1970, device local time),
+        'status' (array) and 'punch' (array)
+    """
+    user_ids = user_ids or {}
+    uids = uids or {}
+    times = TimeDecoder()
+    columns = {
+        'uid': array('l'),
+        'user_id': [],
+        'timestamp': array('q'),
+        'status': array('B'),
+        'punch': array('B'),
+    }
+    for uid, user_id, t, status, punch in iter_attendance_records(data, record_size):
+        epoch = times.to_epoch(t)
+        if since_epoch is not None and epoch <= since_epoch:
+            continue
+        if user_id is None:
+            user_id = user_ids.get(uid, str(uid))
+        elif uid is None:
+            user_id = str(user_id)
+            uid = uids.get(user_id, int(user_id))
+        else:
+            user_id = decode_user_id(user_id)
+        columns['uid'].append(uid)
+        columns['user_id'].append(user_id)
+        columns['timestamp'].append(epoch)
+        columns['status'].append(status)
+        columns['punch'].append(punch)
+    return columns
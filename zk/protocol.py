@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+encoding and decoding of the ZK protocol packets, without any I/O; shared
+by the blocking client (base.ZK) and the asyncio client (aio.AsyncZK)
+"""
+from datetime import datetime
+from struct import pack, unpack
+
+from . import const, decoder
+from .attendance import Attendance
+from .exception import ZKErrorResponse, ZKNetworkError
+from .user import User
+
+TCP_MAX_CHUNK = 0xFFc0
+UDP_MAX_CHUNK = 16 * 1024
+
+
+def create_checksum(buf):
+    """
+    Calculates the checksum of a packet (zkemsdk.c), summing all the 16 bit
+    words at once; the running "subtract USHRT_MAX on overflow" of the
+    original loop is the same as reducing the total modulo USHRT_MAX into
+    the range 1..USHRT_MAX (0 only for an all zero packet)
+
+    :param buf: bytes-like packet
+    :return: int checksum
+    """
+    size = len(buf)
+    even = size - size % 2
+    total = sum(memoryview(buf).cast('B')[:even].cast('H')) if even else 0
+    if size % 2:
+        total += buf[-1]
+    if total:
+        total = (total - 1) % const.USHRT_MAX + 1
+    if total < const.USHRT_MAX:
+        return const.USHRT_MAX - 1 - total
+    return const.USHRT_MAX - 1
+
+
+def make_commkey(key, session_id, ticks=50):
+    """
+    take a password and session_id and scramble them to send to the machine.
+    copied from commpro.c - MakeKey
+    """
+    key = int(key)
+    session_id = int(session_id)
+    k = 0
+    for i in range(32):
+        if (key & (1 << i)):
+            k = (k << 1 | 1)
+        else:
+            k = k << 1
+    k += session_id
+
+    k = pack(b'I', k)
+    k = unpack(b'BBBB', k)
+    k = pack(
+        b'BBBB',
+        k[0] ^ ord('Z'),
+        k[1] ^ ord('K'),
+        k[2] ^ ord('S'),
+        k[3] ^ ord('O'))
+    k = unpack(b'HH', k)
+    k = pack(b'HH', k[1], k[0])
+
+    B = 0xff & ticks
+    k = unpack(b'BBBB', k)
+    k = pack(
+        b'BBBB',
+        k[0] ^ B,
+        k[1] ^ B,
+        B,
+        k[3] ^ B)
+    return k
+
+
+def create_header(command, command_string, session_id, reply_id):
+    """
+    Puts a the parts that make up a packet together and packs them into a byte string
+
+    :return: the packet, with the next reply id
+    """
+    buf = pack('<4H', command, 0, session_id, reply_id) + command_string
+    checksum = create_checksum(buf)
+    reply_id += 1
+    if reply_id >= const.USHRT_MAX:
+        reply_id -= const.USHRT_MAX
+
+    buf = pack('<4H', command, checksum, session_id, reply_id)
+    return buf + command_string
+
+
+def create_tcp_top(packet):
+    """
+    witch the complete packet set top header
+    """
+    length = len(packet)
+    top = pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, length)
+    return top + packet
+
+
+def parse_tcp_top(top):
+    """
+    :param top: the 8 bytes before every tcp packet
+    :return: length of the packet that follows
+    """
+    tcp_header = unpack('<HHI', top)
+    if tcp_header[0] != const.MACHINE_PREPARE_DATA_1 or tcp_header[1] != const.MACHINE_PREPARE_DATA_2 or tcp_header[2] < 8:
+        raise ZKNetworkError("TCP packet invalid")
+    return tcp_header[2]
+
+
+def encode_prepare_buffer(command, fct=0, ext=0):
+    """
+    :return: the _CMD_PREPARE_BUFFER command string to read a buffer
+    """
+    return pack('<bhii', 1, command, fct, ext)
+
+
+def encode_read_buffer(start, size):
+    """
+    :return: the _CMD_READ_BUFFER command string of a chunk
+    """
+    return pack('<ii', start, size)
+
+
+def buffer_ranges(size, max_chunk):
+    """
+    :return: list of (start, size) chunks that make up a buffer
+    """
+    return [(offset, min(max_chunk, size - offset)) for offset in range(0, size, max_chunk)]
+
+
+def parse_header(packet):
+    """
+    :return: (command, checksum, session_id, reply_id) of a packet
+    """
+    return unpack('<4H', packet[:8])
+
+
+def decode_time(t):
+    """
+    Decode a timestamp retrieved from the timeclock
+
+    copied from zkemsdk.c - DecodeTime
+    """
+    return decoder.TimeDecoder().to_datetime(unpack("<I", t)[0])
+
+
+def encode_time(t):
+    """
+    Encode a timestamp so that it can be read on the timeclock
+
+    formula taken from zkemsdk.c - EncodeTime
+    """
+    return (
+        ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
+        (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
+    )
+
+
+def encode_timehex(t):
+    """
+    timehex string of six bytes (live events)
+    """
+    return pack("6B", t.year - 2000, t.month, t.day, t.hour, t.minute, t.second)
+
+
+def decode_timehex(timehex):
+    """
+    timehex string of six bytes
+    """
+    year, month, day, hour, minute, second = unpack("6B", timehex)
+    year += 2000
+    d = datetime(year, month, day, hour, minute, second)
+    return d
+
+
+def decode_sizes(data):
+    """
+    decode the CMD_GET_FREE_SIZES response
+
+    :return: dict with the counters present in the response
+    """
+    sizes = {}
+    if len(data) >= 80:
+        fields = unpack('20i', data[:80])
+        sizes.update(
+            users=fields[4],
+            fingers=fields[6],
+            records=fields[8],
+            dummy=fields[10], #???
+            cards=fields[12],
+            fingers_cap=fields[14],
+            users_cap=fields[15],
+            rec_cap=fields[16],
+            fingers_av=fields[17],
+            users_av=fields[18],
+            rec_av=fields[19])
+        data = data[80:]
+    if len(data) >= 12: #face info
+        fields = unpack('3i', data[:12]) #dirty hack! we need more information
+        sizes.update(faces=fields[0], faces_cap=fields[2])
+    return sizes
+
+
+def decode_users(userdata, user_packet_size, encoding):
+    """
+    decode the user table (without the 4 bytes total size)
+
+    :param user_packet_size: 28 (zk6) or 72 (zk8)
+    :return: list of User object
+    """
+    users = []
+    if user_packet_size == 28:
+        while len(userdata) >= 28:
+            uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI',userdata.ljust(28, b'\x00')[:28])
+            password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            group_id = str(group_id)
+            user_id = str(user_id)
+            #TODO: check card value and find in ver8
+            if not name:
+                name = "NN-%s" % user_id
+            users.append(User(uid, name, privilege, password, group_id, user_id, card))
+            userdata = userdata[28:]
+    else:
+        while len(userdata) >= 72:
+            uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata.ljust(72, b'\x00')[:72])
+            password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            group_id = (group_id.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            user_id = (user_id.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            if not name:
+                name = "NN-%s" % user_id
+            users.append(User(uid, name, privilege, password, group_id, user_id, card))
+            userdata = userdata[72:]
+    return users
+
+
+def index_users(users):
+    """
+    index users by uid and by user_id (first match, like a linear search)
+
+    :return: (dict uid -> User, dict user_id -> User)
+    """
+    by_uid = {}
+    by_user_id = {}
+    for user in users:
+        by_uid.setdefault(user.uid, user)
+        by_user_id.setdefault(user.user_id, user)
+    return by_uid, by_user_id
+
+
+def next_user_ids(users, by_user_id):
+    """
+    :return: (next free uid, next free user_id)
+    """
+    max_uid = max([user.uid for user in users] or [0]) + 1
+    next_uid = max_uid
+    next_user_id = str(max_uid)
+    while next_user_id in by_user_id:
+        max_uid += 1
+        next_user_id = str(max_uid)
+    return next_uid, next_user_id
+
+
+def attendance_start(records, since=None, last=None):
+    """
+    first record to download for a watermark
+
+    :param records: amount of records in the device log (read_sizes)
+    :param since: None (all records), datetime (records with a later
+        timestamp) or int (amount of records already read)
+    :param last: attendance_key of the record at since - 1 when it was
+        read, to tell whether the log was cleared since then
+    :return: (index of the first record to read, since_time, check), or
+        (None, None, False) when there are no records newer than since;
+        with check the record before start has to match last, otherwise
+        the log was cleared and it has to be read from the start
+    """
+    if isinstance(since, datetime):
+        return 0, since, False
+    if since is None:
+        return 0, None, False
+    since = int(since)
+    if since > records or since <= 0:
+        # the log was cleared on the device, read it again from the start
+        return 0, None, False
+    if since == records and last is None:
+        return None, None, False
+    return since, None, last is not None
+
+
+def attendance_key(record, record_size, by_uid, by_user_id):
+    """
+    :param record: one raw attendance record
+    :return: (user_id, timestamp) of the record, to compare with a
+        watermark, or None if it can't be decoded
+    """
+    try:
+        attendances = decode_attendance(record, record_size, by_uid, by_user_id)
+    except Exception:
+        return None
+    if not attendances:
+        return None
+    return attendances[0].user_id, attendances[0].timestamp
+
+
+def split_attendance(attendance_data, records, start=0):
+    """
+    :param attendance_data: the CMD_ATTLOG_RRQ buffer, with its 4 bytes total size
+    :param records: amount of records in the buffer
+    :return: (memoryview of the records from index start, record size)
+    """
+    total_size = unpack("I", attendance_data[:4])[0]
+    record_size = total_size // records
+    return memoryview(attendance_data)[4 + start * record_size:], record_size
+
+
+def decode_attendance(attendance_data, record_size, by_uid, by_user_id, since_time=None):
+    """
+    decode raw attendance records, skipping the ones not newer than since_time
+
+    :return: list of Attendance object
+    """
+    attendances = []
+    times = decoder.TimeDecoder()
+    for uid, user_id, timestamp, status, punch in decoder.iter_attendance_records(attendance_data, record_size):
+        timestamp = times.to_datetime(timestamp)
+        if since_time is not None and timestamp <= since_time:
+            continue
+        if record_size == 8:
+            tuser = by_uid.get(uid)
+            if tuser is None:
+                user_id = str(uid)
+            else:
+                user_id = tuser.user_id
+        elif record_size == 16:
+            user_id = str(user_id)
+            tuser = by_user_id.get(user_id)
+            if tuser is None:
+                uid = str(user_id)
+            else:
+                uid = tuser.uid
+        else:
+            user_id = decoder.decode_user_id(user_id)
+        attendances.append(Attendance(user_id, timestamp, status, punch, uid))
+    return attendances
+
+
+def iter_attendance_batches(attendance_data, record_size, by_uid, by_user_id, since_time=None, batch_size=1000):
+    """
+    decode raw attendance records a batch at a time, so only one batch of
+    Attendance objects is kept in memory besides the raw buffer
+
+    :return: iterator of lists of up to batch_size Attendance object
+    """
+    step = max(1, batch_size) * record_size
+    for offset in range(0, len(attendance_data), step):
+        records = decode_attendance(attendance_data[offset:offset + step], record_size, by_uid, by_user_id, since_time)
+        if records:
+            yield records
+
+
+def decode_events(data, by_user_id):
+    """
+    decode the attendance events of a CMD_REG_EVENT packet
+
+    :return: list of Attendance object
+    """
+    events = []
+    while len(data) >= 10:
+        if len(data) == 10:
+            user_id, status, punch, timehex = unpack('<HBB6s', data)
+            data = data[10:]
+        elif len(data) == 12:
+            user_id, status, punch, timehex = unpack('<IBB6s', data)
+            data = data[12:]
+        elif len(data) == 14:
+            user_id, status, punch, timehex, _other = unpack('<HBB6s4s', data)
+            data = data[14:]
+        elif len(data) == 32:
+            user_id,  status, punch, timehex = unpack('<24sBB6s', data[:32])
+            data = data[32:]
+        elif len(data) == 36:
+            user_id,  status, punch, timehex, _other = unpack('<24sBB6s4s', data[:36])
+            data = data[36:]
+        elif len(data) == 37:
+            user_id,  status, punch, timehex, _other = unpack('<24sBB6s5s', data[:37])
+            data = data[37:]
+        elif len(data) >= 52:
+            user_id,  status, punch, timehex, _other = unpack('<24sBB6s20s', data[:52])
+            data = data[52:]
+        if isinstance(user_id, int):
+            user_id = str(user_id)
+        else:
+            user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
+        timestamp = decode_timehex(timehex)
+        tuser = by_user_id.get(user_id)
+        if tuser is None:
+            uid = int(user_id)
+        else:
+            uid = tuser.uid
+        events.append(Attendance(user_id, timestamp, status, punch, uid))
+    return events
+
+
+def encode_user(uid, name, privilege, password, group_id, user_id, card, user_packet_size, encoding):
+    """
+    :return: the CMD_USER_WRQ command string of a user
+    """
+    if user_packet_size == 28: #self.firmware == 6:
+        if not group_id:
+            group_id = 0
+        try:
+            return pack('HB5s8sIxBHI', uid, privilege, password.encode(encoding, errors='ignore'), name.encode(encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
+        except Exception:
+            raise ZKErrorResponse("Can't pack user")
+    name_pad = name.encode(encoding, errors='ignore').ljust(24, b'\x00')[:24]
+    card_str = pack('<I', int(card))[:4]
+    return pack('HB8s24s4sx7sx24s', uid, privilege, password.encode(encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
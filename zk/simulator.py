@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+"""
+ZK device simulator, to test and benchmark the clients without a real
+terminal: serves a synthetic set of users and attendance records over TCP
+and/or UDP, with optional latency and packet loss, and can push live
+attendance events (CMD_REG_EVENT)
+
+usage::
+
+    python -m zk.simulator --port 4370 --users 500 --records 100000 --latency 0.02
+
+or from python::
+
+    with ZKSimulator(SimulatedDevice(records=5000)) as sim:
+        conn = ZK('127.0.0.1', port=sim.port, ommit_ping=True).connect()
+"""
+import argparse
+import random
+import socketserver
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from struct import pack, unpack
+
+from . import const, decoder, protocol
+
+OPTIONS = {
+    '~SerialNumber': 'SIM0000001',
+    '~Platform': 'ZMM220_TFT',
+    '~DeviceName': 'ZK Simulator',
+    'MAC': '00:17:61:00:00:01',
+    '~ZKFPVersion': '10',
+    'ZKFaceVersion': '0',
+    '~ExtendFmt': '0',
+    '~UserExtFmt': '0',
+    'FaceFunOn': '0',
+    'CompatOldFirmware': '0',
+    'IPAddress': '127.0.0.1',
+    'NetMask': '255.255.255.0',
+    'GATEIPAddress': '0.0.0.0',
+}
+
+# commands answered with a plain CMD_ACK_OK
+ACK_COMMANDS = set([
+    const.CMD_ENABLEDEVICE, const.CMD_DISABLEDEVICE, const.CMD_REFRESHDATA,
+    const.CMD_CANCELCAPTURE, const.CMD_STARTVERIFY, const.CMD_TESTVOICE,
+    const.CMD_OPTIONS_WRQ, const.CMD_FREE_DATA,
+])
+
+UDP_DATA_SIZE = 1024
+
+
+def make_packet(command, session_id, reply_id, payload=b''):
+    """
+    :return: packet (without tcp top) with its checksum, echoing reply_id
+    """
+    buf = pack('<4H', command, 0, session_id, reply_id) + payload
+    checksum = protocol.create_checksum(buf)
+    return pack('<4H', command, checksum, session_id, reply_id) + payload
+
+
+class SimulatedDevice(object):
+    """
+    the data of a simulated terminal: users and attendance records, shared
+    by all the connections to the simulator
+    """
+
+    def __init__(self, users=100, records=1000, record_size=40, user_packet_size=72,
+                 password=0, serialnumber=None, start=None, seed=0, encoding='UTF-8'):
+        """
+        :param users: amount of synthetic users
+        :param records: amount of synthetic attendance records
+        :param record_size: attendance record format, 8, 16 or 40 bytes
+        :param user_packet_size: user record format, 28 (zk6) or 72 (zk8)
+        :param password: communication password (0: none)
+        :param serialnumber: serial number reported by the device
+        :param start: timestamp of the first record
+        :param seed: random seed of the synthetic data
+        """
+        if record_size not in (8, 16, 40):
+            raise ValueError("record_size must be 8, 16 or 40")
+        if user_packet_size not in (28, 72):
+            raise ValueError("user_packet_size must be 28 or 72")
+        self.lock = threading.RLock()
+        self.record_size = record_size
+        self.user_packet_size = user_packet_size
+        self.password = password
+        self.encoding = encoding
+        self.options = dict(OPTIONS)
+        if serialnumber:
+            self.options['~SerialNumber'] = serialnumber
+        self.time_offset = timedelta(0)
+        self.users = []     # (uid, name, privilege, password, group_id, user_id, card)
+        self.records = []   # (uid, user_id, timestamp, status, punch)
+        self.listeners = []
+        self.__buffers = {}
+        rnd = random.Random(seed)
+        for uid in range(1, users + 1):
+            self.users.append((uid, 'User %i' % uid, const.USER_DEFAULT, '', '1', str(1000 + uid), 0))
+        moment = start or datetime(2024, 1, 1, 7, 0, 0)
+        for _ in range(records):
+            uid, _name, _privilege, _password, _group_id, user_id, _card = rnd.choice(self.users)
+            moment += timedelta(seconds=rnd.randint(1, 300))
+            self.records.append((uid, user_id, moment, rnd.randint(0, 1), rnd.randint(0, 5)))
+
+    def __changed(self):
+        self.__buffers = {}
+
+    def now(self):
+        return datetime.now() + self.time_offset
+
+    def user_buffer(self):
+        with self.lock:
+            buf = self.__buffers.get('users')
+            if buf is None:
+                rows = [protocol.encode_user(uid, name, privilege, password, group_id, user_id, card,
+                                             self.user_packet_size, self.encoding)
+                        for uid, name, privilege, password, group_id, user_id, card in self.users]
+                data = b''.join(rows)
+                buf = self.__buffers['users'] = pack('<I', len(data)) + data
+            return buf
+
+    def attendance_buffer(self):
+        with self.lock:
+            buf = self.__buffers.get('attendance')
+            if buf is None:
+                rows = []
+                for uid, user_id, timestamp, status, punch in self.records:
+                    t = protocol.encode_time(timestamp)
+                    if self.record_size == 8:
+                        rows.append(decoder.ATT_RECORD_8.pack(uid, status, t, punch))
+                    elif self.record_size == 16:
+                        rows.append(decoder.ATT_RECORD_16.pack(int(user_id), t, status, punch, 0))
+                    else:
+                        rows.append(decoder.ATT_RECORD_40.pack(uid, user_id.encode(), status, t, punch))
+                data = b''.join(rows)
+                buf = self.__buffers['attendance'] = pack('<I', len(data)) + data
+            return buf
+
+    def sizes(self):
+        fields = [0] * 20
+        with self.lock:
+            fields[4] = len(self.users)
+            fields[8] = len(self.records)
+        fields[14] = 3000   # fingers_cap
+        fields[15] = 3000   # users_cap
+        fields[16] = 100000 # rec_cap
+        fields[17] = 3000
+        fields[18] = 3000 - fields[4]
+        fields[19] = 100000 - fields[8]
+        return pack('20i', *fields) + pack('3i', 0, 0, 0)
+
+    def set_user(self, data):
+        for user in protocol.decode_users(data, self.user_packet_size, self.encoding):
+            row = (user.uid, user.name, user.privilege, user.password, user.group_id, user.user_id, user.card)
+            with self.lock:
+                self.users = [u for u in self.users if u[0] != user.uid] + [row]
+                self.users.sort()
+                self.__changed()
+
+    def delete_user(self, uid):
+        with self.lock:
+            self.users = [u for u in self.users if u[0] != uid]
+            self.__changed()
+
+    def clear_attendance(self):
+        with self.lock:
+            self.records = []
+            self.__changed()
+
+    def clear_data(self):
+        with self.lock:
+            self.users = []
+            self.records = []
+            self.__changed()
+
+    def punch(self, user_id=None, timestamp=None, status=1, punch=0):
+        """
+        register an attendance, as if someone used the terminal: it is added
+        to the attendance log and sent to the connections capturing events
+
+        :return: the record (uid, user_id, timestamp, status, punch)
+        """
+        with self.lock:
+            if user_id is None:
+                uid, user_id = self.users[0][0], self.users[0][5]
+            else:
+                user_id = str(user_id)
+                uid = next((u[0] for u in self.users if u[5] == user_id), 0)
+            record = (uid, user_id, timestamp or self.now().replace(microsecond=0), status, punch)
+            self.records.append(record)
+            self.__changed()
+            listeners = list(self.listeners)
+        event = pack('<24sBB6s', user_id.encode(), status, punch, protocol.encode_timehex(record[2]))
+        for listener in listeners:
+            listener(event)
+        return record
+
+
+class _Session(object):
+    """
+    state of one client (tcp connection or udp address) and the command
+    handling, independent of the transport
+    """
+
+    def __init__(self, device, session_id, send_event, data_size=None):
+        """
+        :param send_event: function that sends an event payload to the client
+        :param data_size: max payload of every CMD_DATA packet (None: one packet)
+        """
+        self.device = device
+        self.session_id = session_id
+        self.send_event = send_event
+        self.data_size = data_size
+        self.authenticated = not device.password
+        self.buffer = b''
+        self.listener = None
+
+    def handle(self, command, data):
+        """
+        :return: list of (command, payload) to answer
+        """
+        device = self.device
+        if command == const.CMD_CONNECT:
+            if self.authenticated:
+                return [(const.CMD_ACK_OK, b'')]
+            return [(const.CMD_ACK_UNAUTH, b'')]
+        if command == const.CMD_AUTH:
+            self.authenticated = bytes(data[:4]) == protocol.make_commkey(device.password, self.session_id)
+            return [(const.CMD_ACK_OK if self.authenticated else const.CMD_ACK_UNAUTH, b'')]
+        if not self.authenticated:
+            return [(const.CMD_ACK_UNAUTH, b'')]
+        if command == const.CMD_ACK_OK:
+            return [] # event acknowledge
+        if command in ACK_COMMANDS:
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_EXIT:
+            self.unregister()
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_GET_FREE_SIZES:
+            return [(const.CMD_ACK_OK, device.sizes())]
+        if command == const.CMD_GET_VERSION:
+            return [(const.CMD_ACK_OK, b'Ver 6.60 Simulator\x00')]
+        if command == const.CMD_OPTIONS_RRQ:
+            key = bytes(data).split(b'\x00')[0].decode(errors='ignore')
+            value = device.options.get(key)
+            if value is None:
+                return [(const.CMD_ACK_ERROR, b'')]
+            return [(const.CMD_ACK_OK, ('%s=%s\x00' % (key, value)).encode())]
+        if command == const.CMD_GET_PINWIDTH:
+            return [(const.CMD_ACK_OK, b'\x09\x00')]
+        if command == const.CMD_GET_TIME:
+            return [(const.CMD_ACK_OK, pack('<I', protocol.encode_time(device.now())))]
+        if command == const.CMD_SET_TIME:
+            moment = protocol.decode_time(bytes(data[:4]))
+            device.time_offset = moment - datetime.now()
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_USER_WRQ:
+            device.set_user(bytes(data))
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_DELETE_USER:
+            device.delete_user(unpack('h', data[:2])[0])
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_CLEAR_ATTLOG:
+            device.clear_attendance()
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_CLEAR_DATA:
+            device.clear_data()
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const.CMD_REG_EVENT:
+            self.unregister()
+            if unpack('<I', data[:4])[0]:
+                self.register()
+            return [(const.CMD_ACK_OK, b'')]
+        if command == const._CMD_PREPARE_BUFFER:
+            _flag, buffer_command, fct, _ext = unpack('<bhii', data[:11])
+            if buffer_command == const.CMD_USERTEMP_RRQ and fct == const.FCT_USER:
+                self.buffer = device.user_buffer()
+            elif buffer_command == const.CMD_ATTLOG_RRQ:
+                self.buffer = device.attendance_buffer()
+            else:
+                self.buffer = pack('<I', 0) # no templates or other data
+            if len(self.buffer) <= UDP_DATA_SIZE - 8:
+                return [(const.CMD_DATA, self.buffer)]
+            return [(const.CMD_ACK_OK, b'\x00' + pack('<I', len(self.buffer)) + pack('<I', 0))]
+        if command == const._CMD_READ_BUFFER:
+            start, size = unpack('<ii', data[:8])
+            chunk = self.buffer[start:start + size]
+            answer = [(const.CMD_PREPARE_DATA, pack('<II', len(chunk), 0))]
+            step = self.data_size or max(len(chunk), 1)
+            for offset in range(0, len(chunk), step):
+                answer.append((const.CMD_DATA, chunk[offset:offset + step]))
+            answer.append((const.CMD_ACK_OK, b''))
+            return answer
+        return [(const.CMD_ACK_UNKNOWN, b'')]
+
+    def register(self):
+        self.listener = self.send_event
+        with self.device.lock:
+            self.device.listeners.append(self.listener)
+
+    def unregister(self):
+        if self.listener is not None:
+            with self.device.lock:
+                if self.listener in self.device.listeners:
+                    self.device.listeners.remove(self.listener)
+            self.listener = None
+
+
+class _Link(object):
+    """
+    delivers the packets of one client after the simulated latency, in
+    order, dropping them with the simulated loss probability
+    """
+
+    def __init__(self, simulator, send):
+        self.simulator = simulator
+        self.send = send
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data):
+        with self.condition:
+            self.queue.append((time.time() + self.simulator.latency, data))
+            self.condition.notify()
+
+    def close(self, wait=False):
+        """
+        :param wait: wait until the queued packets are sent
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if wait:
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                due, data = self.queue.popleft()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.send(data)
+            except OSError:
+                return
+            self.simulator.count('bytes_sent', len(data))
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            part = self.request.recv(size - len(data))
+            if not part:
+                raise EOFError
+            data += part
+        return data
+
+    def handle(self):
+        simulator = self.server.simulator
+        simulator.count('connections')
+        session_id = simulator.new_session_id()
+        link = _Link(simulator, self.request.sendall)
+        session = _Session(simulator.device, session_id, lambda event: link.put(
+            protocol.create_tcp_top(make_packet(const.CMD_REG_EVENT, session_id, 0, event))))
+        try:
+            while True:
+                length = protocol.parse_tcp_top(self.recv_exactly(8))
+                packet = self.recv_exactly(length)
+                command, _checksum, _session_id, reply_id = protocol.parse_header(packet)
+                simulator.count('commands')
+                if simulator.verbose: print ("tcp command %i" % command)
+                answer = session.handle(command, memoryview(packet)[8:])
+                if answer and simulator.lost():
+                    continue # the whole exchange is lost
+                for response, payload in answer:
+                    link.put(protocol.create_tcp_top(make_packet(response, session.session_id, reply_id, payload)))
+                if command == const.CMD_EXIT:
+                    break
+        except Exception as e:
+            if simulator.verbose: print ("tcp connection closed: %s" % e)
+        finally:
+            session.unregister()
+            link.close(wait=True)
+
+
+class _UDPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        simulator = self.server.simulator
+        packet, sock = self.request
+        if len(packet) < 8:
+            return
+        command, _checksum, session_id, reply_id = protocol.parse_header(packet)
+        simulator.count('commands')
+        if simulator.verbose: print ("udp command %i" % command)
+        session, link = simulator.udp_session(self.client_address, sock, command == const.CMD_CONNECT)
+        if session is None:
+            return
+        for response, payload in session.handle(command, memoryview(packet)[8:]):
+            if simulator.lost():
+                continue # every datagram can be lost
+            link.put(make_packet(response, session.session_id, reply_id, payload))
+        if command == const.CMD_EXIT:
+            simulator.udp_forget(self.client_address)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ZKSimulator(object):
+    """
+    TCP and/or UDP server speaking the ZK protocol for a SimulatedDevice
+    """
+
+    def __init__(self, device=None, host='127.0.0.1', port=0, tcp=True, udp=False,
+                 latency=0, loss=0, seed=None, verbose=False):
+        """
+        :param device: SimulatedDevice (default: 100 users, 1000 records)
+        :param port: port of both servers (0: any free port)
+        :param tcp: serve TCP
+        :param udp: serve UDP (on the same port number)
+        :param latency: seconds added before every answer packet
+        :param loss: probability (0..1) to lose an answer: the whole
+            exchange over TCP, every datagram over UDP
+        """
+        self.device = device or SimulatedDevice()
+        self.host = host
+        self.port = port
+        self.tcp = tcp
+        self.udp = udp
+        self.latency = latency
+        self.loss = loss
+        self.verbose = verbose
+        self.stats = {'connections': 0, 'commands': 0, 'bytes_sent': 0, 'lost': 0}
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__session_id = 0
+        self.__udp_sessions = {}
+        self.__servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """
+        :return: self, with the port in use
+        """
+        if self.tcp:
+            server = _ThreadingTCPServer((self.host, self.port), _TCPHandler)
+            self.port = server.server_address[1]
+            self.__serve(server)
+        if self.udp:
+            server = socketserver.ThreadingUDPServer((self.host, self.port), _UDPHandler)
+            server.daemon_threads = True
+            self.port = server.server_address[1]
+            self.__serve(server)
+        return self
+
+    def __serve(self, server):
+        server.simulator = self
+        self.__servers.append(server)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        for server in self.__servers:
+            server.shutdown()
+            server.server_close()
+        self.__servers = []
+        for session, link in self.__udp_sessions.values():
+            session.unregister()
+            link.close()
+        self.__udp_sessions = {}
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.stats[name] += amount
+
+    def lost(self):
+        if not self.loss:
+            return False
+        with self.__lock:
+            lost = self.__random.random() < self.loss
+            if lost:
+                self.stats['lost'] += 1
+        return lost
+
+    def new_session_id(self):
+        with self.__lock:
+            self.__session_id = self.__session_id % 0xfff0 + 1
+            return self.__session_id
+
+    def udp_session(self, address, sock, connect):
+        with self.__lock:
+            current = self.__udp_sessions.get(address)
+        if connect or current is None:
+            if current is not None:
+                current[0].unregister()
+                current[1].close()
+            session_id = self.new_session_id()
+            link = _Link(self, lambda data: sock.sendto(data, address))
+            session = _Session(self.device, session_id, lambda event: link.put(
+                make_packet(const.CMD_REG_EVENT, session_id, 0, event)), UDP_DATA_SIZE)
+            current = (session, link)
+            with self.__lock:
+                self.__udp_sessions[address] = current
+            self.count('connections')
+        return current
+
+    def udp_forget(self, address):
+        with self.__lock:
+            current = self.__udp_sessions.pop(address, None)
+        if current is not None:
+            current[0].unregister()
+            current[1].close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZK device simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4370)
+    parser.add_argument('--protocol', choices=['tcp', 'udp', 'both'], default='both')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--record-size', type=int, choices=[8, 16, 40], default=40)
+    parser.add_argument('--user-size', type=int, choices=[28, 72], default=72)
+    parser.add_argument('--password', type=int, default=0)
+    parser.add_argument('--serial', default=None)
+    parser.add_argument('--latency', type=float, default=0, help='seconds before every answer')
+    parser.add_argument('--loss', type=float, default=0, help='probability to lose an answer (0..1)')
+    parser.add_argument('--events', type=float, default=0, help='live attendance events per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    device = SimulatedDevice(args.users, args.records, args.record_size, args.user_size,
+                             args.password, args.serial, seed=args.seed)
+    simulator = ZKSimulator(device, args.host, args.port, tcp=args.protocol in ('tcp', 'both'),
+                            udp=args.protocol in ('udp', 'both'), latency=args.latency,
+                            loss=args.loss, seed=args.seed, verbose=args.verbose)
+    simulator.start()
+    print ("ZK simulator on %s:%i (%s): %i users, %i records of %i bytes" % (
+        args.host, simulator.port, args.protocol, args.users, args.records, args.record_size))
+    rnd = random.Random(args.seed)
+    try:
+        while True:
+            if args.events > 0:
+                time.sleep(rnd.expovariate(args.events))
+                record = device.punch(rnd.choice(device.users)[5])
+                if args.verbose: print ("event %s %s" % (record[1], record[2]))
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        print ("stats: %s" % simulator.stats)
+
+
+if __name__ == '__main__':
+    main()
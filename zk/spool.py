@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+local spool of partially downloaded buffers, so an interrupted
+read_with_buffer can resume fetching only the missing chunks
+"""
+import json
+import os
+
+
+class Spool(object):
+    """
+    keeps the chunks of one buffer (device, command, size) already
+    downloaded in a data file, plus a json file with the completed ranges
+    """
+
+    def __init__(self, directory, key, size, grows=False):
+        """
+        :param directory: directory for the spool files
+        :param key: device and buffer identifier (serial, command...)
+        :param size: total size of the buffer; a spool of another size is
+            discarded (the buffer changed on the device)
+        :param grows: the buffer only grows by appending (attendance log),
+            so the chunks of a smaller spool are still valid, except the
+            first one (it starts with the total size)
+        """
+        name = ''.join(c if c.isalnum() else '_' for c in key)
+        self.data_file = os.path.join(directory, '%s.spool' % name)
+        self.index_file = os.path.join(directory, '%s.json' % name)
+        self.size = size
+        self.completed = {}
+        self.__file = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            previous = index['size']
+            if os.path.getsize(self.data_file) < previous:
+                # the data file was not written completely
+                self.completed = {}
+            elif previous == size:
+                self.completed = dict((int(start), length) for start, length in index['completed'])
+            elif grows and previous < size:
+                self.completed = dict((int(start), length) for start, length in index['completed']
+                                      if start > 0 and start + length <= previous)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.completed = {}
+
+    def missing(self, ranges):
+        """
+        :param ranges: list of (start, size) that make up the buffer
+        :return: the ranges that still have to be downloaded
+        """
+        return [(start, size) for start, size in ranges if self.completed.get(start) != size]
+
+    def load(self, view):
+        """
+        copy the completed ranges into the buffer
+
+        :return: amount of bytes loaded
+        """
+        loaded = 0
+        if not self.completed:
+            return loaded
+        with open(self.data_file, 'rb') as f:
+            for start, size in sorted(self.completed.items()):
+                f.seek(start)
+                f.readinto(view[start:start + size])
+                loaded += size
+        return loaded
+
+    def save(self, start, data):
+        """
+        store a downloaded chunk and checkpoint it
+        """
+        if self.__file is None:
+            mode = 'r+b' if self.completed and os.path.exists(self.data_file) else 'w+b'
+            self.__file = open(self.data_file, mode)
+            self.__file.truncate(self.size)
+        self.__file.seek(start)
+        self.__file.write(data)
+        self.__file.flush()
+        self.completed[start] = len(data)
+        index = {'size': self.size, 'completed': sorted(self.completed.items())}
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def discard(self):
+        """
+        remove the spool files (the buffer was read completely)
+        """
+        self.close()
+        self.completed = {}
+        for filename in (self.data_file, self.index_file):
+            try:
+                os.remove(filename)
+            except (IOError, OSError):
+                pass
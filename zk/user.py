@@ -12,6 +12,17 @@ class User(object):
         self.user_id = user_id
         self.card = int(card) # 64 int to 40 bit int
 
+    def json_pack(self):
+        return {
+            "uid": self.uid,
+            "name": self.name,
+            "privilege": self.privilege,
+            "password": self.password,
+            "group_id": self.group_id,
+            "user_id": self.user_id,
+            "card": self.card
+        }
+
     @staticmethod
     def json_unpack(json):
         #validate?